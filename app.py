@@ -1,815 +1,5541 @@
-from fastapi.middleware.cors import CORSMiddleware
-import threading
-import time
-from datetime import datetime
-from collections import deque
-from contextlib import asynccontextmanager
-from pathlib import Path
-import sqlite3
-import asyncio
-import queue
-import math
-
-from fastapi import FastAPI, WebSocket, Query
-from fastapi.responses import JSONResponse, StreamingResponse
-from fastapi import Body
-import uvicorn
-
-import serial
-from serial.tools import list_ports
-import json
-import requests
-import os
-import csv
-# ---------------------- Config ----------------------
-
-MAX_DATOS     = 300       # Últimas muestras en memoria para /ecg
-BUFFER_DB     = 50        # Lote mínimo para volcar a SQLite (ECG y BPM juntos)
-BAUDRATE      = 115200    # Debe coincidir con Serial.begin(...) del Arduino
-SER_TIMEOUT   = 1.0       # Timeout de lectura en segundos
-RETRY_SECS    = 1.0       # Reintento de conexión cada 1s
-
-#FS            = 853       # Frecuencia de muestreo estimada (informativa)
-FS       = 125
-
-# Detector de BPM sencillo (umbral + refractario)
-UMBRAL       = 400
-REFRACT_SEC  = 0.300
-RR_MIN       = 0.300
-RR_MAX       = 2.000
-
-# Señal de prueba (senoide)
-#_test_cfg = {
-#    "enabled": False,   # Si True, reemplaza val por senoide
-#    "freq": 1.0,        # Hz
-#    "amp": 800,         # amplitud en cuentas (mantener << 0x7FFFFF)
-#    "offset": 0,        # offset DC en cuentas
-#}
-#_test_state = {
-#    "phase": 0.0,
-#    "last_t": None,     # perf_counter del último sample
-#}
-
-# Senal ed prueba 2
-_test_cfg_2 = {
-    "enabled":"False",
-    "freq": 1.0,    # Frecuencia de la señal en Hz
-    "amp": 1.0,     # Amplitud máxima = 1
-    "offset": 0.0,  # Offset 0 para -1 a 1
-}
-_test_state_2 = {
-    "last_t": None,
-    "phase": 0.0
-}
-
-# ---------------------- Estado ----------------------
-
-datos_ecg = deque(maxlen=MAX_DATOS)  # [{"timestamp": str, "value": int}, ...]
-db_lock   = threading.Lock()
-activar_escritura = False
-
-buffer_db_ecg = []  # [(ts, val), ...]
-buffer_db_bpm = []  # [(ts, bpm), ...]
-
-_last_bpm = None
-_last_bpm_ts = None
-
-_last_val_for_peak = 0
-_last_peak_time = 0.0
-
-# WS: clientes y cola thread-safe
-ws_clients = set()
-ws_queue = queue.Queue(maxsize=4096)  # valores int (crudos)
-
-HDR = b'\xAA\x55'
-
-# Carpeta y DB
-BASE_DIR = Path(__file__).resolve().parent
-DATA_DIR = BASE_DIR / "data"
-DATA_DIR.mkdir(parents=True, exist_ok=True)
-
-
-
-
-# ---------------------- DB ----------------------
-
-def conectar_sqlite(nombre_bd="ecg_data.db"):
-    ruta_bd = DATA_DIR / nombre_bd
-    conn = sqlite3.connect(ruta_bd, check_same_thread=False)
-    cur = conn.cursor()
-    cur.execute("PRAGMA journal_mode=WAL;")
-    cur.execute("PRAGMA synchronous=NORMAL;")
-    cur.execute("PRAGMA temp_store=MEMORY;")
-    cur.execute("PRAGMA cache_size=-2000;")  # ~2MB
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS ecg_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            value INTEGER NOT NULL
-        );
-    ''')
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS bpm_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            bpm INTEGER NOT NULL
-        );
-    ''')
-    conn.commit()
-    return conn
-
-db_conn = conectar_sqlite()
-
-def flush_buffers_if_needed(cursor, force=False):
-    """
-    Inserta ECG y BPM en UNA MISMA transacción cuando cualquiera
-    de los dos buffers alcanza el tamaño de lote o si 'force' es True.
-    Importante: si ocurre un error, NO se limpian los buffers;
-    se reintenta en el siguiente ciclo.
-    """
-    global buffer_db_ecg, buffer_db_bpm
-
-    ecg_ready = len(buffer_db_ecg) >= BUFFER_DB
-    bpm_ready = len(buffer_db_bpm) >= BUFFER_DB
-
-    if not (force or ecg_ready or bpm_ready):
-        return False
-
-    try:
-        with db_lock:
-            cursor.execute("BEGIN IMMEDIATE;")
-            if buffer_db_ecg:
-                cursor.executemany(
-                    "INSERT INTO ecg_data (timestamp, value) VALUES (?, ?)",
-                    buffer_db_ecg
-                )
-            if buffer_db_bpm:
-                cursor.executemany(
-                    "INSERT INTO bpm_data (timestamp, bpm) VALUES (?, ?)",
-                    buffer_db_bpm
-                )
-            db_conn.commit()
-            # Sólo si COMMIT fue exitoso, limpiamos los buffers
-            buffer_db_ecg.clear()
-            buffer_db_bpm.clear()
-        return True
-    except Exception as e:
-        # Rollback y mantenemos los buffers tal cual para reintentar luego
-        try:
-            db_conn.rollback()
-        except:
-            pass
-        print(f"Error al volcar lotes a DB: {e}. Se reintentará en el siguiente ciclo.")
-        return False
-
-# === Cambio dinámico de BD ===
-CURRENT_DB_NAME = "ecg_data.db"  # nombre actual (se ajusta al iniciar si ya abriste otra)
-DB_SWITCH_COUNTER = 0            # para avisar a hilos que renueven cursor
-
-def _sanitize_basename(name: str) -> str:
-    import re
-    base = (name or "").strip()
-    if base.lower().endswith(".db"):
-        base = base[:-3]
-    base = re.sub(r"[^A-Za-z0-9_\-]+", "_", base).strip("_-") or "ecg_data"
-    return base
-
-def _unique_db_filename(base: str) -> str:
-    base = _sanitize_basename(base)
-    fname = f"{base}.db"
-    p = DATA_DIR / fname
-    i = 1
-    while p.exists():
-        fname = f"{base}_{i}.db"
-        p = DATA_DIR / fname
-        i += 1
-    return fname
-
-def _current_db_path_from_conn() -> Path:
-    try:
-        cur = db_conn.cursor()
-        cur.execute("PRAGMA database_list;")
-        row = cur.fetchone()
-        if row and len(row) >= 3 and row[2]:
-            return Path(row[2])
-    except Exception:
-        pass
-    return DATA_DIR / CURRENT_DB_NAME
-
-# ---------------------- BPM sencillo ----------------------
-
-def detectar_bpm_sencillo(valor_actual: int, ts_str: str):
-    """
-    Pico = cruce ascendente del umbral + refractario.
-    BPM = 60 / RR del último intervalo válido.
-    Devuelve BPM nuevo (int) si se calcula; si no, None.
-    """
-    global _last_val_for_peak, _last_peak_time, _last_bpm, _last_bpm_ts
-
-    v = valor_actual
-    bpm_out = None
-
-    if v > UMBRAL and _last_val_for_peak <= UMBRAL:
-        t_now = time.time()
-        if _last_peak_time == 0.0:
-            _last_peak_time = t_now
-        else:
-            rr = t_now - _last_peak_time
-            if rr >= REFRACT_SEC and RR_MIN <= rr <= RR_MAX:
-                bpm = round(60.0 / rr)
-                _last_bpm = bpm
-                _last_bpm_ts = ts_str
-                bpm_out = bpm
-                _last_peak_time = t_now
-            elif rr >= REFRACT_SEC:
-                _last_peak_time = t_now
-
-    _last_val_for_peak = v
-    return bpm_out
-
-# ---------------------- Señal de prueba ----------------------
-
-
-def gen_test_sample_normalized_2():
-    now = time.perf_counter()
-    dt = 1.0 / FS
-
-    last_t = _test_state_2["last_t"]
-    if last_t is None:
-        target_t = now
-    else:
-        target_t = last_t + dt
-        if now < target_t:
-            time.sleep(target_t - now)
-
-    _test_state_2["last_t"] = target_t
-
-    # Avanza fase y genera senoide normalizada
-    phase = _test_state_2["phase"]
-    phase += 2.0 * math.pi * _test_cfg_2["freq"] / FS
-    if phase > 2.0 * math.pi:
-        phase -= 2.0 * math.pi
-    _test_state_2["phase"] = phase
-
-    val = _test_cfg_2["offset"] + _test_cfg_2["amp"] * math.sin(phase)
-
-    return val
-
-
-def _gen_test_sample():
-    """
-    Genera y retorna un valor entero de senoide a FS.
-    Controla el tiempo para emitir exactamente ~FS muestras/seg.
-    """
-    # Programación por tiempo para mantener la tasa FS
-    now = time.perf_counter()
-    dt = 1.0 / max(1, FS)
-
-    last_t = _test_state["last_t"]
-    if last_t is None:
-        # Primera muestra
-        target_t = now
-    else:
-        target_t = last_t + dt
-        if now < target_t:
-            time.sleep(target_t - now)
-
-    _test_state["last_t"] = target_t
-
-    # Avanza fase y genera senoide
-    phase = _test_state["phase"]
-    phase += 2.0 * math.pi * _test_cfg["freq"] / max(1, FS)
-    # Envuelve fase
-    if phase > 2.0 * math.pi:
-        phase -= 2.0 * math.pi
-    _test_state["phase"] = phase
-
-    val = int(round(_test_cfg["offset"] + _test_cfg["amp"] * math.sin(phase)))
-
-    # Protección de rango 24b con signo
-    if val > 0x7FFFFF:
-        val = 0x7FFFFF
-    elif val < -0x800000:
-        val = -0x800000
-
-    return val
-
-# ---------------------- Autodetección de puerto ----------------------
-
-_KNOWN_IDS = {
-    (0x2341, 0x0043),  # Arduino Uno
-    (0x2341, 0x0001),  # Arduino (antiguo)
-    (0x2A03, 0x0043),  # Genuino/Arduino
-    (0x1A86, 0x7523),  # WCH CH340
-    (0x1A86, 0x5523),  # WCH CH340 variante
-    (0x0403, 0x6001),  # FTDI FT232
-    (0x10C4, 0xEA60),  # Silicon Labs CP210x
-}
-_KEYWORDS = ["arduino", "usb-serial", "ch340", "wch", "ftdi", "cp210", "nano"]
-_last_known_port = None
-
-def find_arduino_port(prefer=None):
-    ports = list(list_ports.comports())
-    if prefer:
-        for p in ports:
-            if p.device == prefer:
-                return prefer
-    for p in ports:
-        try:
-            if p.vid is not None and p.pid is not None:
-                if (p.vid, p.pid) in _KNOWN_IDS:
-                    return p.device
-        except Exception:
-            pass
-    for p in ports:
-        desc = f"{p.description} {p.manufacturer} {p.name}".lower()
-        if any(k in desc for k in _KEYWORDS):
-            return p.device
-    if ports:
-        return ports[0].device
-    return None
-
-# ---------------------- Serial 3B + reconexión / o Test Signal ----------------------
-
-_ser = None
-_stop_event = threading.Event()
-
-def _open_serial():
-    global _last_known_port
-    port = find_arduino_port(_last_known_port)
-    if port is None:
-        raise RuntimeError("No se encontró ningún puerto serie compatible.")
-    s = serial.Serial(port, BAUDRATE, timeout=SER_TIMEOUT)
-    _last_known_port = port
-    print(f"Conectado a {port} a {BAUDRATE} baudios.")
-    return s
-
-def _read_sample_24bit_be_signed(b0, b1, b2):
-    raw = (b0 << 16) | (b1 << 8) | b2
-    # if raw & 0x800000:
-    #     raw -= 0x1000000
-    return raw
-
-def _process_value(val, cursor):
-    """
-    Procesa un valor: buffer memoria, WS, BPM, y DB por lotes.
-    """
-    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-
-    # Memoria para /ecg
-    datos_ecg.append({"timestamp": ts, "value": val})
-
-    # Empujar a WS (no bloqueante)
-    try:
-        ws_queue.put_nowait(val)
-    except queue.Full:
-        # Si se llena, descartamos lo más antiguo para mantener latencia baja
-        try:
-            ws_queue.get_nowait()
-            ws_queue.put_nowait(val)
-        except Exception:
-            pass
-
-    # BPM
-    bpm_new = detectar_bpm_sencillo(val, ts)
-
-    # Escritura por lotes unificados (no saturar SQLite)
-    if activar_escritura:
-        buffer_db_ecg.append((ts, val))
-        if bpm_new is not None:
-            buffer_db_bpm.append((ts, int(bpm_new)))
-        flush_buffers_if_needed(cursor, force=False)
-
-def _read_exact(ser, n):
-    """
-    Lee exactamente n bytes o devuelve None si se agota el timeout.
-    """
-    data = bytearray()
-    while len(data) < n and not _stop_event.is_set():
-        chunk = ser.read(n - len(data))
-        if not chunk:  # timeout
-            return None
-        data.extend(chunk)
-    return bytes(data)
-
-def leer_desde_serial():
-    global _ser
-
-    cursor = db_conn.cursor()
-    last_seen_switch = globals().get("DB_SWITCH_COUNTER", 0)
-    while not _stop_event.is_set():
-        # Modo test: genera senoide y procesa
-        if _test_cfg_2["enabled"]:
-            try:
-# using  normalized sample
-                val = gen_test_sample_normalized_2()
-                _process_value(val, cursor)
-            except Exception as e:
-                print(f"Error generando señal de prueba: {e}")
-            continue
-
-        # Conexión/reconexión
-        if _ser is None or not (_ser.is_open if not callable(getattr(_ser, "is_open", None)) else _ser.is_open()):
-            try:
-                _ser = _open_serial()
-            except Exception as e:
-                print(f"No se pudo abrir puerto: {e}. Reintentando en {RETRY_SECS}s.")
-                time.sleep(RETRY_SECS)
-                continue
-
-        try:
-            while not _stop_event.is_set() and _ser and (_ser.is_open if not callable(getattr(_ser, "is_open", None)) else _ser.is_open()):
-                
-                cur_switch = globals().get("DB_SWITCH_COUNTER", 0)
-                if last_seen_switch != cur_switch:
-                    try:
-                        cursor = db_conn.cursor()
-                    except Exception:
-                        pass
-                    last_seen_switch = cur_switch
-
-                # 1) Buscar 0xAA
-                b = _read_exact(_ser, 1)
-                if b is None:
-                    continue
-                if b[0] != 0xAA:
-                    continue
-
-                # 2) Confirmar 0x55
-                b = _read_exact(_ser, 1)
-                if b is None or b[0] != 0x55:
-                    # si no es 0x55, volvemos a buscar header
-                    continue
-
-                # 3) Leer payload de 3 bytes (MSB, MID, LSB)
-                payload = _read_exact(_ser, 3)
-                if payload is None or len(payload) != 3:
-                    continue
-
-                msb, mid, lsb = payload[0], payload[1], payload[2]
-                val = _read_sample_24bit_be_signed(msb, mid, lsb)
-                _process_value(val, cursor)
-
-        except (serial.SerialException, OSError, ValueError) as e:
-            print(f"Error de lectura serial: {e}. Intentando reconectar en {RETRY_SECS}s.")
-            try:
-                if _ser and (_ser.is_open if not callable(getattr(_ser, "is_open", None)) else _ser.is_open()):
-                    _ser.close()
-            except Exception:
-                pass
-            _ser = None
-            time.sleep(RETRY_SECS)
-            continue
-        except Exception as e:
-            print(f"Lectura interrumpida por excepción: {e}. Intentando reconectar en {RETRY_SECS}s.")
-            try:
-                if _ser and (_ser.is_open if not callable(getattr(_ser, "is_open", None)) else _ser.is_open()):
-                    _ser.close()
-            except Exception:
-                pass
-            _ser = None
-            time.sleep(RETRY_SECS)
-            continue
-
-    # Cierre
-    try:
-        if _ser and (_ser.is_open if not callable(getattr(_ser, "is_open", None)) else _ser.is_open()):
-            _ser.close()
-    except Exception:
-        pass
-    flush_buffers_if_needed(db_conn.cursor(), force=True)
-    print("Hilo de lectura finalizado.")
-
-# ---------------------- WebSocket: broadcaster ----------------------
-
-async def _ws_broadcaster():
-    """
-    Empaqueta valores en lotes y los envía a todos los clientes WS.
-    Formato: texto CSV con n valores por mensaje.
-    """
-    BATCH = 10
-    IDLE_FLUSH_MS = 50
-
-    lote = []
-    while not _stop_event.is_set():
-        try:
-            val = ws_queue.get(timeout=IDLE_FLUSH_MS / 1000.0)
-            lote.append(val)
-        except queue.Empty:
-            pass
-
-        if lote and (len(lote) >= BATCH or ws_queue.empty()):
-            msg = ",".join(map(str, lote))
-            for ws in list(ws_clients):
-                try:
-                    await ws.send_text(msg)
-                except Exception:
-                    try:
-                        ws_clients.discard(ws)
-                    except Exception:
-                        pass
-            lote.clear()
-
-        await asyncio.sleep(0)
-
-# ---------------------- FastAPI (API + WS, sin frontend) ----------------------
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    print("API ECG iniciada (JSON + WebSocket). Detector: simple_threshold")
-    hilo = threading.Thread(target=leer_desde_serial, daemon=True)
-    hilo.start()
-    ws_task = asyncio.create_task(_ws_broadcaster())
-    try:
-        yield
-    finally:
-        _stop_event.set()
-        ws_task.cancel()
-        try:
-            await ws_task
-        except Exception:
-            pass
-        hilo.join(timeout=2.0)
-        print("API ECG detenida.")
-
-app = FastAPI(lifespan=lifespan)
-
-# Permitir CORS
-origins = [
-    "http://localhost:3000",  # tu frontend local
-    "http://127.0.0.1:3000",  # alternativa 
-    "https://qm1n4mn1-4321.brs.devtunnels.ms",
-    "*",                       # o todos los orígenes (solo para pruebas)
-]
-
-# Configurar CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],          # <- permite todos los orígenes; para producción usa tu frontend específico
-    allow_credentials=True,
-    allow_methods=["*"],          # GET, POST, etc.
-    allow_headers=["*"],          # Headers permitidos
-)
-
-@app.get("/health")
-def health():
-    return {
-        "ok": True,
-        "samples_in_memory": len(datos_ecg),
-        "writing": activar_escritura,
-        "last_known_port": _last_known_port,
-        "baudrate": BAUDRATE,
-        "hr_detector": "simple_threshold",
-        "buffer_ecg": len(buffer_db_ecg),
-        "buffer_bpm": len(buffer_db_bpm),
-        "umbral": UMBRAL,
-        "refract_sec": REFRACT_SEC,
-        "ws_clients": len(ws_clients),
-        "test_signal": _test_cfg_2
-    }
-
-@app.get("/ecg")
-def obtener_ecg_memoria():
-    return JSONResponse(list(datos_ecg))
-
-@app.get("/activar_escritura/{estado}")
-def activar_escritura_api(estado: str):
-    global activar_escritura
-    activar_escritura = (estado.lower() == "on")
-    return {"escritura_activada": activar_escritura}
-
-@app.get("/bpm")
-def obtener_bpm():
-    return {"bpm": _last_bpm, "timestamp": _last_bpm_ts}
-
-@app.get("/test_signal")
-def set_test_signal(
-    enabled: bool = Query(..., description="true/false para activar la senoide"),
-    freq: float = Query(1.0, description="Frecuencia Hz"),
-    amp: int = Query(800, description="Amplitud en cuentas 24b"),
-    offset: int = Query(0, description="Offset DC en cuentas 24b"),
-):
-    """
-    Activa/desactiva modo senoide y ajusta parámetros.
-    Al activarse, la lectura por serial se ignora y se envían valores senoidales a WS y DB.
-    """
-    _test_cfg["enabled"] = bool(enabled)
-    _test_cfg["freq"] = max(0.0, float(freq))
-    _test_cfg["amp"] = int(amp)
-    _test_cfg["offset"] = int(offset)
-    # Reset de fase/tiempo para que arranque limpio
-    _test_state["phase"] = 0.0
-    _test_state["last_t"] = None
-    return {"ok": True, "test_signal": _test_cfg}
-
-@app.get("/db/info")
-def db_info():
-    p = _current_db_path_from_conn()
-    try:
-        size = p.stat().st_size
-        mtime = datetime.fromtimestamp(p.stat().st_mtime).strftime("%Y-%m-%d %H:%M:%S")
-    except Exception:
-        size, mtime = None, None
-    return {"name": p.name, "path": str(p), "size_bytes": size, "modified": mtime}
-
-@app.post("/db/set")
-def db_set(name: str = Query(..., description="Base sin .db; si existe, se autoenumera")):
-    """
-    Vuelca buffers, cierra la conexión actual y abre una nueva con conectar_sqlite().
-    """
-    global db_conn, CURRENT_DB_NAME, DB_SWITCH_COUNTER
-
-    # Volcar buffers antes de cambiar
-    try:
-        flush_buffers_if_needed(db_conn.cursor(), force=True)
-    except Exception:
-        pass
-
-    # Cerrar BD actual
-    try:
-        db_conn.close()
-    except Exception:
-        pass
-
-    # Elegir nombre único y abrir
-    new_db_name = _unique_db_filename(name)  # e.g., paciente.db o paciente_1.db
-    db_conn = conectar_sqlite(new_db_name)
-    CURRENT_DB_NAME = new_db_name
-
-    # Avisar a hilos: renueven cursor
-    DB_SWITCH_COUNTER += 1
-
-    p = DATA_DIR / CURRENT_DB_NAME
-    return {"ok": True, "db_name": CURRENT_DB_NAME, "path": str(p)}
-
-@app.get("/db/list")
-def db_list():
-    """
-    Lista todos los .db en DATA_DIR con tamaño y fecha.
-    """
-    items = []
-    for p in sorted(DATA_DIR.glob("*.db")):
-        try:
-            size = p.stat().st_size
-            mtime = datetime.fromtimestamp(p.stat().st_mtime).strftime("%Y-%m-%d %H:%M:%S")
-        except Exception:
-            size, mtime = None, None
-        items.append({"name": p.name, "size_bytes": size, "modified": mtime})
-    return items
-
-def _csv_stream_for_db(db_path: Path, table: str):
-    # Conecta de solo lectura a la DB objetivo
-    conn = sqlite3.connect(str(db_path))
-    cur = conn.cursor()
-    if table == "ecg":
-        yield "timestamp,value\n"
-        cur.execute("SELECT timestamp, value FROM ecg_data ORDER BY id;")
-    else:
-        yield "timestamp,bpm\n"
-        cur.execute("SELECT timestamp, bpm FROM bpm_data ORDER BY id;")
-
-    while True:
-        rows = cur.fetchmany(10000)
-        if not rows:
-            break
-        for r in rows:
-            # Campos simples, separados por coma
-            yield f"{r[0]},{r[1]}\n"
-
-    try:
-        conn.close()
-    except Exception:
-        pass
-
-@app.get("/db/export")
-def db_export(
-    name: str = Query(..., description="Nombre del archivo .db a exportar (de /db/list)"),
-    table: str = Query("ecg", pattern="^(ecg|bpm)$", description="Tabla a exportar: ecg o bpm")
-):
-    """
-    Exporta la DB indicada a CSV por streaming.
-    - /db/export?name=archivo.db&table=ecg
-    - /db/export?name=archivo.db&table=bpm
-    """
-    db_path = (DATA_DIR / name)
-    if not db_path.exists() or db_path.suffix.lower() != ".db":
-        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
-
-    # Antes de exportar, si es la BD actual, volcar buffers
-    if db_path.resolve() == _current_db_path_from_conn().resolve():
-        flush_buffers_if_needed(db_conn.cursor(), force=True)
-
-    filename = f"{db_path.stem}_{table}.csv"
-    return StreamingResponse(
-        _csv_stream_for_db(db_path, table),
-        media_type="text/csv; charset=utf-8",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
-    )
-
-@app.get("/newData")
-def get_new_data():
-    file_path = "newDataStatus.txt"
-
-    try:
-        with open(file_path, "r") as f:
-            data = json.load(f)
-
-        new_data_value = data.get("newData", "false").lower() == "true"
-
-        return {"newData": new_data_value}
-    except FileNotFoundError:
-        return {"error":"Archivo no encontrado"}
-    except json.JSONDecodeError:
-        return{"error":"Error al parsear JSON"}
-
-@app.get("/checkTrainingStatus")
-def check_external():
-    url = "https://qm1n4mn1-3333.brs.devtunnels.ms/"   
-    try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        return {"ok": True, "data": r.json()}  
-    except Exception as e:
-        return {"ok": False, "error": str(e)}
-
-@app.get("/predictedData")
-def obtener_ecg_predicciones():
-    file_path = "predicted_data.csv"
-    if not os.path.exists(file_path):
-        return JSONResponse({"error": "Archivo no encontrado"}, status_code=404)
-
-    try:
-        data = []
-        with open(file_path, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                # Convertir valores a números si es necesario
-                row_converted = {k: (float(v) if v.replace('.', '', 1).isdigit() else v) for k, v in row.items()}
-                data.append(row_converted)
-
-        return JSONResponse(content=data)
-    except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
-
-@app.get("/sendPrediction")
-def send_prediction():
-    file_path = "predicted_data.csv"
-    if not os.path.exists(file_path):
-        return JSONResponse({"error": "Archivo no encontrado"}, status_code=404)
-
-    try:
-        data = []
-        with open(file_path, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                # Convertir valores a números si es posible
-                row_converted = {
-                    k: (float(v) if v.replace('.', '', 1).isdigit() else v)
-                    for k, v in row.items()
-                }
-                data.append(row_converted)
-
-        return {"ok": True, "predictions": data}
-    except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
-
-
-@app.post("/doPrediction")
-def do_prediction(payload: dict = Body(default={})):
-    global predictionStatus
-    try:
-        predictionStatus = {
-            "ok": True,
-            "message": "Prediction sended"
-        }
-        return predictionStatus
-    except Exception as e:
-        predictionStatus = {"ok": False, "error": str(e)}
-        return predictionStatus
-
-@app.get("/predictionStatus")
-def getPredictionStatus():
-    return {"status": predictionStatus}
-
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    ws_clients.add(websocket)
-    try:
-        while True:
-            await websocket.receive_text()
-    except Exception:
-        ws_clients.discard(websocket)
-
-
-@app.post("/resetPredictionStatus")
-def reset_prediction_status():
-    global predictionStatus
-    predictionStatus = {"ok": False, "message": "idle"}
-    return {"ok": True, "message": "PredictionStatus reset"}
-
-# ---------------------- Main ----------------------
-
-if __name__ == "__main__":
-    # Ejecuta la API (JSON + WebSocket)
-    uvicorn.run(app, host="0.0.0.0", port=5000)
+from fastapi.middleware.cors import CORSMiddleware
+import threading
+import time
+from datetime import datetime, timedelta
+from collections import deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+import sqlite3
+import asyncio
+import queue
+import zlib
+import struct
+import io
+from bisect import bisect_left
+
+import numpy as np
+from scipy import signal as sp_signal
+
+from fastapi import FastAPI, WebSocket, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import Body
+import uvicorn
+
+import serial
+from serial.tools import list_ports
+import json
+import requests
+import httpx
+import os
+import platform
+import csv
+# ---------------------- Config ----------------------
+
+MAX_DATOS     = 300       # Muestras que devuelve /ecg sin ?since
+ECG_MEMORY_MIN = 5.0      # Minutos de señal en el buffer circular de /ecg
+BUFFER_DB     = 50        # Lote mínimo para volcar a SQLite (ECG y BPM juntos)
+DB_SCHEMA     = 2         # Esquema de BD nuevas: 1 = fila por muestra, 2 = chunks BLOB
+CHUNK_SECS    = 2.0       # Duración de cada chunk en el esquema 2
+CHUNK_GAP_SECS = 0.5      # Hueco entre bloques que obliga a cerrar un chunk (reconexión)
+CHUNK_ENCODING = "delta+zlib"  # "raw", "delta" o "delta+zlib"
+PYRAMID_LEVELS = (1, 10, 60)  # Niveles min/max/media precalculados (segundos por bucket)
+
+# Hilo escritor de SQLite: commit cuando hay BUFFER_DB filas o pasan DB_COMMIT_MS
+DB_COMMIT_MS      = 1000
+DB_QUEUE_MAX      = 2048    # Bloques en cola hacia el escritor (si se llena, se descartan)
+DB_RETRY_MAX_SECS = 5.0     # Espera máxima entre reintentos tras un error
+DB_BUFFER_MAX_SECS = 600    # Datos máx. retenidos en memoria mientras la BD falla
+DB_WAL_LIMIT_MB   = 64      # journal_size_limit: el WAL se recorta a esto tras cada checkpoint
+
+# Rotación de grabaciones: None (manual con /db/set), "session" (un archivo
+# por cada /activar_escritura/on), "hours" (cada ROTATE_HOURS) o "size"
+# (al superar ROTATE_MAX_MB). Los archivos rotados se llaman <ROTATE_PREFIX>_<fecha>.db
+ROTATE_MODE       = None
+ROTATE_HOURS      = 6.0
+ROTATE_MAX_MB     = 512
+ROTATE_PREFIX     = "ecg"
+# Retención (sólo archivos rotados y cerrados; None = sin límite)
+RETENTION_DAYS    = None
+RETENTION_MAX_GB  = None
+MAINT_INTERVAL_SECS = 60    # Ciclo del hilo de mantenimiento (retención, checkpoint, optimize)
+BAUDRATE      = 115200    # Debe coincidir con Serial.begin(...) del Arduino
+SER_TIMEOUT   = 1.0       # Timeout de lectura en segundos
+RETRY_SECS    = 1.0       # Reintento de conexión cada 1s
+
+#FS            = 853       # Frecuencia de muestreo estimada (informativa)
+FS       = 125
+
+# Lectura serial: "chunked" lee bloques (in_waiting) y decodifica con NumPy;
+# "bytewise" es el lector original byte a byte.
+SERIAL_MODE   = "chunked"
+FRAME_LEN     = 5         # HDR (2 bytes) + payload 24b (3 bytes)
+
+# Reloj de muestras: seq se asigna al decodificar y t = ancla + seq / FS
+LATE_MS       = 500       # Muestra que llega (o sale de una etapa) más tarde que esto: tardía
+REANCHOR_SECS = 2.0       # Desfase con el reloj del sistema que obliga a re-anclar
+
+# Filtro en streaming entre el decodificador y los consumidores (SOS con estado)
+FILTER_ENABLED   = True
+FILTER_BAND      = (0.5, 40.0)  # Pasa-banda (Hz); 0.5 Hz quita la deriva de línea base. None en un borde lo desactiva
+FILTER_NOTCH_HZ  = 50.0         # Red eléctrica (50 o 60 Hz); None desactiva
+FILTER_NOTCH_Q   = 30.0
+FILTER_MEDIAN_MS = None         # Línea base por medianas causales, p.ej. (200, 600); None desactiva
+FILTER_STORE     = True         # Guardar también la señal filtrada en la BD
+
+# Detector de latidos: "pan_tompkins" (por bloques, reloj de muestras) o "simple_threshold"
+HR_DETECTOR  = "pan_tompkins"
+
+# Inferencia ECGNet en proceso: modelo cargado una vez (en su hilo, al iniciar),
+# latidos clasificados por lotes a medida que llegan
+INFER_ENABLED   = True
+MODEL_PATH      = "ecg_model_mlp.pth"   # en data/
+SCALER_PATH     = "minmaxscaler.pkl"    # en data/
+MODEL_INPUT     = 187       # Muestras por latido
+MODEL_FS        = 125       # Frecuencia de los latidos de entrenamiento
+PRED_CLASES     = ("N", "S", "V", "F", "Q")
+INFER_BATCH     = 64        # Latidos por lote
+INFER_QUEUE_MAX = 1024      # Elementos en cola hacia el hilo de inferencia
+INFER_RESULTS   = 2000      # Predicciones en vivo retenidas en memoria
+INFER_THREADS   = 1         # Hilos de torch (no quitar CPU a la adquisición)
+# Segmentación de latidos: ventana fija desde cada R tomada del buffer circular
+# y remuestreada a MODEL_FS; cada latido se guarda en la tabla beats
+BEATS_ENABLED  = True
+BEAT_PRE_S     = 0.0        # Segundos antes de la R (0: empieza en la R, como los latidos de entrenamiento)
+BEAT_RING_SECS = 10.0       # Señal retenida para cortar ventanas
+PREDICT_INPUT_CSV  = "ecg_segmentado_187.csv"
+PREDICT_OUTPUT_CSV = "predicted_data.csv"
+
+# Detector de BPM sencillo (umbral + refractario)
+UMBRAL       = 400
+REFRACT_SEC  = 0.300
+RR_MIN       = 0.300
+RR_MAX       = 2.000
+
+# HRV en ventanas deslizantes sobre los RR del detector (ver AnalizadorHRV)
+HRV_WINDOWS_MIN  = (1, 5, 60)  # Minutos; se actualizan en cada latido
+HRV_HIST_BIN_MS  = 8           # Clase del histograma de RR (~1/128 s, la del índice triangular)
+HRV_PERSIST_MIN  = 5           # Ventanas de al menos esto se guardan en la tabla hrv
+HRV_PERSIST_SECS = 60.0        # Cada cuánto (tiempo de señal) se guarda una fila por ventana
+
+# Señal de prueba: reemplaza al serial por ECG sintético ("ecg") o una
+# senoide ("sine"), generados por bloques a FS (ver GeneradorECG)
+_test_cfg = {
+    "enabled": False,
+    "shape": "ecg",
+    "amp": 800,         # amplitud en cuentas (R en "ecg"; mantener << 0x7FFFFF)
+    "offset": 0,        # offset DC en cuentas
+    "freq": 1.0,        # Hz, sólo "sine"
+    "hr": 72.0,         # lpm medio
+    "hrv_ms": 40.0,     # desvío estándar de los RR
+    "noise": 0.02,      # ruido blanco, fracción de amp
+    "drift": 0.1,       # deriva de línea base (0.25 Hz), fracción de amp
+    "mains": 0.0,       # interferencia de red (FILTER_NOTCH_HZ), fracción de amp
+    "ectopic": 0.0,     # probabilidad de latido ventricular prematuro
+    "channels": 1,      # canales independientes; el pipeline consume el 0
+    "seed": None,
+}
+TEST_BLOCKS_PER_SEC = 25  # Bloques por segundo que entrega la señal de prueba
+
+# Adquisición (ECG_ACQ_MODE en el entorno): "thread" = el hilo lector corre dentro de
+# la API, un solo worker. "process" = este proceso adquiere, filtra, detecta y escribe
+# la BD, publica en memoria compartida (AnilloCompartido) y atiende el control en
+# ACQ_HOST:ACQ_PORT. "attach" = worker de la API (uvicorn --workers N) que sólo lee
+# la memoria compartida: /ecg, /bpm, /ws y las consultas a la BD se sirven en el
+# worker, el resto se reenvía al proceso de adquisición.
+ACQ_MODE    = os.environ.get("ECG_ACQ_MODE", "thread")
+# El anillo compartido no usa locks ni barreras de memoria: depende de que la CPU
+# haga visibles las escrituras en orden (x86). En ARM (Raspberry Pi) un worker podría
+# leer muestras a medio escribir, así que "process" y "attach" sólo corren en x86.
+SHM_SOPORTADO = platform.machine().lower() in ("x86_64", "amd64", "i386", "i686", "x86")
+if ACQ_MODE in ("process", "attach") and not SHM_SOPORTADO:
+    raise RuntimeError(f"ECG_ACQ_MODE={ACQ_MODE} necesita una CPU x86 (el anillo compartido no tiene "
+                       f"barreras de memoria) y esta es {platform.machine()}: use ECG_ACQ_MODE=thread")
+ACQ_HOST    = "127.0.0.1"
+ACQ_PORT    = 5001
+SHM_NAME    = "ecg_live"
+SHM_POLL_MS = 20          # Cada cuánto un worker "attach" copia lo nuevo del anillo
+SHM_MSG_SLOTS = 64        # Mensajes JSON (predicciones, HRV) que guarda el anillo para /ws/predictions y /ws/hrv
+SHM_MSG_BYTES = 16384     # Tamaño máximo de cada mensaje
+# Procesos del reproceso (pool de /reprocess y reprocesar.py, ECG_REPROC_WORKER=1):
+# sólo usan los .db que procesan, no la BD activa
+REPROC_WORKER = os.environ.get("ECG_REPROC_WORKER") == "1"
+# Rutas HTTP que un worker "attach" atiende él mismo (lectura); el resto se reenvía
+ATTACH_RUTAS = ("/ecg", "/bpm", "/shm", "/ecg/range", "/bpm/range", "/hrv/range", "/ecg/overview",
+                "/db/list", "/db/export", "/derived/beats")
+
+# Reproducción de grabaciones (.db o CSV de DATA_DIR) por el mismo camino que el serial
+REPLAY_MAX_BLOCK_SECS = 0.5  # Bloques a velocidad máxima (bastante menos que BEAT_RING_SECS)
+REPLAY_CSV_ROWS  = 8192   # Filas por lectura del CSV
+REPLAY_GAP_SECS  = 1.0    # Huecos mayores no se reproducen (se salta, como una reconexión)
+
+# ---------------------- Estado ----------------------
+
+db_lock   = threading.Lock()
+activar_escritura = False
+
+# Buffers propiedad del hilo escritor
+buffer_db_ecg = []  # [(t0, valores ndarray, filtrada ndarray | None, seq0), ...] bloques consecutivos
+buffer_db_bpm = []  # [(ts, bpm, t_epoch_ns), ...]
+buffer_db_beats = []      # [(session_id, r_seq, t_epoch_ns, rr_ms, fs, blob), ...]
+buffer_db_beat_cls = []   # [(clase, session_id, r_seq), ...] predicciones a anotar
+buffer_db_hrv = []        # [(window_s, t_epoch_ns, n, mean_rr_ms, sdnn_ms, rmssd_ms, pnn50, mean_hr, hist), ...]
+
+# Cola adquisición -> escritor: ("ecg", t0, valores, filtrada, seq0) | ("bpm", filas) | ("beats", filas)
+#                               | ("beat_classes", filas) | ("hrv", filas) | ("cmd", fn, evento, resultado)
+db_queue = queue.Queue(maxsize=DB_QUEUE_MAX)
+_db_stop = threading.Event()
+_db_stats = {
+    "commits": 0,
+    "rows_ecg": 0,           # muestras escritas
+    "rows_bpm": 0,
+    "rows_beats": 0,
+    "rows_hrv": 0,
+    "errors": 0,
+    "last_error": None,
+    "dropped_samples": 0,    # descartadas por cola llena o buffer excedido
+    "late_samples": 0,       # escritas más tarde de lo que imponen chunk + DB_COMMIT_MS + LATE_MS
+    "lag_ms": None,          # antigüedad de la muestra más vieja del último commit
+    "max_lag_ms": 0.0,
+    "last_flush_ms": None,
+    "max_flush_ms": 0.0,
+    "avg_flush_ms": None,    # media móvil exponencial
+}
+
+_last_bpm = None
+_last_bpm_ts = None
+
+_last_val_for_peak = 0
+_last_peak_time = 0.0
+
+# Picos R recientes: (seq de la muestra, epoch s)
+_picos_r = deque(maxlen=256)
+
+# Inferencia: cola hacia el hilo de inferencia
+#   ("beats", X (n, MODEL_INPUT), metas [dict], t_encolado, trabajo | None) | ("file", ruta, trabajo)
+infer_queue = queue.Queue(maxsize=INFER_QUEUE_MAX)
+_infer_stop = threading.Event()
+_infer_thread = None
+_modelo = {"net": None, "scaler": None, "torch": None, "state": "not_loaded", "error": None, "load_ms": None}
+predicciones = deque(maxlen=INFER_RESULTS)  # [{"id", "seq", "timestamp", "class", "label", "prob"}]
+_pred_id = 0
+_trabajos = {}  # {id: trabajo de /doPrediction}, sólo los últimos MAX_TRABAJOS
+_trabajo_id = 0
+MAX_TRABAJOS = 20
+_infer_stats = {
+    "batches": 0,
+    "beats": 0,
+    "dropped_beats": 0,      # cola llena o modelo no disponible
+    "last_batch_ms": None,   # tiempo de cómputo del último lote
+    "last_latency_ms": None, # encolado -> resultado, último lote
+    "avg_latency_ms": None,
+    "max_latency_ms": 0.0,
+    "last_error": None,
+}
+predictionStatus = {"ok": False, "message": "idle"}
+ws_pred_clients = {}  # {websocket: _ClienteWS} suscritos a /ws/predictions
+ws_hrv_clients = {}   # {websocket: _ClienteWS} suscritos a /ws/hrv
+
+# Segmentador de latidos: última R ya cortada y contadores
+_seg_ultimo_r = -1
+_seg_stats = {"beats": 0, "missed": 0}  # missed: la ventana ya no estaba en el buffer
+
+# WS: clientes y cola thread-safe
+# WS: clientes y cola asyncio (se crea en lifespan, en el loop del servidor).
+# El hilo lector entrega bloques con loop.call_soon_threadsafe; nunca espera.
+ws_clients = {}  # {websocket: _ClienteWS}
+ws_queue = None  # asyncio.Queue de bloques (seq primera muestra, [crudos], [filtrados] | None, t0)
+_ws_loop = None
+_ws_stats = {
+    "dropped_samples": 0,    # descartes en ws_queue (antes del reparto)
+    "client_dropped_samples": 0,  # descartes en colas de clientes (acumulado, también desconectados)
+    "late_samples": 0,       # repartidas más de LATE_MS después de muestreadas
+    "lag_ms": None,          # muestreo -> reparto, último lote
+}
+
+WS_QUEUE_MAX     = 4096   # Bloques en ws_queue
+WS_CLIENT_QUEUE  = 256    # Mensajes pendientes por cliente (se descarta el más antiguo)
+WS_SLOW_SECS     = 5.0    # Cliente con la cola llena durante más de esto: se desconecta
+
+# Protocolo WS binario (opt-in con /ws?format=binary), little-endian:
+#   seq u64 (primera muestra) | count u32 | fs f32 | dtype u8 | version u8 | 2 bytes relleno
+# seguido de count muestras int32 (dtype=1) o float32 (dtype=2).
+WS_BIN_HEADER  = struct.Struct("<QIfBB2x")
+WS_BIN_VERSION = 1
+WS_DTYPE_INT32, WS_DTYPE_FLOAT32 = 1, 2
+
+HDR = b'\xAA\x55'
+
+# Contadores del decodificador por bloques
+_serial_stats = {
+    "frames": 0,         # tramas decodificadas
+    "resyncs": 0,        # veces que se perdió la alineación con HDR
+    "garbage_bytes": 0,  # bytes descartados al resincronizar
+    "lost_samples": 0,   # tramas perdidas estimadas (hueco en seq)
+}
+
+# ---------------------- Métricas ----------------------
+
+# Cubetas de latencia en segundos (100 us .. 2.5 s)
+LAT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+               0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Histograma:
+    """
+    Histograma de cubetas fijas para /metrics. Cada instancia la alimenta
+    un solo hilo (lector, escritor, inferencia o un cliente WS): observar()
+    es un bisect y dos sumas, sin locks ni memoria nueva. /metrics lee una
+    copia; a lo sumo ve la observación en curso a medias.
+    """
+    __slots__ = ("limites", "cuentas", "suma")
+
+    def __init__(self, limites=LAT_BUCKETS):
+        self.limites = tuple(limites)
+        self.cuentas = [0] * (len(self.limites) + 1)  # la última es +Inf
+        self.suma = 0.0
+
+    def observar(self, v: float):
+        self.cuentas[bisect_left(self.limites, v)] += 1
+        self.suma += v
+
+    def exponer(self, nombre: str, etiquetas: str = "") -> list:
+        """
+        Líneas _bucket/_sum/_count en formato texto de Prometheus;
+        etiquetas ya formateadas ('client="3"') o "".
+        """
+        cuentas, suma = list(self.cuentas), self.suma
+        sep = etiquetas + "," if etiquetas else ""
+        lineas, acum = [], 0
+        for le, c in zip(self.limites, cuentas):
+            acum += c
+            lineas.append(f'{nombre}_bucket{{{sep}le="{le:g}"}} {acum}')
+        acum += cuentas[-1]
+        lineas.append(f'{nombre}_bucket{{{sep}le="+Inf"}} {acum}')
+        sufijo = f"{{{etiquetas}}}" if etiquetas else ""
+        lineas.append(f"{nombre}_sum{sufijo} {suma:.6f}")
+        lineas.append(f"{nombre}_count{sufijo} {acum}")
+        return lineas
+
+_hist_db_flush = Histograma()      # flush_buffers_if_needed (transacción completa)
+_hist_bpm = Histograma()           # detector de BPM por bloque
+_hist_bloque = Histograma()        # _process_block completo
+_hist_infer_lote = Histograma()    # cómputo del modelo por lote
+_hist_infer_lat = Histograma()     # encolado -> resultado, por latido
+
+# Carpeta y DB
+BASE_DIR = Path(__file__).resolve().parent
+DATA_DIR = BASE_DIR / "data"
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+
+
+
+
+# ---------------------- DB ----------------------
+
+# Esquema 1: ecg_data(id, timestamp TEXT, value, t_epoch_ns, value_filt, seq) -> una fila por muestra.
+# Esquema 2: ecg_chunks(session_id, t0_epoch_ns, fs, n, encoding, blob, stream, seq0) ->
+#            un BLOB int32 por chunk de CHUNK_SECS. Se marca con PRAGMA user_version = 2.
+#            stream = 'raw' (crudo) o 'filtered' (salida de FiltroECG, float32).
+#            seq0 = número de secuencia de la primera muestra; un chunk nunca cruza un hueco.
+# bpm_data(id, timestamp TEXT, bpm, t_epoch_ns) es igual en ambos.
+# Las columnas *_epoch_ns están indexadas para consultas por rango de tiempo.
+# ecg_pyramid guarda min/max/suma por bucket de PYRAMID_LEVELS para vistas alejadas.
+
+_SQL_ECG_V1 = '''
+    CREATE TABLE IF NOT EXISTS ecg_data (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        value INTEGER NOT NULL,
+        t_epoch_ns INTEGER,
+        value_filt REAL,
+        seq INTEGER
+    );
+'''
+_SQL_ECG_V2 = '''
+    CREATE TABLE IF NOT EXISTS ecg_chunks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        t0_epoch_ns INTEGER NOT NULL,
+        fs REAL NOT NULL,
+        n INTEGER NOT NULL,
+        encoding TEXT NOT NULL,
+        blob BLOB NOT NULL,
+        stream TEXT NOT NULL DEFAULT 'raw',
+        seq0 INTEGER
+    );
+'''
+_SQL_BPM = '''
+    CREATE TABLE IF NOT EXISTS bpm_data (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        bpm INTEGER NOT NULL,
+        t_epoch_ns INTEGER
+    );
+'''
+
+# Latidos segmentados: ventana de MODEL_INPUT muestras a MODEL_FS (float32),
+# clave (sesión, índice de muestra de la R); class se completa al clasificar
+_SQL_BEATS = '''
+    CREATE TABLE IF NOT EXISTS beats (
+        session_id TEXT NOT NULL,
+        r_seq INTEGER NOT NULL,
+        t_epoch_ns INTEGER NOT NULL,
+        rr_ms INTEGER,
+        fs REAL NOT NULL,
+        blob BLOB NOT NULL,
+        class INTEGER,
+        PRIMARY KEY (session_id, r_seq)
+    ) WITHOUT ROWID;
+'''
+
+# HRV de las ventanas largas (HRV_PERSIST_MIN) cada HRV_PERSIST_SECS; hist es el
+# histograma de RR en JSON {"start_ms", "bin_ms", "counts", "tri_index"}
+_SQL_HRV = '''
+    CREATE TABLE IF NOT EXISTS hrv (
+        window_s INTEGER NOT NULL,
+        t_epoch_ns INTEGER NOT NULL,
+        n INTEGER NOT NULL,
+        mean_rr_ms REAL,
+        sdnn_ms REAL,
+        rmssd_ms REAL,
+        pnn50 REAL,
+        mean_hr REAL,
+        hist TEXT,
+        PRIMARY KEY (window_s, t_epoch_ns)
+    ) WITHOUT ROWID;
+'''
+
+_SQL_PIRAMIDE = '''
+    CREATE TABLE IF NOT EXISTS ecg_pyramid (
+        level_s INTEGER NOT NULL,
+        bucket_ns INTEGER NOT NULL,
+        n INTEGER NOT NULL,
+        vmin REAL NOT NULL,
+        vmax REAL NOT NULL,
+        vsum REAL NOT NULL,
+        PRIMARY KEY (level_s, bucket_ns)
+    ) WITHOUT ROWID;
+'''
+
+# timestamp local "%Y-%m-%d %H:%M:%S.mmm" -> epoch ns (para BD antiguas sin t_epoch_ns)
+_SQL_TS_A_NS = "CAST(ROUND((julianday(timestamp, 'utc') - 2440587.5) * 86400000.0) AS INTEGER) * 1000000"
+
+def _asegurar_indices_tiempo(conn):
+    """
+    Añade t_epoch_ns (rellenada desde timestamp), las columnas de la señal
+    filtrada y de seq e índices de tiempo a BD creadas antes de existir. Idempotente.
+    """
+    tablas = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")}
+    for tabla, col_valor in (("ecg_data", "value"), ("bpm_data", "bpm")):
+        if tabla not in tablas:
+            continue
+        cols = {r[1] for r in conn.execute(f"PRAGMA table_info({tabla});")}
+        if "t_epoch_ns" not in cols:
+            conn.execute(f"ALTER TABLE {tabla} ADD COLUMN t_epoch_ns INTEGER;")
+        # Índice cubriente: el rango se resuelve sin tocar la tabla
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{tabla}_t ON {tabla} (t_epoch_ns, {col_valor}, timestamp);")
+        # Filas sin tiempo entero (BD antiguas): se rellenan desde el texto; usa el índice
+        conn.execute(f"UPDATE {tabla} SET t_epoch_ns = {_SQL_TS_A_NS} WHERE t_epoch_ns IS NULL;")
+        if tabla == "ecg_data" and "value_filt" not in cols:
+            conn.execute("ALTER TABLE ecg_data ADD COLUMN value_filt REAL;")
+        if tabla == "ecg_data" and "seq" not in cols:
+            conn.execute("ALTER TABLE ecg_data ADD COLUMN seq INTEGER;")
+    if "ecg_chunks" in tablas:
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(ecg_chunks);")}
+        if "stream" not in cols:
+            conn.execute("ALTER TABLE ecg_chunks ADD COLUMN stream TEXT NOT NULL DEFAULT 'raw';")
+        if "seq0" not in cols:
+            conn.execute("ALTER TABLE ecg_chunks ADD COLUMN seq0 INTEGER;")
+        conn.execute("DROP INDEX IF EXISTS idx_ecg_chunks_t0;")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ecg_chunks_st ON ecg_chunks (stream, t0_epoch_ns);")
+    conn.commit()
+
+def esquema_db(conn) -> int:
+    """
+    Devuelve 2 si la BD usa chunks BLOB, 1 si usa una fila por muestra.
+    """
+    (version,) = conn.execute("PRAGMA user_version;").fetchone()
+    return 2 if version >= 2 else 1
+
+def conectar_sqlite(nombre_bd="ecg_data.db"):
+    ruta_bd = DATA_DIR / nombre_bd
+    nueva = not ruta_bd.exists()
+    conn = sqlite3.connect(ruta_bd, check_same_thread=False)
+    cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL;")
+    cur.execute("PRAGMA synchronous=NORMAL;")
+    cur.execute("PRAGMA temp_store=MEMORY;")
+    cur.execute("PRAGMA cache_size=-2000;")  # ~2MB
+    cur.execute(f"PRAGMA journal_size_limit={int(DB_WAL_LIMIT_MB * 1024 * 1024)};")
+    # BD existentes conservan su esquema; las nuevas usan DB_SCHEMA
+    if nueva and DB_SCHEMA >= 2:
+        cur.execute("PRAGMA user_version = 2;")
+    if esquema_db(conn) >= 2:
+        cur.execute(_SQL_ECG_V2)
+    else:
+        cur.execute(_SQL_ECG_V1)
+    cur.execute(_SQL_BPM)
+    cur.execute(_SQL_PIRAMIDE)
+    cur.execute(_SQL_BEATS)
+    cur.execute(_SQL_HRV)
+    conn.commit()
+    _asegurar_indices_tiempo(conn)
+    return conn
+
+# Conexión del escritor. Los workers "attach" y los del reproceso no escriben:
+# no la abren (ni crean ecg_data.db al importar app)
+db_conn = conectar_sqlite() if ACQ_MODE != "attach" and not REPROC_WORKER else None
+db_schema = esquema_db(db_conn) if db_conn is not None else None
+# Ruta de la BD activa. Solo la cambia el hilo escritor (_cambiar_db); los
+# demás hilos la leen de aquí y nunca usan db_conn.
+_ruta_db_activa = DATA_DIR / "ecg_data.db"
+_db_abierta_desde = time.monotonic()  # para ROTATE_MODE = "hours"
+SESSION_ID = datetime.now().strftime("%Y%m%d-%H%M%S")  # sesión de adquisición actual
+
+# --- Empaquetado de muestras (esquema 2) ---
+
+def empaquetar_muestras(vals: np.ndarray, encoding: str = None):
+    """
+    Empaqueta un chunk como int32 little-endian, opcionalmente en delta
+    y comprimido con zlib. Valores no enteros (p.ej. la señal de prueba
+    normalizada) se guardan como float32.
+    Devuelve (encoding, bytes).
+    """
+    modo = encoding or CHUNK_ENCODING
+    vals = np.asarray(vals)
+    if vals.dtype.kind == "f" and not np.all(np.mod(vals, 1) == 0):
+        enc = "f32"
+        raw = vals.astype("<f4").tobytes()
+    else:
+        v = vals.astype("<i4")
+        if "delta" in modo:
+            enc = "i32+delta"
+            raw = np.diff(v, prepend=np.int32(0)).astype("<i4").tobytes()
+        else:
+            enc = "i32"
+            raw = v.tobytes()
+    if "zlib" in modo:
+        enc += "+zlib"
+        raw = zlib.compress(raw, 1)  # nivel 1: casi todo el beneficio, poco CPU
+    return enc, raw
+
+def desempaquetar_muestras(encoding: str, blob: bytes) -> np.ndarray:
+    """
+    Inversa de empaquetar_muestras.
+    """
+    if encoding.endswith("+zlib"):
+        blob = zlib.decompress(blob)
+    if encoding.startswith("f32"):
+        return np.frombuffer(blob, dtype="<f4")
+    v = np.frombuffer(blob, dtype="<i4")
+    if "+delta" in encoding:
+        v = np.cumsum(v, dtype=np.int64).astype(np.int32)
+    return v
+
+def _chunks_de_buffer(bloques, fs, force):
+    """
+    Agrupa bloques [(t0, valores[, filtrada[, seq0]]), ...] en chunks
+    [(t0, valores, filtrada | None, seq0 | None)] de CHUNK_SECS. Un hueco
+    > CHUNK_GAP_SECS o un salto de seq cierra el chunk en curso.
+    Devuelve (chunks, resto): si no es 'force', el último chunk incompleto
+    queda como resto para el siguiente volcado.
+    """
+    n_chunk = max(1, int(round(CHUNK_SECS * fs)))
+    corridas = []  # [(t0, [arrays], [arrays filtrados | None], seq0 | None)]
+    fin = None
+    seq_fin = None
+    for bloque in bloques:
+        t0, vals = bloque[0], bloque[1]
+        filt = bloque[2] if len(bloque) > 2 else None
+        seq0 = bloque[3] if len(bloque) > 3 else None
+        if fin is None or abs(t0 - fin) > CHUNK_GAP_SECS or (seq0 is not None and seq0 != seq_fin):
+            corridas.append((t0, [], [], seq0))
+            esperado = t0
+        else:
+            esperado = fin
+        corridas[-1][1].append(vals)
+        corridas[-1][2].append(filt)
+        fin = esperado + len(vals) / fs
+        seq_fin = None if seq0 is None else seq0 + len(vals)
+
+    chunks, resto = [], []
+    for k, (t0, partes, partes_f, seq0) in enumerate(corridas):
+        vals = np.concatenate(partes)
+        # La filtrada sólo se conserva si todos los bloques de la corrida la traen
+        filt = None if any(f is None for f in partes_f) else np.concatenate(partes_f)
+        for i in range(0, len(vals), n_chunk):
+            trozo = vals[i:i + n_chunk]
+            trozo_f = None if filt is None else filt[i:i + n_chunk]
+            t_i = t0 + i / fs
+            seq_i = None if seq0 is None else seq0 + i
+            if len(trozo) < n_chunk and not force and k == len(corridas) - 1:
+                resto.append((t_i, trozo, trozo_f, seq_i))
+            else:
+                chunks.append((t_i, trozo, trozo_f, seq_i))
+    return chunks, resto
+
+def _insertar_chunks(cursor, chunks, session_id, fs):
+    filas = []
+    for t0, vals, filt, seq0 in chunks:
+        t0_ns = int(round(t0 * 1e9))
+        enc, blob = empaquetar_muestras(vals)
+        filas.append((session_id, t0_ns, float(fs), len(vals), enc, blob, "raw", seq0))
+        if filt is not None:
+            enc, blob = empaquetar_muestras(filt)
+            filas.append((session_id, t0_ns, float(fs), len(filt), enc, blob, "filtered", seq0))
+    if filas:
+        cursor.executemany(
+            "INSERT INTO ecg_chunks (session_id, t0_epoch_ns, fs, n, encoding, blob, stream, seq0) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            filas
+        )
+
+def _actualizar_piramide(cursor, bloques, fs):
+    """
+    Acumula min/max/suma (señal cruda) de los bloques [(t0, valores, ...)]
+    recién escritos en cada nivel de PYRAMID_LEVELS (upsert sobre el bucket).
+    """
+    if not bloques:
+        return
+    t = np.concatenate([b[0] + np.arange(len(b[1])) / fs for b in bloques])
+    v = np.concatenate([np.asarray(b[1], dtype=np.float64) for b in bloques])
+    _actualizar_piramide_tv(cursor, t, v)
+
+def _actualizar_piramide_tv(cursor, t, v):
+    """
+    Igual que _actualizar_piramide con tiempos (epoch, s) y valores explícitos.
+    """
+    orden = np.argsort(t, kind="stable")
+    t, v = t[orden], v[orden]
+    for nivel in PYRAMID_LEVELS:
+        bucket = np.floor(t / nivel).astype(np.int64)
+        ini = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+        n = np.diff(np.r_[ini, len(v)])
+        filas = zip(
+            [nivel] * len(ini),
+            (bucket[ini] * nivel * 1_000_000_000).tolist(),
+            n.tolist(),
+            np.minimum.reduceat(v, ini).tolist(),
+            np.maximum.reduceat(v, ini).tolist(),
+            np.add.reduceat(v, ini).tolist(),
+        )
+        cursor.executemany(
+            "INSERT INTO ecg_pyramid (level_s, bucket_ns, n, vmin, vmax, vsum) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(level_s, bucket_ns) DO UPDATE SET "
+            "n = n + excluded.n, vmin = MIN(vmin, excluded.vmin), "
+            "vmax = MAX(vmax, excluded.vmax), vsum = vsum + excluded.vsum;",
+            filas
+        )
+
+def _insertar_ecg(cursor, bloques, schema, force):
+    """
+    Inserta los bloques pendientes según el esquema de la BD y actualiza
+    la pirámide con lo escrito.
+    Devuelve los bloques que quedan pendientes (chunk incompleto).
+    """
+    if schema >= 2:
+        chunks, resto = _chunks_de_buffer(bloques, FS, force)
+        _insertar_chunks(cursor, chunks, SESSION_ID, FS)
+        _actualizar_piramide(cursor, chunks, FS)
+        return resto
+
+    for t0, vals, filt, seq0 in bloques:
+        t_ns = (int(round(t0 * 1e9)) + np.arange(len(vals), dtype=np.int64) * int(round(1e9 / FS))).tolist()
+        v_filt = [None] * len(vals) if filt is None else filt.tolist()
+        cursor.executemany(
+            "INSERT INTO ecg_data (timestamp, value, t_epoch_ns, value_filt, seq) VALUES (?, ?, ?, ?, ?)",
+            zip(_timestamps_bloque(t0, len(vals)), vals.tolist(), t_ns, v_filt, range(seq0, seq0 + len(vals)))
+        )
+    _actualizar_piramide(cursor, bloques, FS)
+    return []
+
+def _registrar_lag_db(bloques, escritas: int):
+    """
+    Antigüedad de las muestras recién escritas (los primeros 'escritas' de
+    los bloques, en orden cronológico) y cuántas llegaron tarde a la BD.
+    """
+    if escritas <= 0 or not bloques:
+        return
+    ahora = time.time()
+    limite = (CHUNK_SECS if db_schema >= 2 else 0.0) + (DB_COMMIT_MS + LATE_MS) / 1000.0
+    lag_ms = (ahora - bloques[0][0]) * 1000.0
+    _db_stats["lag_ms"] = round(lag_ms, 1)
+    _db_stats["max_lag_ms"] = round(max(_db_stats["max_lag_ms"], lag_ms), 1)
+    for bloque in bloques:
+        if escritas <= 0 or ahora - bloque[0] <= limite:
+            break
+        n = min(len(bloque[1]), escritas)
+        escritas -= n
+        _db_stats["late_samples"] += n
+
+def flush_buffers_if_needed(cursor, force=False, vencido=False):
+    """
+    Inserta ECG y BPM en UNA MISMA transacción cuando cualquiera
+    de los dos buffers alcanza el tamaño de lote, cuando 'vencido'
+    (pasaron DB_COMMIT_MS desde el último commit) o si 'force' es True.
+    Con esquema 2 sólo 'force' escribe el chunk incompleto.
+    Importante: si ocurre un error, NO se limpian los buffers;
+    se reintenta en el siguiente ciclo.
+    """
+    global buffer_db_ecg, buffer_db_bpm
+
+    n_ecg = sum(len(b[1]) for b in buffer_db_ecg)
+    lote_ecg = CHUNK_SECS * FS if db_schema >= 2 else BUFFER_DB
+    ecg_ready = n_ecg >= lote_ecg
+    bpm_ready = len(buffer_db_bpm) >= BUFFER_DB or len(buffer_db_beats) >= BUFFER_DB
+    # En esquema 2 un chunk incompleto todavía no es una fila pendiente
+    pendiente = (bool(buffer_db_bpm) or bool(buffer_db_beats) or bool(buffer_db_beat_cls)
+                 or bool(buffer_db_hrv) or (bool(buffer_db_ecg) and db_schema < 2))
+
+    if not (force or ecg_ready or bpm_ready or (vencido and pendiente)):
+        return False
+
+    try:
+        t_ini = time.perf_counter()
+        with db_lock:
+            cursor.execute("BEGIN IMMEDIATE;")
+            resto = []
+            if buffer_db_ecg:
+                resto = _insertar_ecg(cursor, buffer_db_ecg, db_schema, force)
+            if buffer_db_bpm:
+                cursor.executemany(
+                    "INSERT INTO bpm_data (timestamp, bpm, t_epoch_ns) VALUES (?, ?, ?)",
+                    buffer_db_bpm
+                )
+            if buffer_db_beats:
+                cursor.executemany(
+                    "INSERT OR REPLACE INTO beats (session_id, r_seq, t_epoch_ns, rr_ms, fs, blob) VALUES (?, ?, ?, ?, ?, ?)",
+                    buffer_db_beats
+                )
+            if buffer_db_beat_cls:
+                cursor.executemany(
+                    "UPDATE beats SET class = ? WHERE session_id = ? AND r_seq = ?",
+                    buffer_db_beat_cls
+                )
+            if buffer_db_hrv:
+                cursor.executemany(
+                    "INSERT OR REPLACE INTO hrv (window_s, t_epoch_ns, n, mean_rr_ms, sdnn_ms, rmssd_ms, pnn50, mean_hr, hist) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    buffer_db_hrv
+                )
+            db_conn.commit()
+            # Sólo si COMMIT fue exitoso, limpiamos los buffers
+            escritas = n_ecg - sum(len(b[1]) for b in resto)
+            _db_stats["rows_ecg"] += escritas
+            _registrar_lag_db(buffer_db_ecg, escritas)
+            _db_stats["rows_bpm"] += len(buffer_db_bpm)
+            _db_stats["rows_beats"] += len(buffer_db_beats)
+            _db_stats["rows_hrv"] += len(buffer_db_hrv)
+            buffer_db_ecg[:] = resto
+            buffer_db_bpm.clear()
+            buffer_db_beats.clear()
+            buffer_db_beat_cls.clear()
+            buffer_db_hrv.clear()
+        ms = (time.perf_counter() - t_ini) * 1000.0
+        _hist_db_flush.observar(ms / 1000.0)
+        _db_stats["commits"] += 1
+        _db_stats["last_flush_ms"] = round(ms, 3)
+        _db_stats["max_flush_ms"] = round(max(_db_stats["max_flush_ms"], ms), 3)
+        avg = _db_stats["avg_flush_ms"]
+        _db_stats["avg_flush_ms"] = round(ms if avg is None else 0.9 * avg + 0.1 * ms, 3)
+        return True
+    except Exception as e:
+        # Rollback y mantenemos los buffers tal cual para reintentar luego
+        try:
+            db_conn.rollback()
+        except:
+            pass
+        _db_stats["errors"] += 1
+        _db_stats["last_error"] = str(e)
+        print(f"Error al volcar lotes a DB: {e}. Se reintentará en el siguiente ciclo.")
+        return False
+
+def _epoch_de_timestamps(ts_list) -> np.ndarray:
+    """
+    Convierte timestamps "%Y-%m-%d %H:%M:%S.mmm" (hora local) a epoch en s.
+    Se parsean con NumPy y el huso se calcula una vez por hora distinta:
+    una grabación que cruza un cambio de horario queda bien después del
+    cambio (los cambios de horario caen en horas en punto).
+    """
+    naive = np.array([t.replace(" ", "T") for t in ts_list], dtype="datetime64[ms]")
+    naive_s = naive.astype(np.int64) / 1e3
+    horas, inversa = np.unique(np.floor_divide(naive_s, 3600).astype(np.int64), return_inverse=True)
+    base = datetime(1970, 1, 1)
+    offsets = np.array([(base + timedelta(hours=int(h))).timestamp() - int(h) * 3600 for h in horas.tolist()])
+    return naive_s + offsets[inversa]
+
+def migrar_db_v2(db_path: Path, fs: float = None, lote: int = 100000) -> dict:
+    """
+    Convierte ecg_data (fila por muestra) en ecg_chunks dentro del mismo
+    archivo, en una sola transacción, y compacta con VACUUM.
+    Las filas se leen por lotes; fs por defecto es FS.
+    """
+    fs = fs or FS
+    conn = sqlite3.connect(str(db_path))
+    try:
+        if esquema_db(conn) >= 2:
+            _asegurar_indices_tiempo(conn)  # columnas e índices de tiempo, si faltan
+            return {"migrated_rows": 0, "chunks": 0, "schema": 2}
+        size_before = db_path.stat().st_size
+        sesion = f"migrado-{db_path.stem}"
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE;")
+        cur.execute(_SQL_ECG_V2)
+        cur.execute(_SQL_PIRAMIDE)
+        cur.execute("DELETE FROM ecg_pyramid;")
+        lectura = conn.cursor()
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(ecg_data);")}
+        col_filt = "value_filt" if "value_filt" in cols else "NULL"
+        lectura.execute(f"SELECT timestamp, value, {col_filt} FROM ecg_data ORDER BY id;")
+        pendientes = []  # bloques [(t0, valores, filtrada)] aún sin chunk completo
+        total_filas, total_chunks = 0, 0
+        while True:
+            rows = lectura.fetchmany(lote)
+            if not rows:
+                break
+            total_filas += len(rows)
+            ts_list, vals, filts = zip(*rows)
+            t = _epoch_de_timestamps(ts_list)
+            v = np.asarray(vals, dtype=np.int32)
+            f = np.asarray(filts, dtype=np.float64)  # None -> nan
+            # Cada salto > CHUNK_GAP_SECS inicia un bloque nuevo
+            cortes = np.flatnonzero(np.diff(t) > CHUNK_GAP_SECS) + 1
+            for ini, fin in zip(np.r_[0, cortes], np.r_[cortes, len(v)]):
+                f_blq = None if np.isnan(f[ini:fin]).any() else f[ini:fin]
+                pendientes.append((float(t[ini]), v[ini:fin], f_blq))
+            chunks, pendientes = _chunks_de_buffer(pendientes, fs, force=False)
+            _insertar_chunks(cur, chunks, sesion, fs)
+            _actualizar_piramide(cur, chunks, fs)
+            total_chunks += len(chunks)
+        chunks, _ = _chunks_de_buffer(pendientes, fs, force=True)
+        _insertar_chunks(cur, chunks, sesion, fs)
+        _actualizar_piramide(cur, chunks, fs)
+        total_chunks += len(chunks)
+        cur.execute("DROP TABLE ecg_data;")
+        cur.execute("PRAGMA user_version = 2;")
+        conn.commit()
+        _asegurar_indices_tiempo(conn)
+        conn.execute("VACUUM;")
+        return {
+            "migrated_rows": total_filas,
+            "chunks": total_chunks,
+            "schema": 2,
+            "size_before": size_before,
+            "size_after": db_path.stat().st_size,
+        }
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def construir_piramide(db_path: Path, lote: int = 100000) -> dict:
+    """
+    (Re)construye ecg_pyramid a partir de las muestras guardadas, leyendo
+    por lotes. Útil para BD creadas antes de existir la pirámide.
+    """
+    conn = sqlite3.connect(str(db_path))
+    try:
+        _asegurar_indices_tiempo(conn)
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE;")
+        cur.execute(_SQL_PIRAMIDE)
+        cur.execute("DELETE FROM ecg_pyramid;")
+        lectura = conn.cursor()
+        total = 0
+        if esquema_db(conn) >= 2:
+            lectura.execute("SELECT t0_epoch_ns, fs, encoding, blob FROM ecg_chunks WHERE stream = 'raw' ORDER BY t0_epoch_ns;")
+            while True:
+                rows = lectura.fetchmany(max(1, lote // 250))
+                if not rows:
+                    break
+                for t0_ns, fs, enc, blob in rows:
+                    vals = desempaquetar_muestras(enc, blob)
+                    _actualizar_piramide(cur, [(t0_ns / 1e9, vals)], fs)
+                    total += len(vals)
+        else:
+            lectura.execute("SELECT t_epoch_ns, value FROM ecg_data ORDER BY t_epoch_ns;")
+            while True:
+                rows = lectura.fetchmany(lote)
+                if not rows:
+                    break
+                t_ns, vals = zip(*rows)
+                _actualizar_piramide_tv(cur, np.asarray(t_ns, dtype=np.int64) / 1e9, np.asarray(vals, dtype=np.float64))
+                total += len(rows)
+        conn.commit()
+        return {"samples": total, "levels": list(PYRAMID_LEVELS)}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+# === Cambio dinámico de BD ===
+CURRENT_DB_NAME = "ecg_data.db"  # nombre actual (se ajusta al iniciar si ya abriste otra)
+
+def _sanitize_basename(name: str) -> str:
+    import re
+    base = (name or "").strip()
+    if base.lower().endswith(".db"):
+        base = base[:-3]
+    base = re.sub(r"[^A-Za-z0-9_\-]+", "_", base).strip("_-") or "ecg_data"
+    return base
+
+def _unique_db_filename(base: str) -> str:
+    base = _sanitize_basename(base)
+    fname = f"{base}.db"
+    p = DATA_DIR / fname
+    i = 1
+    while p.exists():
+        fname = f"{base}_{i}.db"
+        p = DATA_DIR / fname
+        i += 1
+    return fname
+
+def _cambiar_db(new_db_name: str) -> Path:
+    """
+    Abre new_db_name, vuelca los buffers en la BD actual y recién entonces
+    cambia la conexión y cierra la anterior. Si la nueva no se puede abrir
+    se sigue en la actual; si el volcado falla, lo pendiente queda en los
+    buffers y se escribe en la nueva. Debe ejecutarse en el hilo escritor
+    (ver _db_comando). Devuelve la ruta del archivo cerrado.
+    """
+    global db_conn, db_schema, CURRENT_DB_NAME, SESSION_ID, _db_abierta_desde, _ruta_db_activa
+
+    nueva = conectar_sqlite(new_db_name)
+    vieja = db_conn
+    ruta_vieja = _ruta_db_activa
+
+    # Volcar buffers antes de cambiar (el chunk incompleto también)
+    try:
+        flush_buffers_if_needed(vieja.cursor(), force=True)
+    except Exception:
+        pass
+
+    db_conn = nueva
+    db_schema = esquema_db(nueva)
+    CURRENT_DB_NAME = new_db_name
+    _ruta_db_activa = DATA_DIR / new_db_name
+    SESSION_ID = datetime.now().strftime("%Y%m%d-%H%M%S")
+    _db_abierta_desde = time.monotonic()
+    if _anillo_shm is not None:
+        _anillo_shm.publicar_db(new_db_name)
+
+    # Cerrar BD anterior (el último cierre hace checkpoint del WAL)
+    try:
+        vieja.close()
+    except Exception:
+        pass
+    return ruta_vieja
+
+def _current_db_path_from_conn() -> Path:
+    # Un worker "attach" no escribe: la BD activa es la del proceso de adquisición
+    if ACQ_MODE == "attach" and _anillo_shm is not None:
+        nombre = _anillo_shm.leer_db()
+        if nombre:
+            return DATA_DIR / nombre
+    # Sin tocar db_conn: la usa solo el hilo escritor y esto se llama desde
+    # el hilo de mantenimiento y los endpoints
+    return _ruta_db_activa
+
+# ---------------------- Escritor SQLite ----------------------
+
+def _recortar_buffer_ecg():
+    """
+    Si la BD lleva mucho tiempo fallando, descarta los bloques más
+    antiguos para no crecer sin límite en memoria.
+    """
+    limite = DB_BUFFER_MAX_SECS * FS
+    total = sum(len(b[1]) for b in buffer_db_ecg)
+    while buffer_db_ecg and total > limite:
+        v = buffer_db_ecg.pop(0)[1]
+        total -= len(v)
+        _db_stats["dropped_samples"] += len(v)
+
+def _db_encolar(item):
+    """
+    Encola hacia el escritor sin bloquear nunca la adquisición.
+    Si la cola está llena, el bloque se descarta y se contabiliza.
+    """
+    try:
+        db_queue.put_nowait(item)
+    except queue.Full:
+        if item[0] == "ecg":
+            _db_stats["dropped_samples"] += len(item[2])
+
+def _db_comando(fn, timeout=10.0):
+    """
+    Ejecuta fn() en el hilo escritor (dueño de db_conn) y espera su resultado.
+    Si el escritor no está corriendo, fn() se ejecuta directamente.
+    """
+    hilo = _db_writer_thread
+    if hilo is None or not hilo.is_alive():
+        return fn()
+    hecho = threading.Event()
+    resultado = {}
+    db_queue.put(("cmd", fn, hecho, resultado), timeout=timeout)
+    if not hecho.wait(timeout):
+        raise TimeoutError("El escritor de BD no respondió")
+    if "error" in resultado:
+        raise resultado["error"]
+    return resultado.get("valor")
+
+def _db_writer():
+    """
+    Hilo dueño de la conexión SQLite. Vacía db_queue en los buffers y hace
+    commit por tamaño (BUFFER_DB / chunk completo) o por tiempo (DB_COMMIT_MS).
+    Ante errores reintenta con espera exponencial sin dejar de vaciar la cola.
+    """
+    ultimo_commit = time.monotonic()
+    espera = 0.0
+    proximo_intento = 0.0
+    proxima_rotacion_check = 0.0
+    if ROTATE_MODE in ("hours", "size") and not CURRENT_DB_NAME.startswith(f"{ROTATE_PREFIX}_"):
+        _rotar_db("start")
+
+    while not (_db_stop.is_set() and db_queue.empty()):
+        try:
+            item = db_queue.get(timeout=0.05)
+        except queue.Empty:
+            item = None
+
+        while item is not None:
+            tipo = item[0]
+            if tipo == "ecg":
+                buffer_db_ecg.append((item[1], item[2], item[3], item[4]))
+            elif tipo == "bpm":
+                buffer_db_bpm.extend(item[1])
+            elif tipo == "beats":
+                buffer_db_beats.extend(item[1])
+            elif tipo == "beat_classes":
+                buffer_db_beat_cls.extend(item[1])
+            elif tipo == "hrv":
+                buffer_db_hrv.extend(item[1])
+            elif tipo == "cmd":
+                _, fn, hecho, resultado = item
+                try:
+                    resultado["valor"] = fn()
+                except Exception as e:
+                    resultado["error"] = e
+                hecho.set()
+            try:
+                item = db_queue.get_nowait()
+            except queue.Empty:
+                item = None
+
+        ahora = time.monotonic()
+        if ahora < proximo_intento:
+            continue
+        vencido = (ahora - ultimo_commit) * 1000.0 >= DB_COMMIT_MS
+        errores = _db_stats["errors"]
+        if flush_buffers_if_needed(db_conn.cursor(), vencido=vencido):
+            ultimo_commit = ahora
+            espera = 0.0
+        elif _db_stats["errors"] != errores:
+            espera = min(DB_RETRY_MAX_SECS, max(0.1, espera * 2))
+            proximo_intento = ahora + espera
+            _recortar_buffer_ecg()
+        elif vencido:
+            ultimo_commit = ahora
+
+        if ROTATE_MODE in ("hours", "size") and ahora >= proxima_rotacion_check:
+            proxima_rotacion_check = ahora + 5.0
+            motivo = _motivo_rotacion(ahora)
+            if motivo:
+                _rotar_db(motivo)
+
+    flush_buffers_if_needed(db_conn.cursor(), force=True)
+    print("Escritor de BD finalizado.")
+
+_db_writer_thread = None
+
+# ---------------------- Rotación y mantenimiento ----------------------
+
+_mant_queue = queue.Queue()   # archivos cerrados pendientes de compactar
+_mant_stop = threading.Event()
+_mant_thread = None
+_mant_stats = {
+    "rotations": 0,
+    "last_rotation": None,    # {"closed", "opened", "reason", "at"}
+    "compacted": 0,
+    "last_compaction": None,  # {"name", "size_before", "size_after", "ms"}
+    "deleted": 0,
+    "deleted_bytes": 0,
+    "errors": 0,
+    "last_error": None,
+}
+
+def _tamano_db(p: Path) -> int:
+    """
+    Bytes del archivo más su WAL y shm.
+    """
+    total = 0
+    for f in (p, Path(f"{p}-wal"), Path(f"{p}-shm")):
+        try:
+            total += f.stat().st_size
+        except OSError:
+            pass
+    return total
+
+def _motivo_rotacion(ahora: float):
+    if ROTATE_MODE == "hours" and ahora - _db_abierta_desde >= ROTATE_HOURS * 3600:
+        return "hours"
+    if ROTATE_MODE == "size" and _tamano_db(_current_db_path_from_conn()) >= ROTATE_MAX_MB * 1024 * 1024:
+        return "size"
+    return None
+
+def _rotar_db(motivo: str) -> str:
+    """
+    Cambia a un archivo nuevo <ROTATE_PREFIX>_<fecha>.db sin perder lo que
+    hay en los buffers y deja el anterior para compactar. Corre en el hilo
+    escritor. Devuelve el nombre del archivo nuevo.
+    """
+    nuevo = _unique_db_filename(f"{ROTATE_PREFIX}_{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+    cerrado = _cambiar_db(nuevo)
+    _mant_stats["rotations"] += 1
+    _mant_stats["last_rotation"] = {
+        "closed": cerrado.name, "opened": nuevo, "reason": motivo,
+        "at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    _mant_queue.put(cerrado)
+    print(f"BD rotada ({motivo}): {cerrado.name} -> {nuevo}")
+    return nuevo
+
+def compactar_db(p: Path) -> dict:
+    """
+    Checkpoint del WAL, ANALYZE y VACUUM de un archivo que ya no se escribe.
+    Con lectores abiertos (exportaciones) espera hasta 30 s al lock.
+    """
+    t_ini = time.perf_counter()
+    antes = _tamano_db(p)
+    conn = sqlite3.connect(str(p), timeout=30.0)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        conn.execute("ANALYZE;")
+        conn.execute("VACUUM;")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    finally:
+        conn.close()
+    return {"name": p.name, "size_before": antes, "size_after": _tamano_db(p),
+            "ms": round((time.perf_counter() - t_ini) * 1000.0, 1)}
+
+def _borrar_db(p: Path):
+    liberados = _tamano_db(p)
+    for f in (Path(f"{p}-wal"), Path(f"{p}-shm"), p):
+        f.unlink(missing_ok=True)
+    _mant_stats["deleted"] += 1
+    _mant_stats["deleted_bytes"] += liberados
+    print(f"Retención: borrado {p.name} ({liberados} bytes)")
+
+def aplicar_retencion() -> list:
+    """
+    Borra grabaciones rotadas (<ROTATE_PREFIX>_<fecha>.db, nunca la activa) más
+    antiguas que RETENTION_DAYS y, de las restantes, las más viejas hasta
+    entrar en RETENTION_MAX_GB. Los archivos con otro nombre no se tocan.
+    """
+    activa = _current_db_path_from_conn().resolve()
+    candidatos = []
+    for p in DATA_DIR.glob(f"{ROTATE_PREFIX}_[0-9]*.db"):
+        if p.resolve() == activa:
+            continue
+        try:
+            candidatos.append((p.stat().st_mtime, p))
+        except OSError:
+            pass
+    candidatos.sort()
+    borrados = []
+    if RETENTION_DAYS is not None:
+        limite = time.time() - RETENTION_DAYS * 86400
+        while candidatos and candidatos[0][0] < limite:
+            borrados.append(candidatos.pop(0)[1])
+    if RETENTION_MAX_GB is not None:
+        presupuesto = RETENTION_MAX_GB * 1024 ** 3 - _tamano_db(_current_db_path_from_conn())
+        total = sum(_tamano_db(p) for _, p in candidatos)
+        while candidatos and total > presupuesto:
+            p = candidatos.pop(0)[1]
+            total -= _tamano_db(p)
+            borrados.append(p)
+    for p in borrados:
+        _borrar_db(p)
+    return [p.name for p in borrados]
+
+def _mantenimiento():
+    """
+    Hilo de mantenimiento: al iniciar prepara los .db antiguos
+    (preparar_bd_antiguas); después compacta los archivos que deja la rotación y,
+    cada MAINT_INTERVAL_SECS, aplica la retención y hace un checkpoint
+    PASSIVE del WAL de la BD activa (no espera al escritor ni a lectores).
+    """
+    proximo = 0.0
+    reintentos = {}  # {ruta: (compactaciones fallidas, monotonic del próximo intento)}
+
+    def anotar_error(e):
+        _mant_stats["errors"] += 1
+        _mant_stats["last_error"] = str(e)
+        print(f"Error de mantenimiento de BD: {e}")
+
+    try:
+        preparadas = preparar_bd_antiguas()
+        if preparadas:
+            print(f"BD antiguas preparadas (índices de tiempo): {', '.join(preparadas)}")
+    except Exception as e:
+        anotar_error(e)
+    while not _mant_stop.is_set():
+        try:
+            p = _mant_queue.get(timeout=1.0)
+        except queue.Empty:
+            ahora = time.monotonic()
+            p = next((r for r, (_, cuando) in reintentos.items() if cuando <= ahora), None)
+        if p is not None:
+            try:
+                if p.exists():
+                    _mant_stats["last_compaction"] = compactar_db(p)
+                    _mant_stats["compacted"] += 1
+                reintentos.pop(p, None)
+            except Exception as e:
+                anotar_error(e)
+                # Archivo ocupado: se reintenta más tarde, como mucho 3 veces
+                fallos = reintentos.get(p, (0, 0.0))[0] + 1
+                if fallos <= 3:
+                    reintentos[p] = (fallos, time.monotonic() + MAINT_INTERVAL_SECS)
+                else:
+                    reintentos.pop(p, None)
+        if time.monotonic() >= proximo:
+            proximo = time.monotonic() + MAINT_INTERVAL_SECS
+            try:
+                aplicar_retencion()
+                conn = sqlite3.connect(str(_current_db_path_from_conn()), timeout=1.0)
+                try:
+                    conn.execute("PRAGMA wal_checkpoint(PASSIVE);")
+                    conn.execute("PRAGMA optimize;")
+                finally:
+                    conn.close()
+            except Exception as e:
+                anotar_error(e)
+    print("Hilo de mantenimiento finalizado.")
+
+def estado_mantenimiento() -> dict:
+    return {
+        "rotate_mode": ROTATE_MODE,
+        "rotate_hours": ROTATE_HOURS,
+        "rotate_max_mb": ROTATE_MAX_MB,
+        "retention_days": RETENTION_DAYS,
+        "retention_max_gb": RETENTION_MAX_GB,
+        "open_for_s": round(time.monotonic() - _db_abierta_desde, 1),
+        "pending_compaction": _mant_queue.qsize(),
+        **_mant_stats,
+    }
+
+# ---------------------- Filtro en streaming ----------------------
+
+class FiltroECG:
+    """
+    Etapa de filtrado por bloques con estado entre bloques: mediana causal
+    opcional para la línea base, pasa-banda Butterworth y notch de red,
+    todo como una cascada de secciones de segundo orden (sosfilt con zi).
+    La muestra i de la salida corresponde a la muestra i de la entrada.
+    """
+
+    def __init__(self, fs: float, banda=FILTER_BAND, notch_hz=FILTER_NOTCH_HZ,
+                 notch_q=FILTER_NOTCH_Q, mediana_ms=FILTER_MEDIAN_MS):
+        self.fs = fs
+        bajo, alto = banda if banda else (None, None)
+        if alto is not None and alto >= 0.5 * fs:
+            alto = None  # por encima de Nyquist no hay nada que cortar
+        secciones = []
+        if bajo and alto:
+            secciones.append(sp_signal.butter(2, [bajo, alto], btype="bandpass", fs=fs, output="sos"))
+        elif bajo:
+            secciones.append(sp_signal.butter(2, bajo, btype="highpass", fs=fs, output="sos"))
+        elif alto:
+            secciones.append(sp_signal.butter(4, alto, btype="lowpass", fs=fs, output="sos"))
+        if notch_hz and notch_hz < 0.5 * fs:
+            b, a = sp_signal.iirnotch(notch_hz, notch_q, fs=fs)
+            secciones.append(sp_signal.tf2sos(b, a))
+        else:
+            notch_hz = None
+        self.sos = np.vstack(secciones) if secciones else None
+        self.banda = (bajo, alto)
+        self.notch_hz = notch_hz
+        # Ventanas de mediana impares, en muestras
+        self.ventanas = [int(round(ms * fs / 1000.0)) | 1 for ms in (mediana_ms or ())]
+        self.reset()
+
+    def reset(self):
+        """
+        Olvida el estado (p.ej. tras un hueco en la secuencia).
+        """
+        self.zi = None
+        self.n = None
+        self.hist_med = [None] * len(self.ventanas)
+
+    def _linea_base(self, x: np.ndarray) -> np.ndarray:
+        """
+        Medianas causales en cascada: cada etapa usa las últimas w muestras
+        de la anterior, arrastrando w-1 muestras de historia entre bloques.
+        """
+        base = x
+        for k, w in enumerate(self.ventanas):
+            hist = self.hist_med[k]
+            if hist is None:
+                hist = np.full(w - 1, base[0])
+            ext = np.concatenate((hist, base))
+            self.hist_med[k] = ext[len(ext) - (w - 1):]
+            base = np.median(np.lib.stride_tricks.sliding_window_view(ext, w), axis=1)
+        return base
+
+    def procesar(self, x: np.ndarray, seq0: int) -> np.ndarray:
+        """
+        Filtra un bloque cuya primera muestra tiene índice absoluto seq0.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if self.n is not None and seq0 != self.n:
+            self.reset()
+        self.n = seq0 + len(x)
+        y = x - self._linea_base(x) if self.ventanas else x
+        if self.sos is not None:
+            if self.zi is None:
+                # Arranque en régimen: sin transitorio por el offset DC inicial
+                self.zi = sp_signal.sosfilt_zi(self.sos) * y[0]
+            y, self.zi = sp_signal.sosfilt(self.sos, y, zi=self.zi)
+        return y
+
+    def estado(self) -> dict:
+        return {
+            "fs": self.fs,
+            "band_hz": list(self.banda),
+            "notch_hz": self.notch_hz,
+            "median_windows": self.ventanas,
+            "sos_sections": 0 if self.sos is None else len(self.sos),
+        }
+
+_filtro = FiltroECG(FS) if FILTER_ENABLED else None
+
+# ---------------------- BPM sencillo ----------------------
+
+def detectar_bpm_sencillo(valores: np.ndarray, t0: float, seq0: int = None):
+    """
+    Pico = cruce ascendente del umbral + refractario.
+    BPM = 60 / RR del último intervalo válido.
+    Procesa un bloque: los cruces se buscan con NumPy y el instante de
+    cada uno es t0 + i/FS (t0 = instante de la primera muestra); el
+    timestamp en texto se formatea sólo para los BPM emitidos.
+    Con seq0, los picos aceptados se registran en _picos_r.
+    Devuelve [(ts, bpm, t_epoch_ns), ...] con los BPM nuevos del bloque.
+    """
+    global _last_val_for_peak, _last_peak_time, _last_bpm, _last_bpm_ts
+
+    prev = np.empty_like(valores)
+    prev[0] = _last_val_for_peak
+    prev[1:] = valores[:-1]
+    cruces = np.flatnonzero((valores > UMBRAL) & (prev <= UMBRAL))
+    _last_val_for_peak = valores[-1]
+
+    bpm_out = []
+    for i in cruces.tolist():
+        t_now = t0 + i / FS
+        if _last_peak_time == 0.0:
+            _last_peak_time = t_now
+        else:
+            rr = t_now - _last_peak_time
+            if rr >= REFRACT_SEC and RR_MIN <= rr <= RR_MAX:
+                bpm = round(60.0 / rr)
+                ts = _timestamps_bloque(t_now, 1)[0]
+                _last_bpm = bpm
+                _last_bpm_ts = ts
+                bpm_out.append((ts, bpm, int(round(t_now * 1e9))))
+                _last_peak_time = t_now
+                if seq0 is not None:
+                    _picos_r.append((seq0 + i, t_now))
+                    _hrv_latido(seq0 + i, int(round(rr * FS)), t_now)
+            elif rr >= REFRACT_SEC:
+                _last_peak_time = t_now
+
+    return bpm_out
+
+# ---------------------- Detector Pan-Tompkins ----------------------
+
+class DetectorPanTompkins:
+    """
+    Detector QRS Pan-Tompkins que procesa bloques con NumPy y conserva su
+    estado entre bloques: pasa-banda 5-15 Hz (SOS), derivada de 5 puntos,
+    cuadrado, integración en ventana móvil de 150 ms y umbrales adaptativos
+    (SPKI/NPKI) con búsqueda hacia atrás. Todos los tiempos salen de los
+    índices de muestra y de fs, no del reloj del host.
+    """
+
+    APRENDIZAJE_S = 2.0   # Segundos iniciales para estimar los umbrales
+    REFRACT_S     = 0.200 # Dos QRS no pueden estar más cerca que esto
+
+    def __init__(self, fs: float):
+        self.fs = fs
+        alto = min(15.0, 0.45 * fs)
+        self.sos = sp_signal.butter(2, [5.0, alto], btype="bandpass", fs=fs, output="sos")
+        b, a = sp_signal.sos2tf(self.sos)
+        _, gd = sp_signal.group_delay((b, a), w=[10.0], fs=fs)
+        self.retardo = int(round(gd[0]))              # retardo del pasa-banda (muestras)
+        self.mwi_len = max(1, int(round(0.150 * fs)))
+        self.refract = int(round(self.REFRACT_S * fs))
+        self.reset()
+
+    def reset(self):
+        """
+        Reinicia filtros y umbrales (p.ej. tras un hueco en la secuencia).
+        """
+        self.zi = np.zeros((self.sos.shape[0], 2))
+        self.n = None                                  # índice absoluto de la próxima muestra
+        self.bp_hist = np.zeros(0)                     # pasa-banda reciente (para ubicar la R)
+        self.der_hist = np.zeros(4)
+        self.sq_hist = np.zeros(self.mwi_len - 1)
+        self.mwi_cola = np.zeros(0)                    # últimas 2 muestras integradas
+        self.aprendizaje = []
+        self.inicio = None
+        self.spki = self.npki = self.thr1 = self.thr2 = 0.0
+        self.ultimo_r = None
+        self.ultimo_pico = None
+        self.rr = deque(maxlen=8)
+        self.candidatos = []                           # picos bajo umbral desde la última R
+
+    def procesar(self, x: np.ndarray, seq0: int) -> list:
+        """
+        Procesa un bloque cuya primera muestra tiene índice absoluto seq0.
+        Devuelve [(indice_r, bpm | None), ...] con los QRS confirmados.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if self.n is not None and seq0 != self.n:
+            self.reset()
+        if self.n is None:
+            self.n = seq0
+            self.inicio = seq0
+            # Arrancar el filtro en régimen para no generar un transitorio
+            self.zi = sp_signal.sosfilt_zi(self.sos) * x[0]
+
+        bp, self.zi = sp_signal.sosfilt(self.sos, x, zi=self.zi)
+
+        ext = np.concatenate((self.der_hist, bp))
+        der = (2 * ext[4:] + ext[3:-1] - ext[1:-3] - 2 * ext[:-4]) * (self.fs / 8.0)
+        self.der_hist = ext[-4:]
+
+        ext = np.concatenate((self.sq_hist, der * der))
+        mwi = np.convolve(ext, np.ones(self.mwi_len) / self.mwi_len, mode="valid")
+        self.sq_hist = ext[len(ext) - (self.mwi_len - 1):] if self.mwi_len > 1 else self.sq_hist
+
+        # Historial del pasa-banda: ~1 s hacia atrás basta para ubicar la R
+        hist_ini = self.n - len(self.bp_hist)
+        self.bp_hist = np.concatenate((self.bp_hist, bp))
+        recorte = max(0, len(self.bp_hist) - int(self.fs) - len(bp))
+        self.bp_hist = self.bp_hist[recorte:]
+        hist_ini += recorte
+
+        # Máximos locales de la integración (las 2 muestras de la cola previa
+        # permiten confirmar un máximo justo en el borde del bloque)
+        cola_ini = self.n - len(self.mwi_cola)
+        ext = np.concatenate((self.mwi_cola, mwi))
+        picos, _ = sp_signal.find_peaks(ext, distance=max(1, self.refract))
+        self.mwi_cola = ext[-2:]
+        fin_bloque = self.n + len(x)
+        self.n = fin_bloque
+
+        if self.inicio is not None:
+            self.aprendizaje.append(mwi)
+            if fin_bloque - self.inicio < self.APRENDIZAJE_S * self.fs:
+                return []
+            todo = np.concatenate(self.aprendizaje)
+            self.spki = 0.25 * float(todo.max())
+            self.npki = 0.5 * float(todo.mean())
+            self._actualizar_umbrales()
+            self.aprendizaje = []
+            self.inicio = None
+
+        salida = []
+        for i in picos.tolist():
+            self._evaluar_pico(cola_ini + i, float(ext[i]), hist_ini, salida)
+        self._buscar_atras(fin_bloque, hist_ini, salida)
+        return salida
+
+    def _actualizar_umbrales(self):
+        self.thr1 = self.npki + 0.25 * (self.spki - self.npki)
+        self.thr2 = 0.5 * self.thr1
+
+    def _ubicar_r(self, p: int, hist_ini: int) -> int:
+        """
+        La R es el máximo |pasa-banda| en la ventana de integración que
+        termina en el pico p, corregido por el retardo del filtro.
+        """
+        ini = max(0, p - self.mwi_len - hist_ini)
+        fin = max(ini + 1, min(len(self.bp_hist), p + 1 - hist_ini))
+        return hist_ini + ini + int(np.argmax(np.abs(self.bp_hist[ini:fin]))) - self.retardo
+
+    def _registrar_qrs(self, p: int, hist_ini: int, salida: list):
+        r = self._ubicar_r(p, hist_ini)
+        bpm = None
+        if self.ultimo_r is not None:
+            rr = (r - self.ultimo_r) / self.fs
+            if RR_MIN <= rr <= RR_MAX:
+                self.rr.append(rr)
+                bpm = round(60.0 / rr)
+        self.ultimo_r = r
+        self.ultimo_pico = p
+        self.candidatos = []
+        salida.append((r, bpm))
+
+    def _evaluar_pico(self, p: int, valor: float, hist_ini: int, salida: list):
+        if self.ultimo_r is not None and p - self.ultimo_pico < self.refract:
+            return
+        if valor > self.thr1:
+            self.spki = 0.125 * valor + 0.875 * self.spki
+            self._registrar_qrs(p, hist_ini, salida)
+        else:
+            self.npki = 0.125 * valor + 0.875 * self.npki
+            self.candidatos.append((p, valor))
+        self._actualizar_umbrales()
+
+    def _buscar_atras(self, ahora: int, hist_ini: int, salida: list):
+        """
+        Sin QRS durante 1.66 x RR medio: el mayor candidato sobre thr2 se
+        toma como QRS perdido.
+        """
+        if self.ultimo_r is None or not self.rr or not self.candidatos:
+            return
+        if ahora - self.ultimo_pico < 1.66 * float(np.mean(self.rr)) * self.fs:
+            return
+        p, valor = max(self.candidatos, key=lambda c: c[1])
+        if valor > self.thr2 and p - hist_ini >= 0:
+            self.spki = 0.25 * valor + 0.75 * self.spki
+            self._actualizar_umbrales()
+            self._registrar_qrs(p, hist_ini, salida)
+        else:
+            self.candidatos = []
+
+_detector_pt = DetectorPanTompkins(FS)
+
+def detectar_bpm_pan_tompkins(valores: np.ndarray, seq0: int, t0: float):
+    """
+    Adaptador del detector Pan-Tompkins al pipeline: guarda los picos R
+    y actualiza el último BPM y la HRV. El instante de cada R es t0 + (r - seq0)/FS.
+    Devuelve [(ts, bpm, t_epoch_ns), ...] como detectar_bpm_sencillo.
+    """
+    global _last_bpm, _last_bpm_ts
+
+    bpm_out = []
+    for r, bpm in _detector_pt.procesar(valores, seq0):
+        t_r = t0 + (r - seq0) / FS
+        r_prev = _picos_r[-1][0] if _picos_r else None
+        _picos_r.append((r, t_r))
+        if bpm is None:
+            continue
+        if r_prev is not None:
+            _hrv_latido(r, r - r_prev, t_r)
+        ts = _timestamps_bloque(t_r, 1)[0]
+        _last_bpm = bpm
+        _last_bpm_ts = ts
+        bpm_out.append((ts, bpm, int(round(t_r * 1e9))))
+    return bpm_out
+
+# ---------------------- HRV incremental ----------------------
+
+class VentanaHRV:
+    """
+    Ventana deslizante de RR (en tiempo de señal) con sumas acumuladas:
+    cada RR entra y sale una sola vez, así que un latido cuesta O(1)
+    amortizado sin importar el largo de la ventana. Los RR van en µs
+    enteros: las sumas (y la varianza) son exactas y no derivan.
+    """
+
+    def __init__(self, minutos: float, n_clases: int):
+        self.minutos = minutos
+        self.ancho_ns = int(minutos * 60e9)
+        self.rr = deque()         # (t_epoch_ns, rr_us, dif_us | None)
+        self.hist = [0] * n_clases
+        self.reset()
+
+    def reset(self):
+        self.rr.clear()
+        self.hist[:] = [0] * len(self.hist)
+        self.n = 0
+        self.s1 = 0               # Σ rr
+        self.s2 = 0               # Σ rr²
+        self.n_dif = 0            # diferencias entre RR consecutivos
+        self.s_dif2 = 0           # Σ dif²
+        self.nn50 = 0             # |dif| > 50 ms
+
+    def agregar(self, t_ns: int, rr_us: int, dif_us, clase: int):
+        self.rr.append((t_ns, rr_us, dif_us))
+        self.n += 1
+        self.s1 += rr_us
+        self.s2 += rr_us * rr_us
+        self.hist[clase] += 1
+        if dif_us is not None:
+            self.n_dif += 1
+            self.s_dif2 += dif_us * dif_us
+            self.nn50 += abs(dif_us) > 50000
+        # Salen los RR que terminaron hace más que el ancho de la ventana
+        limite = t_ns - self.ancho_ns
+        while self.rr[0][0] <= limite:
+            _, rr_viejo, dif_viejo = self.rr.popleft()
+            self.n -= 1
+            self.s1 -= rr_viejo
+            self.s2 -= rr_viejo * rr_viejo
+            self.hist[_clase_hrv(rr_viejo)] -= 1
+            if dif_viejo is not None:
+                self.n_dif -= 1
+                self.s_dif2 -= dif_viejo * dif_viejo
+                self.nn50 -= abs(dif_viejo) > 50000
+
+    def resumen(self, histograma: bool = False) -> dict:
+        """
+        SDNN, RMSSD, pNN50 (%) y FC media (60 / RR medio) de la ventana.
+        span_s es lo que cubren los RR presentes: menos que la ventana
+        mientras se llena o tras un hueco.
+        """
+        n = self.n
+        out = {"window_min": self.minutos, "n": n, "span_s": None, "mean_rr_ms": None, "sdnn_ms": None,
+               "rmssd_ms": None, "pnn50": None, "mean_hr": None}
+        if n:
+            out["span_s"] = round((self.rr[-1][0] - self.rr[0][0]) / 1e9 + self.rr[0][1] / 1e6, 3)
+            out["mean_rr_ms"] = round(self.s1 / n / 1000.0, 3)
+            out["mean_hr"] = round(60e6 * n / self.s1, 2)
+        if n > 1:
+            out["sdnn_ms"] = round(((n * self.s2 - self.s1 * self.s1) / (n * (n - 1))) ** 0.5 / 1000.0, 3)
+        if self.n_dif:
+            out["rmssd_ms"] = round((self.s_dif2 / self.n_dif) ** 0.5 / 1000.0, 3)
+            out["pnn50"] = round(100.0 * self.nn50 / self.n_dif, 2)
+        if histograma:
+            out["histogram"] = self.histograma()
+        return out
+
+    def histograma(self) -> dict:
+        """
+        Clases de HRV_HIST_BIN_MS recortadas a las no vacías de los extremos
+        e índice triangular (n / clase más alta).
+        """
+        usadas = [i for i, c in enumerate(self.hist) if c]
+        if not usadas:
+            return {"start_ms": None, "bin_ms": HRV_HIST_BIN_MS, "counts": [], "tri_index": None}
+        ini, fin = usadas[0], usadas[-1] + 1
+        return {"start_ms": _HRV_HIST_INI_MS + ini * HRV_HIST_BIN_MS, "bin_ms": HRV_HIST_BIN_MS,
+                "counts": self.hist[ini:fin], "tri_index": round(self.n / max(self.hist[ini:fin]), 2)}
+
+_HRV_HIST_INI_MS = int(RR_MIN * 1000) // HRV_HIST_BIN_MS * HRV_HIST_BIN_MS
+_HRV_HIST_CLASES = int(RR_MAX * 1000 - _HRV_HIST_INI_MS) // HRV_HIST_BIN_MS + 1
+
+def _clase_hrv(rr_us: int) -> int:
+    return min(max((rr_us // 1000 - _HRV_HIST_INI_MS) // HRV_HIST_BIN_MS, 0), _HRV_HIST_CLASES - 1)
+
+class AnalizadorHRV:
+    """
+    HRV en vivo sobre los RR que entrega el detector: una VentanaHRV por
+    cada duración de HRV_WINDOWS_MIN, todas alimentadas con el mismo RR.
+    La diferencia sucesiva (RMSSD, pNN50) sólo se cuenta entre RR
+    contiguos: un RR descartado por el detector o un hueco la cortan.
+    Escribe el hilo lector; /hrv lee con el lock tomado.
+    """
+
+    def __init__(self, fs: float, ventanas_min=HRV_WINDOWS_MIN):
+        self.fs = fs
+        self.lock = threading.Lock()
+        self.ventanas = [VentanaHRV(m, _HRV_HIST_CLASES) for m in ventanas_min]
+        self.reset()
+
+    def reset(self):
+        for v in self.ventanas:
+            v.reset()
+        self.ultimo_r = None      # seq de la R que cerró el último RR
+        self.ultimo_rr = None
+        self.t_ns = None
+        self.latidos = 0
+        self.proximo_guardado = None
+
+    def agregar(self, r: int, rr_muestras: int, t_r: float):
+        """
+        RR de rr_muestras que termina en la R de índice r (instante t_r,
+        epoch s). Devuelve las filas de la tabla hrv que tocan guardar:
+        cada HRV_PERSIST_SECS de señal, una por ventana >= HRV_PERSIST_MIN.
+        """
+        t_ns = int(round(t_r * 1e9))
+        rr_us = int(round(rr_muestras * 1e6 / self.fs))
+        with self.lock:
+            if self.t_ns is not None and t_ns < self.t_ns:
+                self.reset()  # el tiempo volvió atrás (reproducción desde el principio, otra grabación)
+            dif_us = rr_us - self.ultimo_rr if r - rr_muestras == self.ultimo_r else None
+            clase = _clase_hrv(rr_us)
+            for v in self.ventanas:
+                v.agregar(t_ns, rr_us, dif_us, clase)
+            self.ultimo_r, self.ultimo_rr, self.t_ns = r, rr_us, t_ns
+            self.latidos += 1
+            if self.proximo_guardado is None:
+                self.proximo_guardado = t_ns + int(HRV_PERSIST_SECS * 1e9)
+            if t_ns < self.proximo_guardado:
+                return []
+            self.proximo_guardado = t_ns + int(HRV_PERSIST_SECS * 1e9)
+            return [fila_hrv(t_ns, v.resumen(histograma=True))
+                    for v in self.ventanas if v.minutos >= HRV_PERSIST_MIN]
+
+    def resumen(self, histograma: bool = True) -> dict:
+        with self.lock:
+            return {
+                "timestamp": None if self.t_ns is None else _timestamps_bloque(self.t_ns / 1e9, 1)[0],
+                "t_epoch_ns": self.t_ns,
+                "beats": self.latidos,
+                "last_rr_ms": None if self.ultimo_rr is None else self.ultimo_rr / 1000.0,
+                "windows": [v.resumen(histograma) for v in self.ventanas],
+            }
+
+def fila_hrv(t_ns: int, r: dict) -> tuple:
+    """
+    Resumen de una ventana -> fila de la tabla hrv (el histograma en JSON).
+    """
+    return (int(r["window_min"] * 60), t_ns, r["n"], r["mean_rr_ms"], r["sdnn_ms"], r["rmssd_ms"],
+            r["pnn50"], r["mean_hr"], json.dumps(r["histogram"]))
+
+_hrv = AnalizadorHRV(FS)
+
+def _hrv_latido(r: int, rr_muestras: int, t_r: float):
+    """
+    Alimenta _hrv con un RR nuevo desde el adaptador del detector: encola
+    las filas de la tabla hrv (con escritura activa) y avisa a /ws/hrv.
+    """
+    filas = _hrv.agregar(r, rr_muestras, t_r)
+    if filas and activar_escritura:
+        _db_encolar(("hrv", filas))
+    _publicar_hrv()
+
+def _publicar_hrv():
+    """
+    Entrega el resumen HRV (con histogramas) tras cada latido a los clientes
+    de /ws/hrv y, en el proceso de adquisición, al anillo compartido para
+    los /ws/hrv de los workers "attach".
+    """
+    anillo, msg = _anillo_shm, None
+    if anillo is not None and anillo.escritor:
+        msg = json.dumps(_hrv.resumen())
+        anillo.publicar_mensaje(AnilloCompartido.CANAL_HRV, msg)
+    loop = _ws_loop
+    if loop is None or not ws_hrv_clients:
+        return
+    msg = msg or json.dumps(_hrv.resumen())
+    def _difundir():
+        for cliente in list(ws_hrv_clients.values()):
+            cliente.encolar(msg, 1)
+    try:
+        loop.call_soon_threadsafe(_difundir)
+    except RuntimeError:
+        pass
+
+# ---------------------- Inferencia ECGNet ----------------------
+
+def _cargar_modelo():
+    """
+    Carga ECGNet y el scaler una sola vez (en el hilo de inferencia) y
+    hace una pasada de calentamiento. torch/joblib se importan aquí:
+    sin ellos o sin los archivos, la API sigue funcionando sin inferencia.
+    """
+    _modelo["state"] = "loading"
+    t_ini = time.perf_counter()
+    try:
+        import torch
+        import joblib
+        from predict import ECGNet
+
+        torch.set_num_threads(INFER_THREADS)
+        net = ECGNet(input_size=MODEL_INPUT, num_classes=len(PRED_CLASES))
+        net.load_state_dict(torch.load(DATA_DIR / MODEL_PATH, map_location="cpu"))
+        net.eval()
+        scaler = joblib.load(DATA_DIR / SCALER_PATH)
+        with torch.inference_mode():
+            net(torch.zeros((INFER_BATCH, MODEL_INPUT)))
+        _modelo.update(net=net, scaler=scaler, torch=torch, state="ready", error=None)
+    except Exception as e:
+        _modelo.update(state="unavailable", error=str(e))
+        print(f"Inferencia no disponible: {e}")
+    _modelo["load_ms"] = round((time.perf_counter() - t_ini) * 1000.0, 1)
+
+def clasificar_latidos(X: np.ndarray):
+    """
+    Clasifica latidos (n, MODEL_INPUT) con el modelo caliente.
+    Devuelve (clases ndarray int, probabilidad de la clase ndarray).
+    """
+    torch = _modelo["torch"]
+    X = _modelo["scaler"].transform(X)
+    with torch.inference_mode():
+        salida = _modelo["net"](torch.from_numpy(np.asarray(X, dtype=np.float32)))
+        prob, clase = torch.softmax(salida, dim=1).max(dim=1)
+    return clase.numpy(), prob.numpy()
+
+def inferencia_encolar(X: np.ndarray, metas: list, trabajo: int = None) -> int:
+    """
+    Encola latidos para el hilo de inferencia sin bloquear.
+    Devuelve cuántos latidos se aceptaron.
+    """
+    if not INFER_ENABLED or _modelo["state"] == "unavailable":
+        _infer_stats["dropped_beats"] += len(X)
+        return 0
+    try:
+        infer_queue.put_nowait(("beats", X, metas, time.monotonic(), trabajo))
+        return len(X)
+    except queue.Full:
+        _infer_stats["dropped_beats"] += len(X)
+        return 0
+
+def _publicar_predicciones(resultados: list):
+    """
+    Entrega predicciones en vivo a los clientes de /ws/predictions (un JSON por
+    lote) y, en el proceso de adquisición, al anillo compartido para los
+    workers "attach" (partido en trozos si el lote no entra en un mensaje).
+    """
+    anillo = _anillo_shm
+    if anillo is not None and anillo.escritor:
+        i, paso = 0, len(resultados)
+        while i < len(resultados):
+            parte = resultados[i:i + paso]
+            if anillo.publicar_mensaje(AnilloCompartido.CANAL_PRED, json.dumps(parte), len(parte)) or paso == 1:
+                i += paso
+            else:
+                paso = max(1, paso // 2)
+    loop = _ws_loop
+    if loop is None or not ws_pred_clients:
+        return
+    msg = json.dumps(resultados)
+    def _difundir():
+        for cliente in list(ws_pred_clients.values()):
+            cliente.encolar(msg, len(resultados))
+    try:
+        loop.call_soon_threadsafe(_difundir)
+    except RuntimeError:
+        pass
+
+def _nuevo_trabajo(fuente: str, total: int) -> dict:
+    global _trabajo_id
+    _trabajo_id += 1
+    for viejo in [k for k, t in _trabajos.items() if t["state"] in ("done", "error")][:max(0, len(_trabajos) - MAX_TRABAJOS + 1)]:
+        del _trabajos[viejo]
+    trabajo = {
+        "job": _trabajo_id,
+        "source": fuente,
+        "total": total,
+        "done": 0,
+        "state": "queued",
+        "error": None,
+        "queued_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "classes": [None] * total,
+    }
+    _trabajos[trabajo["job"]] = trabajo
+    return trabajo
+
+def _terminar_trabajo(trabajo: dict, error: str = None):
+    trabajo["finished_at"] = time.time()
+    trabajo["state"] = "error" if error else "done"
+    trabajo["error"] = error
+
+def _escribir_predicciones_csv(X: np.ndarray, clases: list):
+    """
+    Escribe PREDICT_OUTPUT_CSV con el formato de predict.py (columnas 0..186
+    y Predicted_Class). Se escribe a un temporal y se reemplaza de una vez.
+    """
+    tmp = PREDICT_OUTPUT_CSV + ".tmp"
+    cabecera = ",".join([str(i) for i in range(X.shape[1])] + ["Predicted_Class"])
+    datos = np.column_stack((X, np.asarray(clases, dtype=np.float64)))
+    fmt = ["%.6g"] * X.shape[1] + ["%d"]
+    np.savetxt(tmp, datos, fmt=fmt, delimiter=",", header=cabecera, comments="")
+    os.replace(tmp, PREDICT_OUTPUT_CSV)
+
+def _procesar_lote(X: np.ndarray, metas: list, t_enc: list):
+    """
+    Clasifica un lote y reparte resultados: en vivo a memoria y WS,
+    de trabajos a su trabajo. metas[i] es {"seq", "session", "timestamp"}
+    (en vivo) o {"job", "row"[, "beat"]}; t_enc[i] es el instante de encolado.
+    Los latidos de la tabla beats (en vivo o "beat": (sesión, r_seq)) se
+    anotan con su clase si la escritura está activa.
+    """
+    global _pred_id
+
+    t_ini = time.perf_counter()
+    clases, probs = clasificar_latidos(X)
+    ahora = time.monotonic()
+    ms = (time.perf_counter() - t_ini) * 1000.0
+
+    en_vivo, anotar = [], []
+    for meta, clase, prob in zip(metas, clases.tolist(), probs.tolist()):
+        if "job" in meta:
+            trabajo = _trabajos[meta["job"]]
+            trabajo["classes"][meta["row"]] = clase
+            trabajo["done"] += 1
+            if "beat" in meta:
+                anotar.append((clase, *meta["beat"]))
+            continue
+        if "session" in meta:
+            anotar.append((clase, meta["session"], meta["seq"]))
+        _pred_id += 1
+        res = {"id": _pred_id, "seq": meta["seq"], "timestamp": meta["timestamp"],
+               "class": clase, "label": PRED_CLASES[clase], "prob": round(prob, 4)}
+        predicciones.append(res)
+        en_vivo.append(res)
+    if en_vivo:
+        _publicar_predicciones(en_vivo)
+    if anotar and activar_escritura:
+        _db_encolar(("beat_classes", anotar))
+
+    _hist_infer_lote.observar(ms / 1000.0)
+    for t in t_enc:
+        _hist_infer_lat.observar(ahora - t)
+    lat = (ahora - min(t_enc)) * 1000.0
+    _infer_stats["batches"] += 1
+    _infer_stats["beats"] += len(X)
+    _infer_stats["last_batch_ms"] = round(ms, 3)
+    _infer_stats["last_latency_ms"] = round(lat, 3)
+    _infer_stats["max_latency_ms"] = round(max(_infer_stats["max_latency_ms"], lat), 3)
+    avg = _infer_stats["avg_latency_ms"]
+    _infer_stats["avg_latency_ms"] = round(lat if avg is None else 0.9 * avg + 0.1 * lat, 3)
+
+def _infer_worker():
+    """
+    Hilo de inferencia: carga el modelo y agrupa latidos en lotes de hasta
+    INFER_BATCH. Los latidos en vivo tienen prioridad; los trabajos grandes
+    (/doPrediction) se procesan de a un lote entre medio. Los trabajos sobre
+    la tabla beats se leen por partes (fetchmany) a medida que se vacía fondo.
+    """
+    _cargar_modelo()
+    fondo = deque()    # [(X, metas, t_enc, trabajo)] lotes de trabajos pendientes
+    fuentes = deque()  # [(trabajo, conexión, generador de leer_latidos)]
+
+    while not _infer_stop.is_set():
+        try:
+            # Con trabajos pendientes no se espera: sólo se recoge lo que haya
+            item = infer_queue.get_nowait() if fondo else infer_queue.get(timeout=0.05)
+        except queue.Empty:
+            item = None
+
+        X_vivo, metas_vivo, t_vivo = [], [], []
+        while item is not None:
+            if item[0] == "file":
+                _, ruta, trabajo = item
+                try:
+                    X = np.atleast_2d(np.loadtxt(ruta, delimiter=";", dtype=np.float64))
+                    trabajo["total"] = len(X)
+                    trabajo["classes"] = [None] * len(X)
+                    trabajo["X"] = X
+                    item = ("beats", X, [{"job": trabajo["job"], "row": i} for i in range(len(X))],
+                            time.monotonic(), trabajo["job"])
+                except Exception as e:
+                    _terminar_trabajo(trabajo, str(e))
+                    item = None
+            elif item[0] == "db":
+                _, ruta, sesion, trabajo = item
+                try:
+                    conn = conectar_solo_lectura(ruta)
+                    sql = "SELECT COUNT(*) FROM beats" + (" WHERE session_id = ?" if sesion is not None else "")
+                    trabajo["total"] = conn.execute(sql, () if sesion is None else (sesion,)).fetchone()[0]
+                    trabajo["classes"] = [None] * trabajo["total"]
+                    if trabajo["total"]:
+                        fuentes.append((trabajo, conn, leer_latidos(conn, sesion, limit=trabajo["total"], lote=INFER_BATCH * 16)))
+                    else:
+                        conn.close()
+                        _terminar_trabajo(trabajo)
+                except Exception as e:
+                    _terminar_trabajo(trabajo, str(e))
+                item = None
+            if item is not None:
+                _, X, metas, t_enc, id_trabajo = item
+                if _modelo["state"] != "ready":
+                    _infer_stats["dropped_beats"] += len(X)
+                    if id_trabajo is not None:
+                        _terminar_trabajo(_trabajos[id_trabajo], _modelo["error"] or "modelo no disponible")
+                elif id_trabajo is not None:
+                    for i in range(0, len(X), INFER_BATCH):
+                        fondo.append((X[i:i + INFER_BATCH], metas[i:i + INFER_BATCH], t_enc, id_trabajo))
+                else:
+                    X_vivo.append(X)
+                    metas_vivo.extend(metas)
+                    t_vivo.extend([t_enc] * len(X))
+            if len(metas_vivo) >= INFER_BATCH:
+                break
+            try:
+                item = infer_queue.get_nowait()
+            except queue.Empty:
+                item = None
+
+        try:
+            if X_vivo:
+                _procesar_lote(np.vstack(X_vivo), metas_vivo, t_vivo)
+            if not fondo and fuentes:
+                trabajo, conn, gen = fuentes[0]
+                parte = next(gen, None)
+                if parte is None or _modelo["state"] != "ready":
+                    fuentes.popleft()
+                    conn.close()
+                    if _modelo["state"] != "ready":
+                        _terminar_trabajo(trabajo, _modelo["error"] or "modelo no disponible")
+                    elif trabajo["done"] < trabajo["total"]:
+                        # Filas borradas entre el COUNT y la lectura
+                        trabajo["total"] = trabajo["done"]
+                        _terminar_trabajo(trabajo)
+                else:
+                    filas, X = parte
+                    fila0 = trabajo["done"]  # fondo está vacío: todo lo anterior ya se clasificó
+                    X = np.vstack([preparar_latido(x, f[3]) for f, x in zip(filas, X)])
+                    metas = [{"job": trabajo["job"], "row": fila0 + i, "beat": (f[0], f[1])}
+                             for i, f in enumerate(filas)]
+                    t_enc = time.monotonic()
+                    for i in range(0, len(X), INFER_BATCH):
+                        fondo.append((X[i:i + INFER_BATCH], metas[i:i + INFER_BATCH], t_enc, trabajo["job"]))
+            if fondo:
+                X, metas, t_enc, id_trabajo = fondo.popleft()
+                trabajo = _trabajos[id_trabajo]
+                if trabajo["state"] == "queued":
+                    trabajo["state"] = "running"
+                    trabajo["started_at"] = time.time()
+                _procesar_lote(X, metas, [t_enc] * len(X))
+                if trabajo["done"] >= trabajo["total"]:
+                    if trabajo["source"] == "file":
+                        _escribir_predicciones_csv(trabajo.pop("X"), trabajo["classes"])
+                    _terminar_trabajo(trabajo)
+        except Exception as e:
+            print(f"Error en inferencia: {e}")
+            _infer_stats["last_error"] = str(e)
+            fondo.clear()
+            while fuentes:
+                fuentes.popleft()[1].close()
+            for trabajo in _trabajos.values():
+                if trabajo["state"] in ("queued", "running"):
+                    _terminar_trabajo(trabajo, str(e))
+
+    print("Hilo de inferencia finalizado.")
+
+def estado_inferencia() -> dict:
+    return {
+        "enabled": INFER_ENABLED,
+        "model": _modelo["state"],
+        "error": _modelo["error"],
+        "load_ms": _modelo["load_ms"],
+        "queue_depth": infer_queue.qsize(),
+        "results_in_memory": len(predicciones),
+        **_infer_stats,
+    }
+
+def estado_latidos() -> dict:
+    return {
+        "enabled": BEATS_ENABLED,
+        "pre_s": BEAT_PRE_S,
+        "window": MODEL_INPUT,
+        "fs": MODEL_FS,
+        "ring_samples": _anillo_latidos.capacidad,
+        "last_r_seq": _seg_ultimo_r,
+        **_seg_stats,
+    }
+
+# ---------------------- Buffer circular ----------------------
+
+class BufferAnillo:
+    """
+    Buffer circular NumPy indexado por número de secuencia de muestra.
+    Un solo escritor (hilo lector); las lecturas copian el rango pedido y
+    comprueban después que no haya sido sobrescrito mientras tanto.
+    """
+
+    def __init__(self, capacidad: int, dtype=np.float32):
+        self.capacidad = max(1, int(capacidad))
+        self.datos = np.zeros(self.capacidad, dtype=dtype)
+        self.inicio = 0   # seq más antigua disponible
+        self.fin = 0      # seq siguiente a la última escrita
+
+    def escribir(self, seq0: int, vals: np.ndarray):
+        vals = np.asarray(vals)
+        n = len(vals)
+        if n == 0:
+            return
+        if seq0 != self.fin:
+            self.inicio = seq0  # hueco o reinicio: lo anterior ya no es contiguo
+        if n > self.capacidad:
+            vals = vals[-self.capacidad:]
+            seq0 += n - self.capacidad
+            n = self.capacidad
+        i = seq0 % self.capacidad
+        k = min(n, self.capacidad - i)
+        # inicio se adelanta antes de escribir: un lector concurrente detecta la pisada
+        self.inicio = max(self.inicio, seq0 + n - self.capacidad)
+        self.datos[i:i + k] = vals[:k]
+        self.datos[:n - k] = vals[k:]
+        self.fin = seq0 + n
+
+    def leer(self, seq_ini: int, seq_fin: int):
+        """
+        Copia de las muestras [seq_ini, seq_fin), o None si el rango no
+        está (todavía o ya) en el buffer.
+        """
+        if seq_ini < self.inicio or seq_fin > self.fin or seq_fin < seq_ini:
+            return None
+        i = seq_ini % self.capacidad
+        n = seq_fin - seq_ini
+        if i + n <= self.capacidad:
+            out = self.datos[i:i + n].copy()
+        else:
+            out = np.concatenate((self.datos[i:], self.datos[:i + n - self.capacidad]))
+        return out if seq_ini >= self.inicio else None
+
+class BufferMuestras:
+    """
+    Últimas muestras en vivo para /ecg: valores int32 (float32 si llegan
+    valores no enteros, p.ej. la señal de prueba normalizada), filtrada
+    float32 y seq int64 en arrays circulares. El tiempo no se guarda por
+    muestra: t = t_ancla + (seq - seq_ancla) / FS, con un ancla nueva sólo
+    cuando el reloj de muestras se re-ancla, y los timestamps en texto se
+    generan sólo al leer. Un solo escritor; la lectura comprueba que lo
+    copiado no se haya pisado y si no reintenta.
+    """
+
+    def __init__(self, capacidad: int):
+        self.capacidad = max(1, int(capacidad))
+        self.valores = np.zeros(self.capacidad, dtype=np.int32)
+        self.filtrada = np.full(self.capacidad, np.nan, dtype=np.float32)
+        self.seqs = np.full(self.capacidad, -1, dtype=np.int64)
+        self.escritas = 0       # total de muestras escritas (posición lógica)
+        self.anclas = deque(maxlen=64)  # [(seq_ancla, t_ancla)] crecientes en seq
+
+    def __len__(self):
+        return min(self.escritas, self.capacidad)
+
+    def escribir(self, seq0: int, vals: np.ndarray, filt: np.ndarray = None, t0: float = None):
+        n = len(vals)
+        if n == 0:
+            return
+        if self.valores.dtype.kind == "i" and vals.dtype.kind == "f" and not np.all(np.mod(vals, 1) == 0):
+            self.valores = self.valores.astype(np.float32)
+        ultimo = self.seqs[(self.escritas - 1) % self.capacidad] if self.escritas else None
+        if t0 is not None:
+            if ultimo is not None and seq0 <= ultimo:
+                self.anclas.clear()   # reinicio de la numeración
+            if not self.anclas or abs(self._epoch_ancla(self.anclas[-1], seq0) - t0) > 0.5 / FS:
+                self.anclas.append((seq0, t0))
+        if n > self.capacidad:
+            vals = vals[-self.capacidad:]
+            filt = None if filt is None else filt[-self.capacidad:]
+            self.escritas += n - self.capacidad
+            seq0 += n - self.capacidad
+            n = self.capacidad
+        pos = self.escritas % self.capacidad
+        idx = (pos + np.arange(n)) % self.capacidad if pos + n > self.capacidad else slice(pos, pos + n)
+        self.valores[idx] = vals
+        self.filtrada[idx] = np.nan if filt is None else filt
+        self.seqs[idx] = np.arange(seq0, seq0 + n)
+        self.escritas += n
+
+    def _copiar(self, desde: int, hasta: int):
+        """
+        Copia las posiciones lógicas [desde, hasta) de los tres arrays.
+        """
+        i, n = desde % self.capacidad, hasta - desde
+        if i + n <= self.capacidad:
+            return tuple(a[i:i + n].copy() for a in (self.seqs, self.valores, self.filtrada))
+        j = i + n - self.capacidad
+        return tuple(np.concatenate((a[i:], a[:j])) for a in (self.seqs, self.valores, self.filtrada))
+
+    def leer(self, since: int = None, limite: int = None):
+        """
+        (seqs, valores, filtrada) de las muestras con seq > since (las
+        últimas `limite` si since es None), en orden. Sólo se copia lo
+        devuelto: la búsqueda de since es binaria sobre los seq.
+        """
+        for _ in range(3):
+            fin = self.escritas
+            ini = max(0, fin - self.capacidad)
+            n = fin - ini
+            if since is not None:
+                i = ini % self.capacidad
+                a = self.seqs[i:min(self.capacidad, i + n)]
+                k = int(np.searchsorted(a, since, side="right"))
+                if k == len(a):
+                    k += int(np.searchsorted(self.seqs[:n - len(a)], since, side="right"))
+                m = n - k if limite is None else min(limite, n - k)
+            else:
+                m = n if limite is None else min(limite, n)
+                k = n - m
+            datos = self._copiar(ini + k, ini + k + m)
+            # Si el escritor dio la vuelta mientras se copiaba, se repite
+            if self.escritas - self.capacidad <= ini + k:
+                return datos
+        return datos
+
+    @staticmethod
+    def _epoch_ancla(ancla, seq):
+        return ancla[1] + (seq - ancla[0]) / FS
+
+    def epochs(self, seqs: np.ndarray) -> np.ndarray:
+        anclas = list(self.anclas)
+        if not anclas:
+            return np.zeros(len(seqs))
+        if len(anclas) == 1:
+            return self._epoch_ancla(anclas[0], seqs)
+        seq_a, t_a = (np.asarray(c) for c in zip(*anclas))
+        k = np.maximum(np.searchsorted(seq_a, seqs, side="right") - 1, 0)
+        return t_a[k] + (seqs - seq_a[k]) / FS
+
+datos_ecg = BufferMuestras(int(ECG_MEMORY_MIN * 60 * FS))
+
+# ---------------------- Memoria compartida (adquisición en otro proceso) ----------------------
+
+class AnilloCompartido:
+    """
+    Últimas muestras en vivo en un segmento multiprocessing.shared_memory:
+    el proceso de adquisición (ACQ_MODE = "process") es el único escritor y
+    cualquier número de workers de la API (ACQ_MODE = "attach") lo leen sin
+    locks. Se guarda por muestra seq, valor, filtrada y epoch, y aparte un
+    anillo de mensajes JSON (predicciones y HRV) para los /ws de los workers.
+
+    Protocolo: el escritor anuncia en RESERVA hasta dónde va a escribir,
+    copia las muestras y recién entonces avanza ESCRITAS. El lector lee
+    ESCRITAS, copia y comprueba con RESERVA que el escritor no haya pisado
+    lo copiado (si lo pisó, repite); los mensajes siguen el mismo esquema
+    con MSG_RESERVA / MSG_ESCRITOS. El BPM y el nombre de la BD se
+    publican con un contador de generación (impar = escribiendo). Todos los
+    contadores son int64 alineados. No hay barreras de memoria: el protocolo
+    vale sólo si las escrituras del escritor se ven en orden, como en x86
+    (SHM_SOPORTADO); en otras CPU no se crea ni se adjunta.
+    """
+
+    MAGIA   = 0x45434731  # "ECG1"
+    VERSION = 2
+    CAB_BYTES = 512        # 32 campos de 8 bytes + nombre de la BD
+    # Campos int64 de la cabecera
+    I_MAGIA, I_VERSION, I_CAPACIDAD, I_INSTANCIA, I_PID, I_ESCRITAS, I_RESERVA, I_FLOTANTE, \
+        I_BPM_GEN, I_BPM, I_DB_GEN, I_DB_LEN, I_MSG_SLOTS, I_MSG_BYTES, I_MSG_ESCRITOS, I_MSG_RESERVA = range(16)
+    # Campos float64
+    F_FS, F_LATIDO, F_BPM_T = 16, 17, 18
+    DB_OFF, DB_MAX = 256, 256
+    # Canales del anillo de mensajes
+    CANAL_PRED, CANAL_HRV = 0, 1
+
+    @staticmethod
+    def _bytes_muestras(capacidad: int) -> int:
+        return (28 * capacidad + 7) // 8 * 8  # el anillo de mensajes empieza alineado a 8
+
+    def __init__(self, shm, escritor: bool):
+        self.shm = shm
+        self.escritor = escritor
+        buf = shm.buf
+        self.cab_i = np.ndarray((32,), np.int64, buffer=buf)
+        self.cab_f = np.ndarray((32,), np.float64, buffer=buf)
+        self.capacidad = int(self.cab_i[self.I_CAPACIDAD])
+        cap, off = self.capacidad, self.CAB_BYTES
+        self.seqs = np.ndarray((cap,), np.int64, buffer=buf, offset=off)
+        self.valores = np.ndarray((cap,), np.float64, buffer=buf, offset=off + 8 * cap)
+        self.epochs = np.ndarray((cap,), np.float64, buffer=buf, offset=off + 16 * cap)
+        self.filtrada = np.ndarray((cap,), np.float32, buffer=buf, offset=off + 24 * cap)
+        self.msg_slots, self.msg_bytes = int(self.cab_i[self.I_MSG_SLOTS]), int(self.cab_i[self.I_MSG_BYTES])
+        off += self._bytes_muestras(cap)
+        self.msg_meta = np.ndarray((self.msg_slots, 3), np.int64, buffer=buf, offset=off)  # canal, largo, peso
+        self.msg_datos = np.ndarray((self.msg_slots, self.msg_bytes), np.uint8, buffer=buf, offset=off + 24 * self.msg_slots)
+        self.instancia = int(self.cab_i[self.I_INSTANCIA])
+        self._lock_msg = threading.Lock()  # predicciones (inferencia) y HRV (lector) publican desde hilos distintos
+
+    @classmethod
+    def crear(cls, nombre: str, capacidad: int, fs: float):
+        """
+        Crea el segmento (el de una corrida anterior que no se cerró se
+        reemplaza). Sólo lo llama el proceso de adquisición.
+        """
+        from multiprocessing import shared_memory
+        if not SHM_SOPORTADO:
+            raise RuntimeError(f"Memoria compartida sin barreras: no soportada en {platform.machine()}")
+        capacidad = max(1, int(capacidad))
+        tam = cls.CAB_BYTES + cls._bytes_muestras(capacidad) + SHM_MSG_SLOTS * (24 + SHM_MSG_BYTES)
+        try:
+            shm = shared_memory.SharedMemory(name=nombre, create=True, size=tam)
+        except FileExistsError:
+            viejo = shared_memory.SharedMemory(name=nombre)
+            pid = int(np.ndarray((32,), np.int64, buffer=viejo.buf)[cls.I_PID]) if viejo.size >= cls.CAB_BYTES else 0
+            if pid and pid != os.getpid() and _pid_vivo(pid):
+                viejo.close()
+                raise RuntimeError(f"Ya hay un proceso de adquisición publicando en {nombre} (pid {pid})")
+            viejo.close()
+            viejo.unlink()
+            shm = shared_memory.SharedMemory(name=nombre, create=True, size=tam)
+        cab_i = np.ndarray((32,), np.int64, buffer=shm.buf)
+        cab_f = np.ndarray((32,), np.float64, buffer=shm.buf)
+        cab_i[:] = 0
+        cab_i[cls.I_VERSION] = cls.VERSION
+        cab_i[cls.I_CAPACIDAD] = capacidad
+        cab_i[cls.I_INSTANCIA] = int.from_bytes(os.urandom(7), "little")
+        cab_i[cls.I_PID] = os.getpid()
+        cab_i[cls.I_BPM] = -1
+        cab_i[cls.I_MSG_SLOTS], cab_i[cls.I_MSG_BYTES] = SHM_MSG_SLOTS, SHM_MSG_BYTES
+        cab_f[cls.F_FS] = fs
+        cab_i[cls.I_MAGIA] = cls.MAGIA  # último: recién ahora un lector lo acepta
+        del cab_i, cab_f
+        return cls(shm, escritor=True)
+
+    @classmethod
+    def adjuntar(cls, nombre: str):
+        """
+        Abre el segmento de la adquisición en modo lectura; None si todavía
+        no existe o no está listo (o la CPU no es x86, ver SHM_SOPORTADO).
+        """
+        from multiprocessing import shared_memory
+        if not SHM_SOPORTADO:
+            return None
+        try:
+            try:
+                shm = shared_memory.SharedMemory(name=nombre, track=False)
+            except TypeError:
+                # Python < 3.13: el resource_tracker borraría el segmento al salir este worker
+                from multiprocessing import resource_tracker
+                shm = shared_memory.SharedMemory(name=nombre)
+                resource_tracker.unregister(shm._name, "shared_memory")
+        except FileNotFoundError:
+            return None
+        cab_i = np.ndarray((32,), np.int64, buffer=shm.buf)
+        listo = int(cab_i[cls.I_MAGIA]) == cls.MAGIA and int(cab_i[cls.I_VERSION]) == cls.VERSION
+        del cab_i
+        if not listo:
+            shm.close()
+            return None
+        return cls(shm, escritor=False)
+
+    def cerrar(self):
+        del self.cab_i, self.cab_f, self.seqs, self.valores, self.epochs, self.filtrada, self.msg_meta, self.msg_datos
+        self.shm.close()
+        if self.escritor:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    @property
+    def escritas(self) -> int:
+        return int(self.cab_i[self.I_ESCRITAS])
+
+    @property
+    def fs(self) -> float:
+        return float(self.cab_f[self.F_FS])
+
+    # --- escritor ---
+
+    def escribir(self, seq0: int, vals: np.ndarray, filt: np.ndarray = None, t0: float = None):
+        n = len(vals)
+        if n == 0:
+            return
+        if n > self.capacidad:
+            vals = vals[-self.capacidad:]
+            filt = None if filt is None else filt[-self.capacidad:]
+            t0 = None if t0 is None else t0 + (n - self.capacidad) / FS
+            seq0 += n - self.capacidad
+            n = self.capacidad
+        if vals.dtype.kind == "f" and not self.cab_i[self.I_FLOTANTE] and not np.all(np.mod(vals, 1) == 0):
+            self.cab_i[self.I_FLOTANTE] = 1
+        escritas = self.escritas
+        fin = escritas + n
+        self.cab_i[self.I_RESERVA] = fin
+        pos = escritas % self.capacidad
+        idx = (pos + np.arange(n)) % self.capacidad if pos + n > self.capacidad else slice(pos, pos + n)
+        self.seqs[idx] = np.arange(seq0, seq0 + n)
+        self.valores[idx] = vals
+        self.filtrada[idx] = np.nan if filt is None else filt
+        self.epochs[idx] = (time.time() if t0 is None else t0) + np.arange(n) / FS
+        self.cab_i[self.I_ESCRITAS] = fin
+        self.cab_f[self.F_LATIDO] = time.time()
+
+    def publicar_bpm(self, bpm: int, t: float):
+        self.cab_i[self.I_BPM_GEN] += 1
+        self.cab_i[self.I_BPM] = int(bpm)
+        self.cab_f[self.F_BPM_T] = t
+        self.cab_i[self.I_BPM_GEN] += 1
+
+    def publicar_db(self, nombre: str):
+        datos = nombre.encode("utf-8")[:self.DB_MAX]
+        self.cab_i[self.I_DB_GEN] += 1
+        self.shm.buf[self.DB_OFF:self.DB_OFF + len(datos)] = datos
+        self.cab_i[self.I_DB_LEN] = len(datos)
+        self.cab_i[self.I_DB_GEN] += 1
+
+    def publicar_mensaje(self, canal: int, texto: str, peso: int = 1) -> bool:
+        """
+        Agrega un mensaje al anillo de mensajes; False si no entra en un slot.
+        peso es lo que cuenta el cliente WS al descartarlo (latidos del lote).
+        """
+        datos = texto.encode("utf-8")
+        if len(datos) > self.msg_bytes:
+            return False
+        with self._lock_msg:
+            n = int(self.cab_i[self.I_MSG_ESCRITOS])
+            i = n % self.msg_slots
+            self.cab_i[self.I_MSG_RESERVA] = n + 1
+            self.msg_datos[i, :len(datos)] = np.frombuffer(datos, np.uint8)
+            self.msg_meta[i] = (canal, len(datos), peso)
+            self.cab_i[self.I_MSG_ESCRITOS] = n + 1
+        return True
+
+    # --- lectores ---
+
+    def _consistente(self, i_gen: int, leer):
+        for _ in range(100):
+            g = int(self.cab_i[i_gen])
+            if g % 2:
+                continue
+            valor = leer()
+            if int(self.cab_i[i_gen]) == g:
+                return valor
+        return None
+
+    def leer_bpm(self):
+        """
+        (bpm, epoch) del último BPM publicado, o None.
+        """
+        valor = self._consistente(self.I_BPM_GEN, lambda: (int(self.cab_i[self.I_BPM]), float(self.cab_f[self.F_BPM_T])))
+        return None if valor is None or valor[0] < 0 else valor
+
+    def leer_db(self) -> str:
+        return self._consistente(self.I_DB_GEN, lambda: bytes(
+            self.shm.buf[self.DB_OFF:self.DB_OFF + int(self.cab_i[self.I_DB_LEN])]).decode("utf-8", "replace"))
+
+    def leer_desde(self, pos: int):
+        """
+        Muestras en las posiciones lógicas [pos, ESCRITAS): devuelve
+        (posición inicial, seqs, valores, filtrada, epochs). Si el escritor
+        ya pisó parte de lo pedido, se empieza por lo más antiguo disponible
+        (posición inicial > pos: el lector se atrasó más que la capacidad).
+        """
+        for _ in range(5):
+            fin = self.escritas
+            ini = max(pos, fin - self.capacidad)
+            n = fin - ini
+            i = ini % self.capacidad
+            if i + n <= self.capacidad:
+                datos = tuple(a[i:i + n].copy() for a in (self.seqs, self.valores, self.filtrada, self.epochs))
+            else:
+                j = i + n - self.capacidad
+                datos = tuple(np.concatenate((a[i:], a[:j])) for a in (self.seqs, self.valores, self.filtrada, self.epochs))
+            if int(self.cab_i[self.I_RESERVA]) - self.capacidad <= ini:
+                seqs, vals, filt, t = datos
+                if not self.cab_i[self.I_FLOTANTE]:
+                    vals = vals.astype(np.int32)
+                return ini, seqs, vals, filt, t
+            pos = fin - self.capacidad // 2  # atrasado: saltar a la mitad reciente
+        return self.escritas, np.zeros(0, np.int64), np.zeros(0, np.int32), np.zeros(0, np.float32), np.zeros(0)
+
+    @property
+    def mensajes_escritos(self) -> int:
+        return int(self.cab_i[self.I_MSG_ESCRITOS])
+
+    def leer_mensajes(self, pos: int):
+        """
+        Mensajes en las posiciones [pos, MSG_ESCRITOS): devuelve (posición
+        inicial, posición siguiente, [(canal, texto, peso)]). Los que el
+        escritor pisó antes o durante la copia se saltan.
+        """
+        fin = self.mensajes_escritos
+        ini = max(pos, fin - self.msg_slots)
+        mensajes = []
+        for k in range(ini, fin):
+            i = k % self.msg_slots
+            canal, largo, peso = self.msg_meta[i].tolist()
+            datos = bytes(self.msg_datos[i, :max(0, min(largo, self.msg_bytes))])
+            if int(self.cab_i[self.I_MSG_RESERVA]) - self.msg_slots > k:
+                continue
+            mensajes.append((canal, datos.decode("utf-8", "replace"), peso))
+        return ini, fin, mensajes
+
+    def estado(self) -> dict:
+        latido = float(self.cab_f[self.F_LATIDO])
+        return {
+            "name": self.shm.name,
+            "role": "writer" if self.escritor else "reader",
+            "writer_pid": int(self.cab_i[self.I_PID]),
+            "instance": self.instancia,
+            "capacity": self.capacidad,
+            "fs": self.fs,
+            "written": self.escritas,
+            "messages": self.mensajes_escritos,
+            "last_write_age_s": round(time.time() - latido, 3) if latido else None,
+            "db": self.leer_db(),
+        }
+
+def _pid_vivo(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+_anillo_shm = None   # AnilloCompartido (escritor en "process", lector en "attach")
+_shm_stats = {"pid": os.getpid(), "attached": False, "position": 0, "read_samples": 0,
+              "skipped_samples": 0, "msg_position": 0, "read_messages": 0, "skipped_messages": 0,
+              "reattaches": 0, "error": None, "bpm_t": None}
+
+def _shm_sincronizar():
+    """
+    Worker "attach": copia lo nuevo del anillo compartido a datos_ecg y a
+    los clientes WS de este worker (muestras, predicciones y HRV), y
+    actualiza el BPM. Corre en el loop.
+    """
+    global _last_bpm, _last_bpm_ts
+
+    anillo = _anillo_shm
+    ini, seqs, vals, filt, t = anillo.leer_desde(_shm_stats["position"])
+    _shm_stats["skipped_samples"] += ini - _shm_stats["position"]
+    _shm_stats["position"] = ini + len(seqs)
+    _shm_stats["read_samples"] += len(seqs)
+    if len(seqs):
+        # Un bloque por tramo de seq contiguo (un hueco es una pérdida en la adquisición)
+        cortes = np.flatnonzero(np.diff(seqs) != 1) + 1
+        for a, b in zip(np.r_[0, cortes].tolist(), np.r_[cortes, len(seqs)].tolist()):
+            f = filt[a:b]
+            f = None if np.all(np.isnan(f)) else f
+            datos_ecg.escribir(int(seqs[a]), vals[a:b], f, float(t[a]))
+            if ws_clients:
+                _ws_encolar((int(seqs[a]), vals[a:b].tolist(),
+                             None if f is None else np.round(f.astype(np.float64), 3).tolist(), float(t[a])))
+    ini, fin, mensajes = anillo.leer_mensajes(_shm_stats["msg_position"])
+    _shm_stats["skipped_messages"] += ini - _shm_stats["msg_position"] + (fin - ini - len(mensajes))
+    _shm_stats["msg_position"] = fin
+    _shm_stats["read_messages"] += len(mensajes)
+    for canal, texto, peso in mensajes:
+        clientes = ws_pred_clients if canal == AnilloCompartido.CANAL_PRED else ws_hrv_clients
+        for cliente in list(clientes.values()):
+            cliente.encolar(texto, peso)
+    bpm = anillo.leer_bpm()
+    if bpm is not None and bpm[1] != _shm_stats["bpm_t"]:
+        _shm_stats["bpm_t"] = bpm[1]
+        _last_bpm = bpm[0]
+        _last_bpm_ts = _timestamps_bloque(bpm[1], 1)[0]
+
+async def _shm_lector():
+    """
+    Worker "attach": se adjunta al anillo (reintentando hasta que el
+    proceso de adquisición lo cree) y lo sondea cada SHM_POLL_MS. Si la
+    adquisición se reinicia con un segmento nuevo, se vuelve a adjuntar.
+    """
+    global _anillo_shm, datos_ecg, _last_bpm, _last_bpm_ts
+
+    proximo_chequeo = 0.0
+    while not _stop_event.is_set():
+        ahora = time.monotonic()
+        # Sin escrituras recientes puede que la adquisición se haya reiniciado
+        quieto = _anillo_shm is None or time.time() - float(_anillo_shm.cab_f[AnilloCompartido.F_LATIDO]) > 1.0
+        if quieto and ahora >= proximo_chequeo:
+            proximo_chequeo = ahora + 1.0
+            nuevo = AnilloCompartido.adjuntar(SHM_NAME)
+            if nuevo is not None and (_anillo_shm is None or nuevo.instancia != _anillo_shm.instancia):
+                if nuevo.fs != FS:
+                    _shm_stats["error"] = f"FS de la adquisición ({nuevo.fs:g}) != FS ({FS:g})"
+                    nuevo.cerrar()
+                    nuevo = None
+                else:
+                    if _anillo_shm is not None:
+                        _anillo_shm.cerrar()
+                        _shm_stats["reattaches"] += 1
+                        # La adquisición se reinició y seq vuelve a empezar: como un arranque
+                        datos_ecg = BufferMuestras(datos_ecg.capacidad)
+                        _last_bpm = _last_bpm_ts = None
+                    _anillo_shm, nuevo = nuevo, None
+                    _shm_stats.update(attached=True, position=max(0, _anillo_shm.escritas - _anillo_shm.capacidad),
+                                      msg_position=_anillo_shm.mensajes_escritos, error=None, bpm_t=None)
+            if nuevo is not None:
+                nuevo.cerrar()
+        if _anillo_shm is not None:
+            try:
+                _shm_sincronizar()
+            except Exception as e:
+                _shm_stats["error"] = str(e)
+        await asyncio.sleep(SHM_POLL_MS / 1000.0)
+
+def estado_shm() -> dict:
+    anillo = _anillo_shm
+    return {"mode": ACQ_MODE, **(anillo.estado() if anillo is not None else {}),
+            **(_shm_stats if ACQ_MODE == "attach" else {})}
+
+# ---------------------- Segmentación de latidos ----------------------
+
+_anillo_latidos = BufferAnillo(int(BEAT_RING_SECS * FS), np.float32)
+
+def remuestrear_latido(ventana: np.ndarray, fs: float) -> np.ndarray:
+    """
+    Lleva una ventana a MODEL_INPUT muestras a MODEL_FS (interpolación
+    lineal; el filtro en streaming ya limitó la banda por debajo de Nyquist).
+    """
+    if fs == MODEL_FS and len(ventana) == MODEL_INPUT:
+        return ventana.astype(np.float32)
+    t = np.arange(MODEL_INPUT) / MODEL_FS
+    return np.interp(t, np.arange(len(ventana)) / fs, ventana).astype(np.float32)
+
+def preparar_latido(latido: np.ndarray, rr_ms: float = None) -> np.ndarray:
+    """
+    Formato de los latidos de entrenamiento: normalizado 0..1 y con ceros
+    a partir de 1.2 RR desde la R.
+    """
+    x = np.asarray(latido, dtype=np.float64)
+    rango = float(x.max() - x.min()) or 1.0
+    x = (x - x.min()) / rango
+    if rr_ms:
+        corte = int(round(BEAT_PRE_S * MODEL_FS + 1.2 * rr_ms / 1000.0 * MODEL_FS))
+        x[max(1, corte):] = 0.0
+    return x
+
+def segmentar_latidos(senal: np.ndarray, seq0: int):
+    """
+    Escribe el bloque en el buffer circular y corta una ventana fija
+    (BEAT_PRE_S antes de la R, MODEL_INPUT / MODEL_FS segundos) por cada R
+    nueva de _picos_r en cuanto está completa. Los latidos se guardan en la
+    tabla beats y se encolan para inferencia.
+    """
+    global _seg_ultimo_r
+
+    _anillo_latidos.escribir(seq0, senal)
+    pre = int(round(BEAT_PRE_S * FS))
+    largo = int(np.ceil(MODEL_INPUT * FS / MODEL_FS))
+
+    latidos = []  # [(r, t_r, rr_ms, latido)]
+    r_prev = None
+    for r, t_r in list(_picos_r):
+        if r > _seg_ultimo_r:
+            if r - pre + largo > _anillo_latidos.fin:
+                break
+            _seg_ultimo_r = r
+            ventana = _anillo_latidos.leer(r - pre, r - pre + largo)
+            if ventana is None:
+                _seg_stats["missed"] += 1
+            else:
+                rr = None if r_prev is None else (r - r_prev) / FS
+                rr_ms = int(round(rr * 1000)) if rr is not None and RR_MIN <= rr <= RR_MAX else None
+                latidos.append((r, t_r, rr_ms, remuestrear_latido(ventana, FS)))
+        r_prev = r
+    if not latidos:
+        return
+    _seg_stats["beats"] += len(latidos)
+
+    if activar_escritura:
+        _db_encolar(("beats", [
+            (SESSION_ID, r, int(round(t_r * 1e9)), rr_ms, float(MODEL_FS), latido.astype("<f4").tobytes())
+            for r, t_r, rr_ms, latido in latidos
+        ]))
+    if INFER_ENABLED and _modelo["state"] == "ready":
+        X = np.vstack([preparar_latido(latido, rr_ms) for _, _, rr_ms, latido in latidos])
+        metas = [{"seq": r, "session": SESSION_ID, "timestamp": _timestamps_bloque(t_r, 1)[0]}
+                 for r, t_r, _, _ in latidos]
+        inferencia_encolar(X, metas)
+
+def leer_latidos(conn, session: str = None, since: int = None, limit: int = None, lote: int = 1024):
+    """
+    Lee latidos guardados por lotes, en orden (sesión, r_seq): alimentación
+    por lotes para inferencia o exportación. Genera (filas, X) con
+    filas = [(session_id, r_seq, t_epoch_ns, rr_ms, class)] y X (n, MODEL_INPUT).
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='beats';").fetchone() is None:
+        return
+    sql = "SELECT session_id, r_seq, t_epoch_ns, rr_ms, class, blob FROM beats"
+    cond, params = [], []
+    if session is not None:
+        cond.append("session_id = ?")
+        params.append(session)
+    if since is not None:
+        cond.append("r_seq > ?")
+        params.append(since)
+    if cond:
+        sql += " WHERE " + " AND ".join(cond)
+    sql += " ORDER BY session_id, r_seq"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    cur = conn.execute(sql, params)
+    while True:
+        rows = cur.fetchmany(lote)
+        if not rows:
+            break
+        X = np.frombuffer(b"".join(r[5] for r in rows), dtype="<f4").reshape(len(rows), MODEL_INPUT)
+        yield [r[:5] for r in rows], X
+
+# ---------------------- Predicciones en archivo (caché) ----------------------
+
+# PREDICT_OUTPUT_CSV parseado una vez por versión del archivo (mtime, tamaño, inodo)
+_pred_csv_cache = None
+_pred_csv_lock = threading.Lock()
+
+def _csv_numeros_json(texto: str) -> bool:
+    """
+    True si todos los campos del CSV son literales numéricos válidos en
+    JSON (sin nan/inf, '.5', '5.', '+1' ni ceros a la izquierda): así se
+    pueden copiar tal cual al cuerpo JSON sin volver a formatear floats.
+    Vectorizado sobre los bytes.
+    """
+    b = np.frombuffer(("\n" + texto + "\n").encode(), dtype=np.uint8)
+    digito = (b >= 48) & (b <= 57)
+    sep = (b == 44) | (b == 10) | (b == 13)
+    punto, menos, mas = b == 46, b == 45, b == 43
+    e = (b | 32) == 101
+    if not np.all(digito | sep | punto | menos | mas | e):
+        return False
+    # '.' entre dígitos; '+' sólo en el exponente
+    if np.any(punto[1:-1] & ~(digito[:-2] & digito[2:])) or np.any(mas[1:] & ~e[:-1]):
+        return False
+    # Ceros a la izquierda: '0' seguido de dígito al inicio del número (o tras el signo)
+    inicio = sep[:-2] | (menos[:-2] & np.r_[True, sep[:-3]])
+    return not np.any((b[1:-1] == 48) & digito[2:] & inicio)
+
+def _parsear_predicciones_csv(ruta: str):
+    """
+    Lee el CSV en columnas tipadas (ndarray int64 si todos los valores son
+    enteros, float64 si son numéricos, lista de texto si no).
+    Si todo es numérico y JSON-válido, arma además el cuerpo por filas
+    directamente desde el texto. Devuelve (nombres, columnas, cuerpo | None).
+    """
+    with open(ruta, newline="", encoding="utf-8") as f:
+        texto = f.read()
+    lineas = texto.splitlines()
+    nombres = next(csv.reader(lineas[:1]), [])
+    filas = [l for l in lineas[1:] if l]
+
+    try:
+        datos = np.loadtxt(filas, delimiter=",", ndmin=2, dtype=np.float64) if filas else np.empty((0, len(nombres)))
+        if datos.shape[1] != len(nombres):
+            raise ValueError("columnas inconsistentes")
+        crudas = list(datos.T)
+    except ValueError:
+        # Hay texto: ruta lenta con csv, columna por columna
+        valores = list(csv.reader(filas))
+        crudas = []
+        for col in (zip(*valores) if valores else [()] * len(nombres)):
+            try:
+                crudas.append(np.asarray(col, dtype=np.float64))
+            except ValueError:
+                crudas.append(list(col))
+        datos = None
+
+    columnas = []
+    for col in crudas:
+        if isinstance(col, np.ndarray) and len(col) and np.all(np.isfinite(col)) and np.all(col == np.round(col)):
+            col = col.astype(np.int64)
+        columnas.append(col)
+
+    cuerpo = None
+    if datos is not None and _csv_numeros_json("\n".join(filas)):
+        plantilla = "{" + ",".join(json.dumps(n) + ":%s" for n in nombres) + "}"
+        cuerpo = ("[" + ",".join(plantilla % tuple(l.split(",")) for l in filas) + "]").encode()
+    return nombres, columnas, cuerpo
+
+def cargar_predicciones_csv(ruta: str = None) -> dict:
+    """
+    Devuelve el CSV de predicciones parseado, desde caché mientras el
+    archivo no cambie. Los cuerpos JSON se generan una vez por formato.
+    """
+    global _pred_csv_cache
+
+    ruta = ruta or PREDICT_OUTPUT_CSV
+    st = os.stat(ruta)
+    clave = (ruta, st.st_mtime_ns, st.st_size, st.st_ino)
+    with _pred_csv_lock:
+        if _pred_csv_cache is not None and _pred_csv_cache["key"] == clave:
+            return _pred_csv_cache
+        nombres, columnas, cuerpo_filas = _parsear_predicciones_csv(ruta)
+        _pred_csv_cache = {
+            "key": clave,
+            "version": f"{st.st_mtime_ns:x}-{st.st_size:x}-{st.st_ino:x}",
+            "mtime": st.st_mtime,
+            "last_modified": formatdate(st.st_mtime, usegmt=True),
+            "columns": nombres,
+            "data": columnas,
+            "rows": len(columnas[0]) if columnas else 0,
+            "bodies": {} if cuerpo_filas is None else {(False, "rows"): cuerpo_filas},
+        }
+        return _pred_csv_cache
+
+def cuerpo_predicciones_csv(cache: dict, envoltura: bool, layout: str) -> bytes:
+    """
+    JSON precalculado: layout "rows" (lista de objetos, formato histórico)
+    o "columns" ({"columns": [...], "data": {columna: [...]}}); con
+    envoltura se añade {"ok": true, "predictions": ...} como /sendPrediction.
+    """
+    clave = (envoltura, layout)
+    cuerpo = cache["bodies"].get(clave)
+    if cuerpo is not None:
+        return cuerpo
+    if envoltura:
+        interno = cuerpo_predicciones_csv(cache, False, layout)
+        if layout == "columns":
+            cuerpo = b'{"ok":true,' + interno[1:]
+        else:
+            cuerpo = b'{"ok":true,"predictions":' + interno + b"}"
+    else:
+        nombres = cache["columns"]
+        columnas = []
+        for c in cache["data"]:
+            if isinstance(c, np.ndarray):
+                # nan/inf no existen en JSON: se envían como null
+                c = c.tolist() if c.dtype.kind != "f" or np.all(np.isfinite(c)) else \
+                    np.where(np.isfinite(c), c, None).tolist()
+            columnas.append(c)
+        if layout == "columns":
+            contenido = {"columns": nombres, "data": dict(zip(nombres, columnas))}
+        else:
+            contenido = [dict(zip(nombres, fila)) for fila in zip(*columnas)]
+        cuerpo = json.dumps(contenido, separators=(",", ":")).encode()
+    cache["bodies"][clave] = cuerpo
+    return cuerpo
+
+def _no_modificado(request, etag: str, mtime: float) -> bool:
+    """
+    GET condicional: If-None-Match manda; si no viene, If-Modified-Since.
+    """
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        return etag in [e.strip().removeprefix("W/") for e in inm.split(",")] or inm.strip() == "*"
+    ims = request.headers.get("if-modified-since")
+    if ims:
+        try:
+            return int(mtime) <= parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+# ---------------------- Señal de prueba ----------------------
+
+# Ondas de un latido como gaussianas: (amplitud relativa a R, centro en s
+# respecto a la R, ancho en s). El centro de T escala con sqrt(RR).
+ONDAS_NORMAL = ((0.15, -0.20, 0.025), (-0.10, -0.025, 0.010), (1.00, 0.0, 0.012),
+                (-0.25, 0.030, 0.012), (0.30, 0.25, 0.060))
+# Ventricular prematuro: sin P, QRS ancho y T invertida
+ONDAS_VENTRICULAR = ((-0.15, -0.04, 0.02), (1.30, 0.0, 0.035), (-0.40, 0.07, 0.03),
+                     (-0.35, 0.30, 0.08))
+
+class GeneradorECG:
+    """
+    ECG sintético por bloques, vectorizado, con verdad de referencia.
+    Cada canal tiene su propia serie de latidos: RR ~ N(60/hr, hrv_ms),
+    con probabilidad 'ectopic' un latido ventricular prematuro (60 % del
+    RR) seguido de pausa compensatoria. Encima, deriva de línea base,
+    red y ruido. Las R generadas quedan en 'latidos' (seq, rr_ms, tipo),
+    con rr_ms el RR que precede a esa R (None en la primera).
+    shape="sine" da la senoide de siempre (freq, amp, offset).
+    """
+
+    def __init__(self, fs: float, shape="ecg", amp=800, offset=0, freq=1.0, hr=72.0, hrv_ms=40.0,
+                 noise=0.02, drift=0.1, mains=0.0, ectopic=0.0, channels=1, seed=None, **_):
+        self.fs = float(fs)
+        self.shape = shape
+        self.amp, self.offset, self.freq = float(amp), float(offset), float(freq)
+        self.hr, self.hrv_s = max(20.0, float(hr)), max(0.0, float(hrv_ms)) / 1000.0
+        self.noise, self.drift, self.mains, self.ectopic = float(noise), float(drift), float(mains), float(ectopic)
+        self.canales = max(1, int(channels))
+        self.rng = np.random.default_rng(seed)
+        self.n = 0  # muestras generadas por canal
+        # Por canal: latidos pendientes [(t_R, rr previo, ventricular)], la
+        # próxima R (tiempo, RR que la precede, si es prematura) y la pausa
+        # compensatoria que sigue a una prematura
+        self._pendientes = [deque() for _ in range(self.canales)]
+        self._t_sig = [float(self.rng.uniform(0.1, 0.6)) for _ in range(self.canales)]
+        self._rr_sig = [None] * self.canales
+        self._v_sig = [False] * self.canales
+        self._compensar = [0.0] * self.canales
+        self._fase_deriva = self.rng.uniform(0, 2 * np.pi, self.canales)
+        self.latidos = deque(maxlen=256)  # canal 0: (seq de la R, rr_ms, "N" | "V")
+
+    def _planificar(self, c: int, hasta: float):
+        """
+        Agrega a los pendientes del canal c los latidos con R antes de 'hasta'.
+        """
+        rr_medio = 60.0 / self.hr
+        while self._t_sig[c] < hasta:
+            t, rr_prev, ventricular = self._t_sig[c], self._rr_sig[c], self._v_sig[c]
+            self._pendientes[c].append((t, rr_prev or rr_medio, ventricular))
+            if c == 0:
+                self.latidos.append((int(round(t * self.fs)),
+                                     round(rr_prev * 1000.0, 1) if rr_prev else None,
+                                     "V" if ventricular else "N"))
+            # La R siguiente: tras una prematura va la pausa compensatoria;
+            # si no, con probabilidad 'ectopic' la siguiente llega al 60 % del RR
+            if self._compensar[c]:
+                rr, prematura = self._compensar[c], False
+                self._compensar[c] = 0.0
+            else:
+                rr = float(np.clip(self.rng.normal(rr_medio, self.hrv_s), RR_MIN, RR_MAX))
+                prematura = self.ectopic > 0 and self.rng.random() < self.ectopic
+                if prematura:
+                    rr, self._compensar[c] = 0.6 * rr, 1.4 * rr
+            self._t_sig[c], self._rr_sig[c], self._v_sig[c] = t + rr, rr, prematura
+
+    def _canal(self, c: int, t: np.ndarray) -> np.ndarray:
+        t_ini, t_fin = t[0], t[-1]
+        self._planificar(c, t_fin + 0.3)
+        pendientes = self._pendientes[c]
+        # Un latido influye desde ~0.3 s antes de su R hasta ~0.6 s después
+        while pendientes and pendientes[0][0] < t_ini - 0.8:
+            pendientes.popleft()
+        centros, anchos, amps = [], [], []
+        for t_r, rr, ventricular in pendientes:
+            if t_r - 0.3 > t_fin:
+                break
+            escala_t = np.sqrt(rr / (60.0 / 72.0))
+            for a, dt, w in (ONDAS_VENTRICULAR if ventricular else ONDAS_NORMAL):
+                centros.append(t_r + (dt * escala_t if dt > 0.1 else dt))
+                anchos.append(w)
+                amps.append(a)
+        x = np.zeros_like(t)
+        if centros:
+            centros, anchos, amps = np.asarray(centros), np.asarray(anchos), np.asarray(amps)
+            x = (amps[:, None] * np.exp(-0.5 * ((t[None, :] - centros[:, None]) / anchos[:, None]) ** 2)).sum(axis=0)
+        if self.drift:
+            x += self.drift * np.sin(2 * np.pi * 0.25 * t + self._fase_deriva[c])
+        if self.mains and FILTER_NOTCH_HZ:
+            x += self.mains * np.sin(2 * np.pi * FILTER_NOTCH_HZ * t)
+        if self.noise:
+            x += self.rng.normal(0.0, self.noise, t.size)
+        return x
+
+    def bloque(self, n: int) -> np.ndarray:
+        """
+        Las próximas n muestras en cuentas int32: (n,) con un canal,
+        (canales, n) con varios.
+        """
+        t = (self.n + np.arange(n)) / self.fs
+        self.n += n
+        if self.shape == "sine":
+            x = np.sin(2 * np.pi * self.freq * t)[None, :].repeat(self.canales, axis=0)
+        else:
+            x = np.stack([self._canal(c, t) for c in range(self.canales)])
+        cuentas = np.clip(np.round(self.offset + self.amp * x), -0x800000, 0x7FFFFF).astype(np.int32)
+        return cuentas[0] if self.canales == 1 else cuentas
+
+    def bpm_verdad(self, ultimos: int = 8):
+        """
+        BPM de referencia del canal 0: media de los últimos RR ya
+        transcurridos (los que terminan en una R anterior a la muestra actual).
+        """
+        rr = [r for seq, r, _ in self.latidos if seq < self.n and r is not None][-ultimos:]
+        return round(60000.0 / (sum(rr) / len(rr)), 1) if rr else None
+
+_generador = None       # GeneradorECG activo (se rehace en cada /test_signal)
+_test_state = {"next_t": None, "seq0": None}
+
+def _senal_prueba_bloque():
+    """
+    Genera un bloque de la señal de prueba y espera hasta su hora: el ritmo
+    se lleva por bloque (FS / TEST_BLOCKS_PER_SEC muestras), no por muestra.
+    Si el proceso se atrasa más de 1 s se re-sincroniza en vez de ponerse
+    al día de golpe.
+    """
+    global _generador
+    if _generador is None or _generador.fs != FS:
+        _generador = GeneradorECG(FS, **_test_cfg)
+    n = max(1, int(FS // TEST_BLOCKS_PER_SEC))
+    ahora = time.perf_counter()
+    objetivo = _test_state["next_t"]
+    if objetivo is None or ahora - objetivo > 1.0:
+        objetivo = ahora
+    elif objetivo > ahora:
+        time.sleep(objetivo - ahora)
+    _test_state["next_t"] = objetivo + n / FS
+    vals = _generador.bloque(n)
+    if vals.ndim > 1:
+        vals = vals[0]  # el pipeline es de un canal
+    seq0, t0 = _reloj.asignar(n)
+    if _test_state["seq0"] is None:
+        _test_state["seq0"] = seq0 - (_generador.n - n)
+    _process_block(vals, seq0, t0)
+
+def estado_senal_prueba() -> dict:
+    """
+    Configuración, BPM de referencia y las últimas R generadas (con el seq
+    del pipeline) para contrastar con /bpm y /peaks.
+    """
+    g = _generador
+    if not _test_cfg["enabled"] or g is None:
+        return {**_test_cfg}
+    base = _test_state["seq0"] or 0
+    return {
+        **_test_cfg,
+        "true_bpm": g.bpm_verdad() if g.shape == "ecg" else None,
+        "true_beats": [{"seq": base + seq, "rr_ms": rr, "type": tipo}
+                       for seq, rr, tipo in list(g.latidos)[-10:] if seq < g.n],
+    }
+
+# ---------------------- Reproducción de grabaciones ----------------------
+
+_replay = {
+    "active": False,
+    "id": 0,              # cambia en cada /replay/start: el lector reabre la fuente
+    "name": None,
+    "speed": 1.0,         # 1 = tiempo real, N = N veces, 0 = lo más rápido posible
+    "loop": False,
+    "start": None,        # epoch (s) o None
+    "end": None,
+    "fs": None,           # estimada de la grabación
+    "state": "idle",      # idle | running | finished | stopped | error
+    "samples": 0,
+    "gaps": 0,
+    "t_recording": None,  # instante original de la última muestra reproducida
+    "error": None,
+}
+_replay_iter = None      # generador abierto por el hilo lector
+_replay_ritmo = {"id": None, "t_pared": None, "t_grab": None}
+
+def _replay_csv(ruta: Path, ini_ns: int, fin_ns: int):
+    """
+    Lee un CSV "timestamp,value" (como el de /db/export, también .csv.gz)
+    por bloques de REPLAY_CSV_ROWS filas. timestamp puede ser epoch (s)
+    u hora local "YYYY-mm-dd HH:MM:SS.fff".
+    """
+    import gzip
+    abrir = gzip.open if ruta.name.lower().endswith(".gz") else open
+    with abrir(ruta, "rt", newline="") as f:
+        lector = csv.reader(f)
+        filas = []
+        for fila in lector:
+            if len(fila) < 2:
+                continue
+            filas.append(fila)
+            if len(filas) >= REPLAY_CSV_ROWS:
+                bloque = _replay_csv_bloque(filas, ini_ns, fin_ns)
+                filas = []
+                if bloque is not None:
+                    yield bloque
+        if filas:
+            bloque = _replay_csv_bloque(filas, ini_ns, fin_ns)
+            if bloque is not None:
+                yield bloque
+
+def _replay_csv_bloque(filas: list, ini_ns: int, fin_ns: int):
+    try:
+        float(filas[0][1])
+    except ValueError:
+        filas = filas[1:]  # cabecera
+    if not filas:
+        return None
+    ts, vals = zip(*((f[0], f[1]) for f in filas))
+    try:
+        t = np.asarray(ts, dtype=np.float64)
+    except ValueError:
+        t = _epoch_de_timestamps(list(ts))
+    t_ns = np.round(t * 1e9).astype(np.int64)
+    v = np.asarray(vals, dtype=np.float64)
+    if np.all(np.mod(v, 1) == 0):
+        v = v.astype(np.int32)
+    m = np.ones(len(t_ns), dtype=bool)
+    if ini_ns is not None:
+        m &= t_ns >= ini_ns
+    if fin_ns is not None:
+        m &= t_ns < fin_ns
+    if not m.any():
+        return None
+    return t_ns[m], v[m], None
+
+def _replay_fuente(ruta: Path, ini_ns: int, fin_ns: int):
+    """
+    Bloques (t_ns, valores, seq) en orden de tiempo, sin cargar el archivo:
+    en .db reusa la lectura de /db/export (fetchmany, una foto de la BD).
+    """
+    if ruta.suffix.lower() != ".db":
+        yield from _replay_csv(ruta, ini_ns, fin_ns)
+        return
+    conn = conectar_solo_lectura(ruta)
+    try:
+        conn.execute("BEGIN;")
+        yield from _export_bloques(conn, "ecg", "raw", ini_ns, fin_ns)
+    finally:
+        conn.close()
+
+def _replay_estimar_fs(ruta: Path, ini_ns: int, fin_ns: int):
+    """
+    FS de la grabación: mediana de los intervalos del primer bloque.
+    """
+    fuente = _replay_fuente(ruta, ini_ns, fin_ns)
+    try:
+        t_ns = next(fuente)[0]
+    except StopIteration:
+        return None
+    finally:
+        fuente.close()
+    if len(t_ns) < 2:
+        return None
+    return 1e9 / float(np.median(np.diff(t_ns)))
+
+def _replay_bloques(ruta: Path, ini_ns: int, fin_ns: int, fs: float, n: int):
+    """
+    Re-corta la fuente en bloques de n muestras como los del lector serial:
+    genera (t_ns de la última muestra, valores, muestras perdidas antes del
+    bloque). Los huecos de hasta REPLAY_GAP_SECS se reproducen como
+    pérdidas (dejan el hueco en seq); los mayores se saltan.
+    """
+    paso_ns = 1e9 / fs
+    t_prev = None
+    for t_ns, vals, _ in _replay_fuente(ruta, ini_ns, fin_ns):
+        huecos = np.round(np.diff(t_ns) / paso_ns).astype(np.int64) - 1
+        cortes = np.flatnonzero(huecos != 0) + 1
+        inicios = np.concatenate(([0], cortes))
+        finales = np.concatenate((cortes, [len(t_ns)]))
+        for a, b in zip(inicios.tolist(), finales.tolist()):
+            perdidas = 0
+            if t_prev is not None:
+                perdidas = int(round((t_ns[a] - t_prev) / paso_ns)) - 1
+                if perdidas < 0 or perdidas > REPLAY_GAP_SECS * fs:
+                    perdidas = 0
+            for i in range(a, b, n):
+                j = min(i + n, b)
+                yield int(t_ns[j - 1]), vals[i:j], perdidas
+                perdidas = 0
+            t_prev = t_ns[b - 1]
+
+def _replay_cerrar(estado: str = None):
+    global _replay_iter
+    if _replay_iter is not None:
+        _replay_iter.close()
+        _replay_iter = None
+    if estado:
+        _replay["state"] = estado
+
+def _replay_paso():
+    """
+    Un bloque de la grabación por el pipeline (desde el hilo lector),
+    esperando hasta su hora según 'speed'. Los huecos grandes de la
+    grabación no se esperan.
+    """
+    global _replay_iter
+    if _replay_iter is None or _replay_ritmo["id"] != _replay["id"]:
+        _replay_cerrar()
+        velocidad = _replay["speed"]
+        n = int(FS * REPLAY_MAX_BLOCK_SECS) if velocidad <= 0 else int(FS * velocidad // TEST_BLOCKS_PER_SEC)
+        n = max(1, min(n, int(FS * REPLAY_MAX_BLOCK_SECS)))
+        ini_ns = None if _replay["start"] is None else int(_replay["start"] * 1e9)
+        fin_ns = None if _replay["end"] is None else int(_replay["end"] * 1e9)
+        _replay_iter = _replay_bloques(DATA_DIR / _replay["name"], ini_ns, fin_ns, _replay["fs"], n)
+        _replay_ritmo.update(id=_replay["id"], t_pared=None, t_grab=None)
+        _replay["state"] = "running"
+    try:
+        t_ns, vals, perdidas = next(_replay_iter)
+    except StopIteration:
+        _replay_cerrar()
+        if not _replay["loop"]:
+            _replay["active"] = False
+            _replay["state"] = "finished"
+        return
+
+    velocidad = _replay["speed"]
+    t_grab = t_ns / 1e9
+    if velocidad > 0:
+        ahora = time.perf_counter()
+        t_pared, t_grab0 = _replay_ritmo["t_pared"], _replay_ritmo["t_grab"]
+        objetivo = None if t_pared is None else t_pared + (t_grab - t_grab0) / velocidad
+        if objetivo is None or objetivo - ahora > REPLAY_GAP_SECS or ahora - objetivo > 1.0:
+            # Arranque, hueco grande o atraso: se re-sincroniza el ritmo
+            _replay_ritmo.update(t_pared=ahora, t_grab=t_grab)
+        elif objetivo > ahora:
+            time.sleep(objetivo - ahora)
+
+    if perdidas:
+        _replay["gaps"] += 1
+    seq0, t0 = _reloj.asignar(len(vals), perdidas)
+    _process_block(vals, seq0, t0)
+    _replay["samples"] += len(vals)
+    _replay["t_recording"] = datetime.fromtimestamp(t_grab).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+# ---------------------- Autodetección de puerto ----------------------
+
+_KNOWN_IDS = {
+    (0x2341, 0x0043),  # Arduino Uno
+    (0x2341, 0x0001),  # Arduino (antiguo)
+    (0x2A03, 0x0043),  # Genuino/Arduino
+    (0x1A86, 0x7523),  # WCH CH340
+    (0x1A86, 0x5523),  # WCH CH340 variante
+    (0x0403, 0x6001),  # FTDI FT232
+    (0x10C4, 0xEA60),  # Silicon Labs CP210x
+}
+_KEYWORDS = ["arduino", "usb-serial", "ch340", "wch", "ftdi", "cp210", "nano"]
+_last_known_port = None
+
+def find_arduino_port(prefer=None):
+    ports = list(list_ports.comports())
+    if prefer:
+        for p in ports:
+            if p.device == prefer:
+                return prefer
+    for p in ports:
+        try:
+            if p.vid is not None and p.pid is not None:
+                if (p.vid, p.pid) in _KNOWN_IDS:
+                    return p.device
+        except Exception:
+            pass
+    for p in ports:
+        desc = f"{p.description} {p.manufacturer} {p.name}".lower()
+        if any(k in desc for k in _KEYWORDS):
+            return p.device
+    if ports:
+        return ports[0].device
+    return None
+
+# ---------------------- Serial 3B + reconexión / o Test Signal ----------------------
+
+_ser = None
+_stop_event = threading.Event()
+
+def _open_serial():
+    global _last_known_port
+    port = find_arduino_port(_last_known_port)
+    if port is None:
+        raise RuntimeError("No se encontró ningún puerto serie compatible.")
+    s = serial.Serial(port, BAUDRATE, timeout=SER_TIMEOUT)
+    _last_known_port = port
+    print(f"Conectado a {port} a {BAUDRATE} baudios.")
+    return s
+
+def _read_sample_24bit_be_signed(b0, b1, b2):
+    raw = (b0 << 16) | (b1 << 8) | b2
+    # if raw & 0x800000:
+    #     raw -= 0x1000000
+    return raw
+
+def _tramas_perdidas(basura: int) -> int:
+    """
+    Estimación de tramas perdidas a partir de los bytes descartados en una
+    resincronización (una trama con un byte de menos o de más cuenta como 1 o 0).
+    """
+    perdidas = (basura + FRAME_LEN // 2) // FRAME_LEN
+    _serial_stats["lost_samples"] += perdidas
+    return perdidas
+
+def decodificar_tramas(buf: bytearray) -> list:
+    """
+    Extrae todas las tramas completas (HDR + 3 bytes BE) presentes en 'buf'
+    y decodifica sus payloads en una sola pasada NumPy.
+    Consume de 'buf' los bytes procesados; la cola incompleta queda para
+    la siguiente lectura. Devuelve [(perdidas, valores int32), ...]: cada
+    resincronización abre un segmento nuevo precedido de las tramas que se
+    estiman perdidas (valores puede venir vacío si sólo hubo basura).
+    """
+    data = bytes(buf)
+    n = len(data)
+    pos = 0
+    segmentos = []
+    perdidas = 0
+
+    while True:
+        i = data.find(HDR, pos)
+        if i < 0:
+            # Conservar un 0xAA final: puede ser el inicio de un HDR partido
+            keep = 1 if n > pos and data[-1] == HDR[0] else 0
+            if n - keep > pos:
+                _serial_stats["resyncs"] += 1
+                _serial_stats["garbage_bytes"] += n - keep - pos
+                perdidas += _tramas_perdidas(n - keep - pos)
+            pos = n - keep
+            break
+        if i > pos:
+            _serial_stats["resyncs"] += 1
+            _serial_stats["garbage_bytes"] += i - pos
+            perdidas += _tramas_perdidas(i - pos)
+
+        m = (n - i) // FRAME_LEN
+        if m == 0:
+            pos = i
+            break
+
+        # Suponemos tramas alineadas desde i y validamos todos los HDR de golpe
+        tramas = np.frombuffer(data, dtype=np.uint8, count=m * FRAME_LEN, offset=i).reshape(m, FRAME_LEN)
+        ok = (tramas[:, 0] == HDR[0]) & (tramas[:, 1] == HDR[1])
+        k = m if ok.all() else int(np.argmin(ok))  # la primera siempre es válida
+
+        p = tramas[:k, 2:].astype(np.int32)
+        # Igual que _read_sample_24bit_be_signed: sin extensión de signo
+        vals = (p[:, 0] << 16) | (p[:, 1] << 8) | p[:, 2]
+        _serial_stats["frames"] += int(vals.size)
+        if segmentos and perdidas == 0:
+            segmentos[-1] = (segmentos[-1][0], np.concatenate((segmentos[-1][1], vals)))
+        else:
+            segmentos.append((perdidas, vals))
+        perdidas = 0
+        pos = i + k * FRAME_LEN
+        if k == m:
+            break
+        # HDR roto en medio del bloque: volver a buscar desde ahí
+
+    del buf[:pos]
+
+    if perdidas:
+        segmentos.append((perdidas, np.empty(0, dtype=np.int32)))
+    return segmentos
+
+# ---------------------- Reloj de muestras ----------------------
+
+class RelojMuestras:
+    """
+    Numera las muestras al decodificarlas: seq es monótono durante todo el
+    proceso y las tramas perdidas dejan un hueco. El instante de una muestra
+    es t_ancla + (seq - seq_ancla) / fs, no la hora a la que se procesó.
+    El ancla sigue a la llegada más temprana vista (una muestra no puede
+    llegar antes de existir) y se rehace si el desfase supera REANCHOR_SECS
+    (arranque, reconexión, pausa de la fuente o deriva del reloj del equipo).
+    """
+
+    def __init__(self, fs: float):
+        self.fs = fs
+        self.seq = 0              # seq de la próxima muestra
+        self.seq_ancla = None
+        self.t_ancla = None
+        self.stats = {
+            "samples": 0,
+            "lost_samples": 0,    # huecos de seq (tramas perdidas)
+            "late_samples": 0,    # llegaron más de LATE_MS después de su instante
+            "reanchors": 0,
+            "lag_ms": None,       # instante de muestreo -> llegada, último bloque
+            "max_lag_ms": 0.0,
+        }
+
+    def epoch(self, seq):
+        return self.t_ancla + (seq - self.seq_ancla) / self.fs
+
+    def asignar(self, n: int, perdidas: int = 0, t_llegada: float = None):
+        """
+        Reserva seq para un bloque de n muestras cuya última acaba de
+        llegar (t_llegada, por defecto ahora). Devuelve (seq0, t0).
+        """
+        if perdidas:
+            self.seq += perdidas
+            self.stats["lost_samples"] += perdidas
+        seq0 = self.seq
+        if n <= 0:
+            return seq0, None
+        self.seq += n
+        self.stats["samples"] += n
+        t_llegada = time.time() if t_llegada is None else t_llegada
+        ultima = seq0 + n - 1
+
+        if self.t_ancla is None:
+            self.seq_ancla, self.t_ancla = ultima, t_llegada
+        lag = t_llegada - self.epoch(ultima)
+        if lag > REANCHOR_SECS or lag < -REANCHOR_SECS:
+            self.stats["reanchors"] += 1
+            self.seq_ancla, self.t_ancla = ultima, t_llegada
+            lag = 0.0
+        elif lag < 0:
+            self.t_ancla += lag   # llegó antes de lo previsto: el ancla iba retrasada
+            lag = 0.0
+
+        lag_ms = lag * 1000.0
+        self.stats["lag_ms"] = round(lag_ms, 3)
+        self.stats["max_lag_ms"] = round(max(self.stats["max_lag_ms"], lag_ms), 3)
+        if lag_ms > LATE_MS:
+            self.stats["late_samples"] += n
+        return seq0, self.epoch(seq0)
+
+_reloj = RelojMuestras(FS)
+
+def _timestamps_bloque(t0: float, n: int, fs: float = None) -> list:
+    """
+    Timestamps "%Y-%m-%d %H:%M:%S.mmm" (hora local) de n muestras
+    consecutivas a fs (FS por defecto), empezando en t0 (epoch, s).
+    Formateo vectorizado.
+    """
+    base = np.datetime64(datetime.fromtimestamp(t0), "us")
+    offs = (np.arange(n) * (1e6 / (fs or FS))).astype("timedelta64[us]")
+    return [s.replace("T", " ") for s in np.datetime_as_string(base + offs, unit="ms").tolist()]
+
+def _process_block(values, seq0, t0):
+    """
+    Procesa un bloque de muestras consecutivas: buffer memoria, WS, BPM,
+    y DB por lotes. seq0 y t0 (epoch, s) son los de la primera muestra,
+    asignados por _reloj al decodificar.
+    """
+    vals = np.asarray(values)
+    n = vals.size
+    if n == 0:
+        return
+    t_bloque = time.perf_counter()
+    lista = vals.tolist()
+
+    # Filtro con estado; los consumidores reciben crudo y filtrado
+    filt = _filtro.procesar(vals, seq0) if _filtro is not None else None
+    lista_f = None if filt is None else np.round(filt, 3).tolist()
+
+    # Memoria para /ecg (y para los workers de la API en ACQ_MODE = "process")
+    datos_ecg.escribir(seq0, vals, filt, t0)
+    if _anillo_shm is not None:
+        _anillo_shm.escribir(seq0, vals, filt, t0)
+
+    # Empujar a WS (no bloqueante), un elemento por bloque
+    _ws_publicar((seq0, lista, lista_f, t0))
+
+    # BPM (sobre la señal filtrada si hay filtro)
+    senal = vals if filt is None else filt
+    t_bpm = time.perf_counter()
+    if HR_DETECTOR == "pan_tompkins":
+        bpm_new = detectar_bpm_pan_tompkins(senal, seq0, t0)
+    else:
+        bpm_new = detectar_bpm_sencillo(senal, t0, seq0)
+    _hist_bpm.observar(time.perf_counter() - t_bpm)
+    if bpm_new and _anillo_shm is not None:
+        _anillo_shm.publicar_bpm(bpm_new[-1][1], bpm_new[-1][2] / 1e9)
+
+    # Latidos: ventanas desde el buffer circular hacia la BD y la inferencia
+    if BEATS_ENABLED:
+        segmentar_latidos(senal, seq0)
+
+    # Escritura por lotes unificados en el hilo escritor (nunca bloquea)
+    if activar_escritura:
+        _db_encolar(("ecg", t0, vals, filt if FILTER_STORE else None, seq0))
+        if bpm_new:
+            _db_encolar(("bpm", [(ts, int(bpm), t_ns) for ts, bpm, t_ns in bpm_new]))
+    _hist_bloque.observar(time.perf_counter() - t_bloque)
+
+def _process_value(val):
+    """
+    Procesa un valor suelto (lector bytewise) como un bloque de 1 muestra.
+    """
+    seq0, t0 = _reloj.asignar(1)
+    _process_block([val], seq0, t0)
+
+def _read_exact(ser, n):
+    """
+    Lee exactamente n bytes o devuelve None si se agota el timeout.
+    """
+    data = bytearray()
+    while len(data) < n and not _stop_event.is_set():
+        chunk = ser.read(n - len(data))
+        if not chunk:  # timeout
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+def leer_desde_serial():
+    global _ser
+
+    rx_buf = bytearray()  # bytes pendientes entre lecturas (modo chunked)
+    while not _stop_event.is_set():
+        # Reproducción de una grabación en lugar del serial
+        if _replay["active"]:
+            try:
+                _replay_paso()
+            except Exception as e:
+                _replay.update(active=False, error=str(e))
+                _replay_cerrar("error")
+                print(f"Error reproduciendo {_replay['name']}: {e}")
+            continue
+        if _replay_iter is not None:
+            _replay_cerrar()
+
+        # Modo test: ECG sintético o senoide en lugar del serial
+        if _test_cfg["enabled"]:
+            try:
+                _senal_prueba_bloque()
+            except Exception as e:
+                print(f"Error generando señal de prueba: {e}")
+                time.sleep(RETRY_SECS)
+            continue
+
+        # Conexión/reconexión
+        if _ser is None or not (_ser.is_open if not callable(getattr(_ser, "is_open", None)) else _ser.is_open()):
+            try:
+                _ser = _open_serial()
+                rx_buf.clear()
+            except Exception as e:
+                print(f"No se pudo abrir puerto: {e}. Reintentando en {RETRY_SECS}s.")
+                time.sleep(RETRY_SECS)
+                continue
+
+        try:
+            while not _stop_event.is_set() and not (_test_cfg["enabled"] or _replay["active"]) and _ser and (_ser.is_open if not callable(getattr(_ser, "is_open", None)) else _ser.is_open()):
+
+                if SERIAL_MODE == "chunked":
+                    # Leer todo lo disponible (o esperar al menos 1 byte)
+                    chunk = _ser.read(_ser.in_waiting or 1)
+                    if not chunk:
+                        continue
+                    rx_buf.extend(chunk)
+                    t_llegada = time.time()  # la última muestra del bloque acaba de llegar
+                    for perdidas, vals in decodificar_tramas(rx_buf):
+                        seq0, t0 = _reloj.asignar(vals.size, perdidas, t_llegada)
+                        _process_block(vals, seq0, t0)
+                    continue
+
+                # 1) Buscar 0xAA
+                b = _read_exact(_ser, 1)
+                if b is None:
+                    continue
+                if b[0] != 0xAA:
+                    continue
+
+                # 2) Confirmar 0x55
+                b = _read_exact(_ser, 1)
+                if b is None or b[0] != 0x55:
+                    # si no es 0x55, volvemos a buscar header
+                    continue
+
+                # 3) Leer payload de 3 bytes (MSB, MID, LSB)
+                payload = _read_exact(_ser, 3)
+                if payload is None or len(payload) != 3:
+                    continue
+
+                msb, mid, lsb = payload[0], payload[1], payload[2]
+                val = _read_sample_24bit_be_signed(msb, mid, lsb)
+                _process_value(val)
+
+        except (serial.SerialException, OSError, ValueError) as e:
+            print(f"Error de lectura serial: {e}. Intentando reconectar en {RETRY_SECS}s.")
+            try:
+                if _ser and (_ser.is_open if not callable(getattr(_ser, "is_open", None)) else _ser.is_open()):
+                    _ser.close()
+            except Exception:
+                pass
+            _ser = None
+            time.sleep(RETRY_SECS)
+            continue
+        except Exception as e:
+            print(f"Lectura interrumpida por excepción: {e}. Intentando reconectar en {RETRY_SECS}s.")
+            try:
+                if _ser and (_ser.is_open if not callable(getattr(_ser, "is_open", None)) else _ser.is_open()):
+                    _ser.close()
+            except Exception:
+                pass
+            _ser = None
+            time.sleep(RETRY_SECS)
+            continue
+
+    # Cierre
+    try:
+        if _ser and (_ser.is_open if not callable(getattr(_ser, "is_open", None)) else _ser.is_open()):
+            _ser.close()
+    except Exception:
+        pass
+    print("Hilo de lectura finalizado.")
+
+# ---------------------- WebSocket: broadcaster ----------------------
+
+def _ws_encolar(item):
+    """
+    Corre en el loop: encola el bloque descartando el más antiguo si está llena.
+    """
+    if ws_queue.full():
+        viejo = ws_queue.get_nowait()[1]
+        _ws_stats["dropped_samples"] += len(viejo)
+    ws_queue.put_nowait(item)
+
+def _ws_publicar(item):
+    """
+    Entrega un bloque desde el hilo lector al loop de asyncio sin bloquear.
+    Sin clientes conectados no hay nada que hacer.
+    """
+    loop = _ws_loop
+    if loop is None or not ws_clients:
+        return
+    try:
+        loop.call_soon_threadsafe(_ws_encolar, item)
+    except RuntimeError:
+        pass  # loop cerrado (apagado)
+
+_ws_cliente_id = 0
+
+class _ClienteWS:
+    """
+    Cliente WS con su propia cola acotada y tarea de envío: un cliente
+    lento sólo se retrasa a sí mismo. Si su cola sigue llena más de
+    WS_SLOW_SECS, se le desconecta.
+    """
+
+    def __init__(self, ws: WebSocket, formato: str, stream: str = "raw"):
+        global _ws_cliente_id
+        _ws_cliente_id += 1
+        self.id = _ws_cliente_id   # etiqueta "client" en /metrics
+        self.ws = ws
+        self.formato = formato
+        self.stream = stream       # "raw" o "filtered"
+        self.cola = asyncio.Queue(maxsize=WS_CLIENT_QUEUE)
+        self.enviados = 0
+        self.descartados = 0       # muestras descartadas por cola llena
+        self.lag_ms = 0.0          # encolado -> enviado, último mensaje
+        self.max_lag_ms = 0.0
+        self.lleno_desde = None
+        self.tarea = None
+        self.hist_envio = Histograma()  # duración de send_* por mensaje
+
+    def encolar(self, msg, n: int):
+        ahora = time.monotonic()
+        if self.cola.full():
+            _, _, n_viejo = self.cola.get_nowait()
+            self.descartados += n_viejo
+            _ws_stats["client_dropped_samples"] += n_viejo
+            if self.lleno_desde is None:
+                self.lleno_desde = ahora
+            elif ahora - self.lleno_desde > WS_SLOW_SECS:
+                print(f"Cliente WS demasiado lento ({self.descartados} muestras descartadas). Desconectando.")
+                self.cerrar()
+                return
+        else:
+            self.lleno_desde = None
+        self.cola.put_nowait((msg, ahora, n))
+
+    async def enviar(self):
+        try:
+            while True:
+                msg, t_enc, _ = await self.cola.get()
+                t_envio = time.perf_counter()
+                if self.formato == "binary":
+                    await self.ws.send_bytes(msg)
+                else:
+                    await self.ws.send_text(msg)
+                self.hist_envio.observar(time.perf_counter() - t_envio)
+                self.enviados += 1
+                self.lag_ms = (time.monotonic() - t_enc) * 1000.0
+                self.max_lag_ms = max(self.max_lag_ms, self.lag_ms)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.cerrar()
+
+    def cerrar(self):
+        ws_clients.pop(self.ws, None)
+        ws_pred_clients.pop(self.ws, None)
+        ws_hrv_clients.pop(self.ws, None)
+        if self.tarea is not None and self.tarea is not asyncio.current_task():
+            self.tarea.cancel()
+        asyncio.ensure_future(self._cerrar_ws())
+
+    async def _cerrar_ws(self):
+        try:
+            await self.ws.close()
+        except Exception:
+            pass
+
+    def estado(self) -> dict:
+        return {
+            "format": self.formato,
+            "stream": self.stream,
+            "queue": self.cola.qsize(),
+            "sent": self.enviados,
+            "dropped_samples": self.descartados,
+            "lag_ms": round(self.lag_ms, 3),
+            "max_lag_ms": round(self.max_lag_ms, 3),
+        }
+
+def codificar_ws_binario(seq0: int, lote: list) -> bytes:
+    """
+    Mensaje binario: cabecera WS_BIN_HEADER + muestras empaquetadas.
+    int32 si todos los valores son enteros; si no, float32.
+    """
+    arr = np.asarray(lote)
+    if arr.dtype.kind in "iu" or (arr.dtype.kind == "f" and np.all(np.mod(arr, 1) == 0)):
+        dtype, datos = WS_DTYPE_INT32, arr.astype("<i4").tobytes()
+    else:
+        dtype, datos = WS_DTYPE_FLOAT32, arr.astype("<f4").tobytes()
+    return WS_BIN_HEADER.pack(seq0, len(lote), float(FS), dtype, WS_BIN_VERSION) + datos
+
+def _ws_difundir(lote_seq: int, lote: list, lote_f: list = None, lote_t0: float = None):
+    """
+    Codifica el lote una vez por formato y stream y lo deja en la cola de
+    cada cliente. Sin filtro activo, los clientes 'filtered' reciben el crudo.
+    Cuenta como tardías las muestras que salen más de LATE_MS después de
+    su instante de muestreo.
+    """
+    if lote_t0 is not None:
+        lag_ms = (time.time() - lote_t0 - (len(lote) - 1) / FS) * 1000.0
+        _ws_stats["lag_ms"] = round(lag_ms, 3)
+        if lag_ms > LATE_MS:
+            _ws_stats["late_samples"] += len(lote)
+    mensajes = {}
+    for cliente in list(ws_clients.values()):
+        datos = lote_f if cliente.stream == "filtered" and lote_f is not None else lote
+        clave = (cliente.formato, datos is lote)
+        msg = mensajes.get(clave)
+        if msg is None:
+            if cliente.formato == "binary":
+                msg = codificar_ws_binario(lote_seq, datos)
+            elif cliente.formato == "json":
+                msg = json.dumps({"seq": lote_seq, "t0": lote_t0, "fs": FS, "values": datos})
+            else:
+                msg = ",".join(map(str, datos))
+            mensajes[clave] = msg
+        cliente.encolar(msg, len(datos))
+
+async def _ws_broadcaster():
+    """
+    Empaqueta valores en lotes y los reparte a las colas de los clientes WS.
+    Formato: texto CSV con n valores por mensaje, o binario (ver
+    WS_BIN_HEADER) para clientes con format=binary. Cada lote se codifica
+    una sola vez por formato. Un lote nunca salta un hueco de secuencia.
+    Espera en la cola asyncio: no bloquea el loop.
+    """
+    BATCH = 10
+
+    pendiente = None
+    while not _stop_event.is_set():
+        if pendiente is None:
+            pendiente = await ws_queue.get()
+        lote_seq, lote = pendiente[0], list(pendiente[1])
+        lote_f = None if pendiente[2] is None else list(pendiente[2])
+        lote_t0 = pendiente[3]
+        pendiente = None
+
+        # Agregar bloques contiguos ya disponibles; un hueco cierra el lote
+        while len(lote) < BATCH:
+            try:
+                sig = ws_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if sig[0] != lote_seq + len(lote) or (sig[2] is None) != (lote_f is None):
+                pendiente = sig
+                break
+            lote.extend(sig[1])
+            if lote_f is not None:
+                lote_f.extend(sig[2])
+
+        _ws_difundir(lote_seq, lote, lote_f, lote_t0)
+
+# ---------------------- Consultas por rango (solo lectura) ----------------------
+
+RANGE_LIMIT_MAX = 200000  # Máximo de filas por consulta de rango
+
+def _parse_instante(valor: str) -> float:
+    """
+    Acepta epoch en segundos ("1756695380.5") u hora local
+    "YYYY-mm-dd HH:MM:SS[.fff]" (también con 'T'). Devuelve epoch (s).
+    """
+    valor = (valor or "").strip()
+    try:
+        return float(valor)
+    except ValueError:
+        pass
+    return datetime.fromisoformat(valor.replace("T", " ")).timestamp()
+
+def _resolver_db(name: str = None):
+    """
+    Ruta del .db pedido (o de la BD activa si name es None); None si no existe.
+    """
+    db_path = (DATA_DIR / name) if name else _current_db_path_from_conn()
+    if not db_path.exists() or db_path.suffix.lower() != ".db":
+        return None
+    return db_path
+
+def conectar_solo_lectura(db_path: Path):
+    """
+    Conexión read-only (URI mode=ro): en WAL no bloquea al escritor, no
+    necesita db_lock y nunca escribe. Un archivo antiguo todavía sin
+    preparar (ver preparar_bd_antiguas) se lee a través de vistas TEMP
+    compatibles: las consultas funcionan igual, pero sin índice de tiempo.
+    """
+    conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        for sql in _vistas_compatibles(conn):
+            conn.execute(sql)
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+def _faltantes_tiempo(conn) -> dict:
+    """
+    {tabla: columnas que faltan} de lo que _asegurar_indices_tiempo agrega;
+    t_epoch_ns figura también si hay filas sin rellenar. Vacío: preparada.
+    """
+    tablas = {r[0] for r in conn.execute("SELECT name FROM main.sqlite_master WHERE type='table';")}
+    esperadas = {"ecg_data": ("t_epoch_ns", "value_filt", "seq"), "bpm_data": ("t_epoch_ns",),
+                 "ecg_chunks": ("stream", "seq0")}
+    faltan = {}
+    for tabla, columnas in esperadas.items():
+        if tabla not in tablas:
+            continue
+        cols = {r[1] for r in conn.execute(f"PRAGMA main.table_info({tabla});")}
+        f = [c for c in columnas if c not in cols]
+        if "t_epoch_ns" in cols and conn.execute(
+                f"SELECT 1 FROM main.{tabla} WHERE t_epoch_ns IS NULL LIMIT 1;").fetchone():
+            f.append("t_epoch_ns")
+        if f:
+            faltan[tabla] = f
+    return faltan
+
+def _vistas_compatibles(conn) -> list:
+    """
+    CREATE TEMP VIEW que tapan las tablas de un archivo sin preparar con
+    las columnas que esperan las consultas (las TEMP tienen prioridad sobre
+    main y no escriben en el archivo).
+    """
+    defecto = {"t_epoch_ns": _SQL_TS_A_NS, "value_filt": "NULL", "seq": "NULL", "stream": "'raw'", "seq0": "NULL"}
+    vistas = []
+    for tabla, faltan in _faltantes_tiempo(conn).items():
+        cols = [r[1] for r in conn.execute(f"PRAGMA main.table_info({tabla});")]
+        exprs = []
+        for c in cols:
+            if c in faltan:  # t_epoch_ns con filas sin rellenar
+                exprs.append(f"COALESCE({c}, {defecto[c]}) AS {c}")
+            else:
+                exprs.append(c)
+        exprs += [f"{defecto[c]} AS {c}" for c in faltan if c not in cols]
+        vistas.append(f"CREATE TEMP VIEW {tabla} AS SELECT {', '.join(exprs)} FROM main.{tabla};")
+    return vistas
+
+def preparar_bd_antiguas() -> list:
+    """
+    Agrega columnas e índices de tiempo (_asegurar_indices_tiempo) a los .db
+    cerrados de DATA_DIR que no los tengan. Corre una vez al iniciar, en el
+    hilo de mantenimiento; la BD activa ya la preparó conectar_sqlite. Un
+    archivo de solo lectura o ocupado se deja como está (se lee con vistas).
+    """
+    activa = _current_db_path_from_conn().resolve()
+    preparadas = []
+    for p in sorted(DATA_DIR.glob("*.db")):
+        if p.resolve() == activa:
+            continue
+        try:
+            lector = sqlite3.connect(f"{p.resolve().as_uri()}?mode=ro", uri=True)
+            try:
+                pendiente = bool(_faltantes_tiempo(lector))
+            finally:
+                lector.close()
+            if not pendiente:
+                continue
+            conn = sqlite3.connect(str(p), timeout=5.0)
+            try:
+                _asegurar_indices_tiempo(conn)
+            finally:
+                conn.close()
+            preparadas.append(p.name)
+        except sqlite3.Error as e:
+            print(f"No se pudo preparar {p.name} ({e}); se leerá sin índice de tiempo.")
+    return preparadas
+
+def consultar_ecg_rango(conn, t_ini: float, t_fin: float, limit: int, stream: str = "raw"):
+    """
+    Muestras ECG con t_ini <= t < t_fin, ordenadas por tiempo.
+    stream: "raw" (crudo) o "filtered" (señal filtrada guardada).
+    Usa el índice de tiempo: O(log n + k). Devuelve (t_epoch_s ndarray, valores list).
+    """
+    ini_ns, fin_ns = int(t_ini * 1e9), int(t_fin * 1e9)
+    if esquema_db(conn) >= 2:
+        # Un chunk que empieza hasta CHUNK_SECS antes de t_ini puede solaparse
+        margen = int(CHUNK_SECS * 1e9)
+        cur = conn.execute(
+            "SELECT t0_epoch_ns, fs, encoding, blob FROM ecg_chunks "
+            "WHERE stream = ? AND t0_epoch_ns >= ? AND t0_epoch_ns < ? ORDER BY t0_epoch_ns;",
+            (stream, ini_ns - margen, fin_ns)
+        )
+        tiempos, valores, total = [], [], 0
+        for t0_ns, fs, enc, blob in cur:
+            vals = desempaquetar_muestras(enc, blob)
+            t = t0_ns / 1e9 + np.arange(len(vals)) / fs
+            m = (t >= t_ini) & (t < t_fin)
+            if not m.any():
+                continue
+            t, vals = t[m][:limit - total], vals[m][:limit - total]
+            tiempos.append(t)
+            valores.extend(vals.tolist())
+            total += len(t)
+            if total >= limit:
+                break
+        return (np.concatenate(tiempos) if tiempos else np.empty(0)), valores
+
+    if stream == "filtered":
+        sql = ("SELECT t_epoch_ns, value_filt FROM ecg_data "
+               "WHERE t_epoch_ns >= ? AND t_epoch_ns < ? AND value_filt IS NOT NULL ORDER BY t_epoch_ns LIMIT ?;")
+    else:
+        sql = ("SELECT t_epoch_ns, value FROM ecg_data "
+               "WHERE t_epoch_ns >= ? AND t_epoch_ns < ? ORDER BY t_epoch_ns LIMIT ?;")
+    rows = conn.execute(sql, (ini_ns, fin_ns, limit)).fetchall()
+    if not rows:
+        return np.empty(0), []
+    t_ns, vals = zip(*rows)
+    return np.asarray(t_ns, dtype=np.int64) / 1e9, list(vals)
+
+def consultar_bpm_rango(conn, t_ini: float, t_fin: float, limit: int):
+    """
+    Filas BPM con t_ini <= t < t_fin (índice cubriente). Devuelve [(timestamp, bpm), ...].
+    """
+    return conn.execute(
+        "SELECT timestamp, bpm FROM bpm_data "
+        "WHERE t_epoch_ns >= ? AND t_epoch_ns < ? ORDER BY t_epoch_ns LIMIT ?;",
+        (int(t_ini * 1e9), int(t_fin * 1e9), limit)
+    ).fetchall()
+
+def consultar_hrv_rango(conn, ventana_s: int, t_ini: float, t_fin: float, limit: int):
+    """
+    Filas de la tabla hrv de una ventana con t_ini <= t < t_fin. BD
+    anteriores a la tabla devuelven [].
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hrv';").fetchone():
+        return []
+    return conn.execute(
+        "SELECT t_epoch_ns, n, mean_rr_ms, sdnn_ms, rmssd_ms, pnn50, mean_hr, hist FROM hrv "
+        "WHERE window_s = ? AND t_epoch_ns >= ? AND t_epoch_ns < ? ORDER BY t_epoch_ns LIMIT ?;",
+        (ventana_s, int(t_ini * 1e9), int(t_fin * 1e9), limit)
+    ).fetchall()
+
+def consultar_piramide(conn, nivel: int, t_ini: float, t_fin: float):
+    """
+    Buckets de un nivel de la pirámide que empiezan en [t_ini - nivel, t_fin).
+    Devuelve (t_bucket_s, n, vmin, vmax, vsum) como arrays (vacíos si no hay).
+    """
+    try:
+        rows = conn.execute(
+            "SELECT bucket_ns, n, vmin, vmax, vsum FROM ecg_pyramid "
+            "WHERE level_s = ? AND bucket_ns >= ? AND bucket_ns < ? ORDER BY bucket_ns;",
+            (nivel, int((t_ini - nivel) * 1e9), int(t_fin * 1e9))
+        ).fetchall()
+    except sqlite3.OperationalError:
+        rows = []  # BD sin tabla ecg_pyramid
+    if not rows:
+        return tuple(np.empty(0) for _ in range(5))
+    a = np.asarray(rows, dtype=np.float64)
+    return a[:, 0] / 1e9, a[:, 1], a[:, 2], a[:, 3], a[:, 4]
+
+def _reagrupar(t, n, vmin, vmax, vsum, t_ini, ancho_s):
+    """
+    Junta buckets (o muestras, con n=1) en columnas de ancho_s segundos
+    desde t_ini: min de mins, max de maxs, suma de sumas.
+    """
+    col = np.floor((t - t_ini) / ancho_s).astype(np.int64)
+    ini = np.flatnonzero(np.r_[True, col[1:] != col[:-1]])
+    return (
+        t_ini + col[ini] * ancho_s,
+        np.add.reduceat(n, ini),
+        np.minimum.reduceat(vmin, ini),
+        np.maximum.reduceat(vmax, ini),
+        np.add.reduceat(vsum, ini),
+    )
+
+def lttb(t: np.ndarray, v: np.ndarray, puntos: int):
+    """
+    Largest-Triangle-Three-Buckets: elige 'puntos' muestras que conservan
+    la forma visual de la serie. Devuelve los índices elegidos.
+    """
+    n = len(t)
+    if puntos >= n or puntos < 3:
+        return np.arange(n)
+    idx = np.empty(puntos, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    bordes = np.linspace(1, n - 1, puntos - 1).astype(np.int64)
+    a = 0
+    for i in range(puntos - 2):
+        ini, fin = bordes[i], max(bordes[i + 1], bordes[i] + 1)
+        sig_ini, sig_fin = fin, max(bordes[i + 2] if i + 2 < len(bordes) else n, fin + 1)
+        # Punto medio del bucket siguiente
+        tc, vc = t[sig_ini:sig_fin].mean(), v[sig_ini:sig_fin].mean()
+        ta, va = t[a], v[a]
+        area = np.abs((ta - tc) * (v[ini:fin] - va) - (ta - t[ini:fin]) * (vc - va))
+        a = ini + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+_MS_TXT = [f"{i:03d}" for i in range(1000)]
+
+def _formatear_epochs(t: np.ndarray) -> list:
+    """
+    Formatea epochs (s) como "%Y-%m-%d %H:%M:%S.mmm" en hora local. El huso
+    se calcula una vez por hora UTC distinta, como en _epoch_de_timestamps:
+    un rango que cruza un cambio de horario queda bien a los dos lados.
+    """
+    if len(t) == 0:
+        return []
+    t_ms = np.round(t * 1e3).astype(np.int64)
+    horas, inversa = np.unique(np.floor_divide(t_ms, 3_600_000), return_inverse=True)
+    offsets_ms = np.array([int(datetime.fromtimestamp(int(h) * 3600).astimezone().utcoffset().total_seconds() * 1e3)
+                           for h in horas.tolist()], dtype=np.int64)
+    seg, ms = np.divmod(t_ms + offsets_ms[inversa], 1000)
+    # Cada segundo distinto se formatea una vez; los milisegundos salen de una tabla
+    ini = np.flatnonzero(np.r_[True, seg[1:] != seg[:-1]])
+    textos = [s.replace("T", " ") + "." for s in np.datetime_as_string(seg[ini].astype("datetime64[s]"), unit="s").tolist()]
+    idx = np.repeat(np.arange(len(ini)), np.diff(np.r_[ini, len(seg)]))
+    return [textos[i] + _MS_TXT[m] for i, m in zip(idx.tolist(), ms.tolist())]
+
+# ---------------------- FastAPI (API + WS, sin frontend) ----------------------
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _db_writer_thread, _infer_thread, _mant_thread, _ws_loop, ws_queue, _anillo_shm, _cliente_adq
+    ws_queue = asyncio.Queue(maxsize=WS_QUEUE_MAX)
+    _ws_loop = asyncio.get_running_loop()
+    ws_task = asyncio.create_task(_ws_broadcaster())
+    if ACQ_MODE == "attach":
+        # Worker de la API: sin serial, BD ni inferencia; sólo lee la memoria compartida
+        print(f"Worker API {os.getpid()} adjunto a la adquisición ({SHM_NAME}, control en {ACQ_HOST}:{ACQ_PORT})")
+        shm_task = asyncio.create_task(_shm_lector())
+        _cliente_adq = httpx.AsyncClient(base_url=f"http://{ACQ_HOST}:{ACQ_PORT}", timeout=30.0)
+        try:
+            yield
+        finally:
+            _stop_event.set()
+            _ws_loop = None
+            for tarea in (ws_task, shm_task):
+                tarea.cancel()
+            for cliente in list(ws_clients.values()):
+                if cliente.tarea is not None:
+                    cliente.tarea.cancel()
+            await asyncio.gather(ws_task, shm_task, return_exceptions=True)
+            await _cliente_adq.aclose()
+            _cliente_adq = None
+            if _anillo_shm is not None:
+                _anillo_shm.cerrar()
+                _anillo_shm = None
+        return
+
+    print(f"API ECG iniciada (JSON + WebSocket). Detector: {HR_DETECTOR}")
+    if ACQ_MODE == "process":
+        _anillo_shm = AnilloCompartido.crear(SHM_NAME, datos_ecg.capacidad, FS)
+        _anillo_shm.publicar_db(CURRENT_DB_NAME)
+        print(f"Publicando en memoria compartida {SHM_NAME} ({_anillo_shm.capacidad} muestras)")
+    _db_writer_thread = threading.Thread(target=_db_writer, daemon=True)
+    _db_writer_thread.start()
+    _mant_thread = threading.Thread(target=_mantenimiento, daemon=True)
+    _mant_thread.start()
+    if INFER_ENABLED:
+        # El modelo se carga en su hilo: el arranque de la API no lo espera
+        _infer_thread = threading.Thread(target=_infer_worker, daemon=True)
+        _infer_thread.start()
+    hilo = threading.Thread(target=leer_desde_serial, daemon=True)
+    hilo.start()
+    try:
+        yield
+    finally:
+        _stop_event.set()
+        _ws_loop = None
+        ws_task.cancel()
+        for cliente in list(ws_clients.values()) + list(ws_pred_clients.values()) + list(ws_hrv_clients.values()):
+            if cliente.tarea is not None:
+                cliente.tarea.cancel()
+        try:
+            await ws_task
+        except (Exception, asyncio.CancelledError):
+            pass
+        hilo.join(timeout=2.0)
+        _infer_stop.set()
+        if _infer_thread is not None:
+            _infer_thread.join(timeout=2.0)
+        # El escritor vacía la cola y hace el último commit
+        _db_stop.set()
+        _db_writer_thread.join(timeout=5.0)
+        _mant_stop.set()
+        _mant_thread.join(timeout=2.0)
+        if _anillo_shm is not None:
+            _anillo_shm.cerrar()
+            _anillo_shm = None
+        print("API ECG detenida.")
+
+app = FastAPI(lifespan=lifespan)
+
+# Permitir CORS
+origins = [
+    "http://localhost:3000",  # tu frontend local
+    "http://127.0.0.1:3000",  # alternativa 
+    "https://qm1n4mn1-4321.brs.devtunnels.ms",
+    "*",                       # o todos los orígenes (solo para pruebas)
+]
+
+# Configurar CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],          # <- permite todos los orígenes; para producción usa tu frontend específico
+    allow_credentials=True,
+    allow_methods=["*"],          # GET, POST, etc.
+    allow_headers=["*"],          # Headers permitidos
+)
+
+_cliente_adq = None  # httpx.AsyncClient hacia ACQ_HOST:ACQ_PORT (worker "attach", lo abre lifespan)
+
+@app.middleware("http")
+async def _reenviar_a_adquisicion(request: Request, call_next):
+    """
+    Worker "attach": lo que no es lectura de ATTACH_RUTAS (control, estado,
+    predicciones...) lo atiende el proceso de adquisición, dueño de ese estado.
+    La respuesta se pasa al cliente por partes a medida que llega, sin
+    bloquear el loop ni juntarla entera en memoria.
+    """
+    if ACQ_MODE != "attach" or request.url.path in ATTACH_RUTAS or _cliente_adq is None:
+        return await call_next(request)
+    cabeceras = {k: v for k, v in request.headers.items() if k.lower() not in ("host", "content-length")}
+    pedido = _cliente_adq.build_request(request.method, request.url.path,
+                                        params=list(request.query_params.multi_items()),
+                                        content=await request.body(), headers=cabeceras)
+    try:
+        r = await _cliente_adq.send(pedido, stream=True)
+    except httpx.HTTPError as e:
+        return JSONResponse({"ok": False, "error": f"Proceso de adquisición no disponible: {e}"}, status_code=503)
+    pasar = {k: v for k, v in r.headers.items()
+             if k.lower() in ("etag", "last-modified", "cache-control", "content-disposition", "vary", "content-encoding")
+             or k.lower().startswith("access-control-")}
+
+    async def cuerpo():
+        # Bytes tal cual llegan (content-encoding incluido); cerrar libera la conexión
+        try:
+            async for parte in r.aiter_raw():
+                yield parte
+        finally:
+            await r.aclose()
+
+    return StreamingResponse(cuerpo(), status_code=r.status_code, headers=pasar, media_type=r.headers.get("content-type"))
+
+def estado_pipeline() -> dict:
+    """
+    Resumen de muestras perdidas, descartadas y tardías por etapa: si
+    todo sale en cero (o no crece) la adquisición va al día con este FS.
+    """
+    return {
+        "samples": _reloj.stats["samples"],
+        "lost": {"serial": _reloj.stats["lost_samples"]},
+        "dropped": {
+            "ws_queue": _ws_stats["dropped_samples"],
+            "ws_clients": _ws_stats["client_dropped_samples"],
+            "db": _db_stats["dropped_samples"],
+        },
+        "late": {
+            "acquisition": _reloj.stats["late_samples"],
+            "ws": _ws_stats["late_samples"],
+            "db": _db_stats["late_samples"],
+        },
+    }
+
+@app.get("/health")
+def health():
+    return {
+        "ok": True,
+        "samples_in_memory": len(datos_ecg),
+        "memory_capacity": datos_ecg.capacidad,
+        "writing": activar_escritura,
+        "last_known_port": _last_known_port,
+        "baudrate": BAUDRATE,
+        "hr_detector": HR_DETECTOR,
+        "filter": _filtro.estado() if _filtro is not None else None,
+        "inference": estado_inferencia(),
+        "beats": estado_latidos(),
+        "buffer_ecg": sum(len(b[1]) for b in buffer_db_ecg),
+        "buffer_bpm": len(buffer_db_bpm),
+        "buffer_beats": len(buffer_db_beats),
+        "buffer_hrv": len(buffer_db_hrv),
+        "db_writer": {**_db_stats, "queue_depth": db_queue.qsize()},
+        "db_maintenance": estado_mantenimiento(),
+        "umbral": UMBRAL,
+        "refract_sec": REFRACT_SEC,
+        "ws_clients": len(ws_clients),
+        "ws_queue": {"depth": ws_queue.qsize() if ws_queue is not None else 0, **_ws_stats},
+        "ws_clients_detail": [c.estado() for c in list(ws_clients.values())],
+        "test_signal": estado_senal_prueba(),
+        "replay": _replay,
+        "serial_mode": SERIAL_MODE,
+        "serial_stats": _serial_stats,
+        "clock": {"next_seq": _reloj.seq, "fs": FS, **_reloj.stats},
+        "pipeline": estado_pipeline(),
+        "shm": estado_shm(),
+    }
+
+
+_metricas_prev = {}  # {nombre: (monotonic, total)} de la consulta anterior, para las tasas
+
+def _tasa(nombre: str, total: float) -> float:
+    """
+    Tasa por segundo de un contador desde la consulta anterior a /metrics
+    (0 en la primera). Prometheus puede calcularla igual con rate().
+    """
+    ahora = time.monotonic()
+    previo = _metricas_prev.get(nombre)
+    _metricas_prev[nombre] = (ahora, total)
+    if previo is None or ahora <= previo[0]:
+        return 0.0
+    return (total - previo[1]) / (ahora - previo[0])
+
+def _prom(lineas: list, nombre: str, tipo: str, ayuda: str, valores):
+    """
+    Agrega una métrica con HELP/TYPE. valores es un número o una lista de
+    (etiquetas, número); los None no se exponen.
+    """
+    lineas.append(f"# HELP {nombre} {ayuda}")
+    lineas.append(f"# TYPE {nombre} {tipo}")
+    if not isinstance(valores, list):
+        valores = [("", valores)]
+    for etiquetas, v in valores:
+        if v is None:
+            continue
+        sufijo = f"{{{etiquetas}}}" if etiquetas else ""
+        lineas.append(f"{nombre}{sufijo} {v}")
+
+def _prom_hist(lineas: list, nombre: str, ayuda: str, series):
+    """
+    series: lista de (etiquetas, Histograma).
+    """
+    lineas.append(f"# HELP {nombre} {ayuda}")
+    lineas.append(f"# TYPE {nombre} histogram")
+    for etiquetas, h in series:
+        lineas.extend(h.exponer(nombre, etiquetas))
+
+@app.get("/metrics")
+def metrics():
+    """
+    Contadores, niveles de cola e histogramas de latencia en formato texto
+    de Prometheus (version 0.0.4). Sólo lee lo que cada etapa ya acumula.
+    """
+    L = []
+    muestras = _reloj.stats["samples"]
+    _prom(L, "ecg_samples_total", "counter", "Muestras decodificadas", muestras)
+    _prom(L, "ecg_samples_per_second", "gauge", "Muestras decodificadas por segundo desde la consulta anterior",
+          round(_tasa("samples", muestras), 3))
+    _prom(L, "ecg_serial_frames_total", "counter", "Tramas decodificadas del serial", _serial_stats["frames"])
+    _prom(L, "ecg_serial_resyncs_total", "counter", "Pérdidas de alineación con la cabecera", _serial_stats["resyncs"])
+    _prom(L, "ecg_serial_garbage_bytes_total", "counter", "Bytes descartados al resincronizar",
+          _serial_stats["garbage_bytes"])
+    _prom(L, "ecg_lost_samples_total", "counter", "Muestras perdidas estimadas (huecos de seq)",
+          _reloj.stats["lost_samples"])
+    _prom(L, "ecg_late_samples_total", "counter", "Muestras que salen de una etapa más de LATE_MS tarde",
+          [('stage="acquisition"', _reloj.stats["late_samples"]),
+           ('stage="ws"', _ws_stats["late_samples"]),
+           ('stage="db"', _db_stats["late_samples"])])
+    _prom(L, "ecg_clock_lag_seconds", "gauge", "Desfase de la última llegada respecto al ancla",
+          None if _reloj.stats["lag_ms"] is None else _reloj.stats["lag_ms"] / 1000.0)
+    _prom_hist(L, "ecg_block_seconds", "Tiempo de _process_block por bloque", [("", _hist_bloque)])
+    _prom_hist(L, "ecg_bpm_detector_seconds", "Tiempo del detector de BPM por bloque",
+               [(f'detector="{HR_DETECTOR}"', _hist_bpm)])
+
+    # WebSocket
+    _prom(L, "ecg_ws_queue_depth", "gauge", "Bloques en ws_queue", 0 if ws_queue is None else ws_queue.qsize())
+    _prom(L, "ecg_ws_dropped_samples_total", "counter", "Muestras descartadas por colas WS llenas",
+          [('queue="ws_queue"', _ws_stats["dropped_samples"]),
+           ('queue="client"', _ws_stats["client_dropped_samples"])])
+    clientes = list(ws_clients.values())
+    _prom(L, "ecg_ws_clients", "gauge", "Clientes WS conectados", len(clientes))
+    _prom(L, "ecg_ws_client_queue_depth", "gauge", "Mensajes pendientes por cliente WS",
+          [(f'client="{c.id}"', c.cola.qsize()) for c in clientes])
+    _prom(L, "ecg_ws_client_sent_total", "counter", "Mensajes enviados por cliente WS",
+          [(f'client="{c.id}"', c.enviados) for c in clientes])
+    _prom(L, "ecg_ws_client_lag_seconds", "gauge", "Encolado -> enviado del último mensaje por cliente WS",
+          [(f'client="{c.id}"', c.lag_ms / 1000.0) for c in clientes])
+    _prom_hist(L, "ecg_ws_send_seconds", "Duración de cada envío por cliente WS",
+               [(f'client="{c.id}",format="{c.formato}"', c.hist_envio) for c in clientes])
+
+    # BD
+    filas = _db_stats["rows_ecg"] + _db_stats["rows_bpm"] + _db_stats["rows_beats"] + _db_stats["rows_hrv"]
+    _prom(L, "ecg_db_rows_total", "counter", "Filas escritas en la BD",
+          [('table="ecg"', _db_stats["rows_ecg"]), ('table="bpm"', _db_stats["rows_bpm"]),
+           ('table="beats"', _db_stats["rows_beats"]), ('table="hrv"', _db_stats["rows_hrv"])])
+    _prom(L, "ecg_db_rows_per_second", "gauge", "Filas escritas por segundo desde la consulta anterior",
+          round(_tasa("db_rows", filas), 3))
+    _prom(L, "ecg_db_commits_total", "counter", "Commits del escritor", _db_stats["commits"])
+    _prom(L, "ecg_db_errors_total", "counter", "Errores al volcar a la BD", _db_stats["errors"])
+    _prom(L, "ecg_db_dropped_samples_total", "counter", "Muestras descartadas antes de la BD",
+          _db_stats["dropped_samples"])
+    _prom(L, "ecg_db_queue_depth", "gauge", "Elementos en db_queue", db_queue.qsize())
+    _prom(L, "ecg_db_lag_seconds", "gauge", "Antigüedad de la muestra más vieja del último commit",
+          None if _db_stats["lag_ms"] is None else _db_stats["lag_ms"] / 1000.0)
+    _prom_hist(L, "ecg_db_flush_seconds", "Duración de cada transacción de volcado", [("", _hist_db_flush)])
+
+    # HRV
+    hrv = _hrv.resumen(histograma=False)
+    _prom(L, "ecg_hrv_beats_total", "counter", "RR recibidos por el análisis HRV", hrv["beats"])
+    for clave, ayuda in (("sdnn_ms", "SDNN (ms)"), ("rmssd_ms", "RMSSD (ms)"), ("pnn50", "pNN50 (%)"),
+                         ("mean_hr", "FC media (lpm)")):
+        _prom(L, f"ecg_hrv_{clave}", "gauge", f"{ayuda} por ventana",
+              [(f'window_min="{v["window_min"]:g}"', v[clave]) for v in hrv["windows"]])
+
+    # Inferencia
+    _prom(L, "ecg_infer_beats_total", "counter", "Latidos clasificados", _infer_stats["beats"])
+    _prom(L, "ecg_infer_dropped_beats_total", "counter", "Latidos sin clasificar (cola llena o sin modelo)",
+          _infer_stats["dropped_beats"])
+    _prom(L, "ecg_infer_queue_depth", "gauge", "Elementos en infer_queue", infer_queue.qsize())
+    _prom_hist(L, "ecg_infer_batch_seconds", "Cómputo del modelo por lote", [("", _hist_infer_lote)])
+    _prom_hist(L, "ecg_infer_latency_seconds", "Encolado -> resultado por latido", [("", _hist_infer_lat)])
+
+    return Response("\n".join(L) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/ecg")
+def obtener_ecg_memoria(
+    since: int = Query(None, description="Sólo muestras con seq mayor que este"),
+    limit: int = Query(None, ge=1, description="Máximo de muestras (por defecto MAX_DATOS sin since)"),
+    timestamps: bool = Query(True, description="Incluir el timestamp en texto de cada muestra"),
+):
+    """
+    Muestras en vivo desde el buffer circular. Con since el sondeo sólo
+    recibe lo nuevo; el último seq recibido es el since del siguiente.
+    """
+    seqs, vals, filt = datos_ecg.leer(since, limit if limit is not None or since is not None else MAX_DATOS)
+    # float32 (señal de prueba) se redondea para no emitir ruido de representación
+    columnas = {"seq": seqs.tolist(), "value": (np.round(vals.astype(np.float64), 6) if vals.dtype.kind == "f" else vals).tolist()}
+    if timestamps:
+        columnas["timestamp"] = _formatear_epochs(datos_ecg.epochs(seqs)) if len(seqs) else []
+    if not np.all(np.isnan(filt)):
+        columnas["filtered"] = [None if f != f else f for f in np.round(filt.astype(np.float64), 3).tolist()]
+    claves = list(columnas)
+    return JSONResponse([dict(zip(claves, fila)) for fila in zip(*columnas.values())])
+
+@app.get("/shm")
+def obtener_shm():
+    """
+    Estado de la memoria compartida visto desde este proceso (escritor o worker).
+    """
+    return estado_shm()
+
+@app.get("/activar_escritura/{estado}")
+def activar_escritura_api(estado: str):
+    global activar_escritura
+    nuevo = (estado.lower() == "on")
+    # Con rotación por sesión cada grabación empieza en un archivo nuevo
+    if ROTATE_MODE == "session" and nuevo and not activar_escritura:
+        try:
+            _db_comando(lambda: _rotar_db("session"))
+        except Exception as e:
+            return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+    activar_escritura = nuevo
+    return {"escritura_activada": activar_escritura}
+
+@app.get("/bpm")
+def obtener_bpm():
+    return {"bpm": _last_bpm, "timestamp": _last_bpm_ts}
+
+@app.get("/hrv")
+def obtener_hrv(histogram: bool = Query(True, description="Incluir el histograma de RR de cada ventana")):
+    """
+    HRV en vivo por ventana de HRV_WINDOWS_MIN, actualizada en cada latido.
+    """
+    return _hrv.resumen(histogram)
+
+@app.get("/rpeaks")
+def obtener_picos_r(since: int = Query(None, description="Sólo picos con seq mayor que este")):
+    """
+    Picos R recientes (detector pan_tompkins): índice de muestra y timestamp.
+    """
+    picos = [(r, t) for r, t in list(_picos_r) if since is None or r > since]
+    ts_list = _formatear_epochs(np.asarray([t for _, t in picos])) if picos else []
+    return [{"seq": r, "timestamp": ts} for (r, _), ts in zip(picos, ts_list)]
+
+@app.get("/beats")
+def obtener_latidos(
+    name: str = Query(None, description="Archivo .db; por defecto la BD activa"),
+    session: str = Query(None, description="Sólo latidos de esta sesión"),
+    since: int = Query(None, description="Sólo latidos con r_seq mayor que este"),
+    limit: int = Query(1000, ge=1, description="Máximo de latidos"),
+    format: str = Query("json", pattern="^(json|npy)$"),
+    prepared: bool = Query(False, description="Normalizados 0..1 y recortados a 1.2 RR (entrada del modelo)"),
+):
+    """
+    Latidos segmentados de la tabla beats. format=npy devuelve la matriz
+    (n, 187) float32, lista para predict.py --input; el orden de filas es
+    (sesión, r_seq) y va en las cabeceras X-First-Seq / X-Last-Seq.
+    """
+    db_path = _resolver_db(name)
+    if db_path is None:
+        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
+    limit = min(limit, RANGE_LIMIT_MAX)
+    conn = conectar_solo_lectura(db_path)
+    try:
+        filas, bloques = [], []
+        for f, X in leer_latidos(conn, session, since, limit):
+            if prepared:
+                X = np.vstack([preparar_latido(x, fila[3]) for fila, x in zip(f, X)]).astype(np.float32)
+            filas.extend(f)
+            bloques.append(X)
+    finally:
+        conn.close()
+    X = np.vstack(bloques) if bloques else np.zeros((0, MODEL_INPUT), dtype=np.float32)
+
+    if format == "npy":
+        buf = io.BytesIO()
+        np.save(buf, X)
+        cabeceras = {"Content-Disposition": f'attachment; filename="{db_path.stem}_beats.npy"'}
+        if filas:
+            cabeceras.update({"X-First-Seq": str(filas[0][1]), "X-Last-Seq": str(filas[-1][1])})
+        return Response(buf.getvalue(), media_type="application/octet-stream", headers=cabeceras)
+
+    ts_list = _formatear_epochs(np.asarray([f[2] for f in filas], dtype=np.float64) / 1e9) if filas else []
+    return [
+        {"session": f[0], "seq": f[1], "timestamp": ts, "rr_ms": f[3], "class": f[4],
+         "label": PRED_CLASES[f[4]] if f[4] is not None else None,
+         "beat": np.round(x.astype(np.float64), 5).tolist()}
+        for f, ts, x in zip(filas, ts_list, X)
+    ]
+
+def _rango_params(start: str, end: str, limit: int):
+    t_ini = _parse_instante(start)
+    t_fin = _parse_instante(end) if end else t_ini + 10.0
+    return t_ini, t_fin, max(1, min(int(limit), RANGE_LIMIT_MAX))
+
+@app.get("/ecg/range")
+def obtener_ecg_rango(
+    start: str = Query(..., description="Inicio: epoch (s) o 'YYYY-mm-dd HH:MM:SS[.fff]'"),
+    end: str = Query(None, description="Fin (exclusivo); por defecto start + 10 s"),
+    limit: int = Query(10000, description="Máximo de muestras"),
+    name: str = Query(None, description="Archivo .db (de /db/list); por defecto la BD activa"),
+    stream: str = Query("raw", pattern="^(raw|filtered)$", description="Señal cruda o filtrada"),
+):
+    """
+    Muestras ECG guardadas en un rango de tiempo, vía conexión de solo lectura.
+    """
+    db_path = _resolver_db(name)
+    if db_path is None:
+        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
+    try:
+        t_ini, t_fin, limit = _rango_params(start, end, limit)
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": f"Rango inválido: {e}"}, status_code=400)
+
+    conn = conectar_solo_lectura(db_path)
+    try:
+        t, vals = consultar_ecg_rango(conn, t_ini, t_fin, limit, stream)
+    finally:
+        conn.close()
+    data = [{"timestamp": ts, "value": v} for ts, v in zip(_formatear_epochs(t), vals)]
+    return {"name": db_path.name, "count": len(data), "truncated": len(data) >= limit, "data": data}
+
+@app.get("/bpm/range")
+def obtener_bpm_rango(
+    start: str = Query(..., description="Inicio: epoch (s) o 'YYYY-mm-dd HH:MM:SS[.fff]'"),
+    end: str = Query(None, description="Fin (exclusivo); por defecto start + 10 s"),
+    limit: int = Query(10000, description="Máximo de filas"),
+    name: str = Query(None, description="Archivo .db (de /db/list); por defecto la BD activa"),
+):
+    """
+    BPM guardados en un rango de tiempo, vía conexión de solo lectura.
+    """
+    db_path = _resolver_db(name)
+    if db_path is None:
+        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
+    try:
+        t_ini, t_fin, limit = _rango_params(start, end, limit)
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": f"Rango inválido: {e}"}, status_code=400)
+
+    conn = conectar_solo_lectura(db_path)
+    try:
+        rows = consultar_bpm_rango(conn, t_ini, t_fin, limit)
+    finally:
+        conn.close()
+    data = [{"timestamp": ts, "bpm": bpm} for ts, bpm in rows]
+    return {"name": db_path.name, "count": len(data), "truncated": len(data) >= limit, "data": data}
+
+@app.get("/hrv/range")
+def obtener_hrv_rango(
+    start: str = Query(..., description="Inicio: epoch (s) o 'YYYY-mm-dd HH:MM:SS[.fff]'"),
+    end: str = Query(None, description="Fin (exclusivo); por defecto start + 10 s"),
+    window: float = Query(None, description="Ventana en minutos (de las guardadas); por defecto la más larga"),
+    limit: int = Query(10000, description="Máximo de filas"),
+    histogram: bool = Query(False, description="Incluir el histograma de RR de cada fila"),
+    name: str = Query(None, description="Archivo .db (de /db/list); por defecto la BD activa"),
+):
+    """
+    HRV guardada (ventanas de al menos HRV_PERSIST_MIN) en un rango de tiempo.
+    """
+    db_path = _resolver_db(name)
+    if db_path is None:
+        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
+    try:
+        t_ini, t_fin, limit = _rango_params(start, end, limit)
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": f"Rango inválido: {e}"}, status_code=400)
+    ventana_min = window if window is not None else max(HRV_WINDOWS_MIN)
+
+    conn = conectar_solo_lectura(db_path)
+    try:
+        rows = consultar_hrv_rango(conn, int(round(ventana_min * 60)), t_ini, t_fin, limit)
+    finally:
+        conn.close()
+    ts = _formatear_epochs(np.array([r[0] for r in rows], dtype=np.int64) / 1e9) if rows else []
+    data = []
+    for t, (_, n, mean_rr, sdnn, rmssd, pnn50, mean_hr, hist) in zip(ts, rows):
+        fila = {"timestamp": t, "n": n, "mean_rr_ms": mean_rr, "sdnn_ms": sdnn, "rmssd_ms": rmssd,
+                "pnn50": pnn50, "mean_hr": mean_hr}
+        if histogram:
+            fila["histogram"] = json.loads(hist) if hist else None
+        data.append(fila)
+    return {"name": db_path.name, "window_min": ventana_min, "count": len(data),
+            "truncated": len(data) >= limit, "data": data}
+
+@app.get("/ecg/overview")
+def obtener_ecg_overview(
+    start: str = Query(..., description="Inicio: epoch (s) o 'YYYY-mm-dd HH:MM:SS[.fff]'"),
+    end: str = Query(..., description="Fin (exclusivo)"),
+    width: int = Query(2000, description="Ancho en píxeles: máximo de puntos devueltos"),
+    lttb_mode: bool = Query(False, alias="lttb", description="true: devuelve puntos elegidos con LTTB"),
+    name: str = Query(None, description="Archivo .db (de /db/list); por defecto la BD activa"),
+):
+    """
+    Vista resumida de un rango para dibujar: min/max/media por columna de
+    píxel. Usa el nivel de la pirámide más grueso que aún sea más fino que
+    un píxel, o las muestras crudas si el rango es corto.
+    """
+    db_path = _resolver_db(name)
+    if db_path is None:
+        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
+    try:
+        t_ini, t_fin = _parse_instante(start), _parse_instante(end)
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": f"Rango inválido: {e}"}, status_code=400)
+    width = max(3, min(int(width), 20000))
+    if t_fin <= t_ini:
+        return JSONResponse({"ok": False, "error": "end debe ser mayor que start"}, status_code=400)
+    ancho_s = (t_fin - t_ini) / width
+
+    conn = conectar_solo_lectura(db_path)
+    try:
+        niveles = [lv for lv in PYRAMID_LEVELS if lv <= ancho_s]
+        buckets = None
+        nivel = "raw"
+        if niveles:
+            nivel = max(niveles)
+            buckets = consultar_piramide(conn, nivel, t_ini, t_fin)
+            if len(buckets[0]) == 0:
+                buckets, nivel = None, "raw"  # BD sin pirámide: se calcula desde las muestras
+        if buckets is None:
+            t, vals = consultar_ecg_rango(conn, t_ini, t_fin, RANGE_LIMIT_MAX)
+            v = np.asarray(vals, dtype=np.float64)
+            buckets = (t, np.ones_like(v), v, v, v)
+    finally:
+        conn.close()
+
+    t, n, vmin, vmax, vsum = buckets
+    m = ((t > t_ini - nivel) if nivel != "raw" else (t >= t_ini)) & (t < t_fin)
+    t, n, vmin, vmax, vsum = t[m], n[m], vmin[m], vmax[m], vsum[m]
+    media = vsum / np.maximum(n, 1)
+
+    if lttb_mode:
+        # LTTB sobre las muestras crudas o, con pirámide, sobre la envolvente
+        # min/max intercalada (la media de un bucket aplana los QRS)
+        if nivel == "raw":
+            ts_serie, v_serie = t, vmin
+        else:
+            ts_serie = np.column_stack((t + nivel * 0.25, t + nivel * 0.75)).ravel()
+            alterna = np.column_stack((vmin, vmax))
+            alterna[1::2] = alterna[1::2, ::-1]  # min,max / max,min: trazo continuo
+            v_serie = alterna.ravel()
+        idx = lttb(ts_serie, v_serie, width)
+        data = [{"timestamp": ts, "value": v} for ts, v in zip(_formatear_epochs(ts_serie[idx]), v_serie[idx].tolist())]
+    else:
+        if len(t) > width:
+            t, n, vmin, vmax, vsum = _reagrupar(t, n, vmin, vmax, vsum, t_ini, ancho_s)
+            media = vsum / np.maximum(n, 1)
+        data = [
+            {"timestamp": ts, "min": a, "max": b, "mean": round(c, 3), "n": int(k)}
+            for ts, a, b, c, k in zip(_formatear_epochs(t), vmin.tolist(), vmax.tolist(), media.tolist(), n.tolist())
+        ]
+    level = nivel if nivel == "raw" else f"{nivel}s"
+    return {"name": db_path.name, "level": level, "lttb": lttb_mode, "count": len(data), "data": data}
+
+@app.get("/test_signal")
+def set_test_signal(
+    enabled: bool = Query(..., description="true/false para activar la señal de prueba"),
+    shape: str = Query("ecg", description="ecg (P-QRS-T sintético) o sine"),
+    freq: float = Query(1.0, description="Frecuencia Hz (sine)"),
+    amp: int = Query(800, description="Amplitud en cuentas 24b (R en ecg)"),
+    offset: int = Query(0, description="Offset DC en cuentas 24b"),
+    hr: float = Query(72.0, description="Frecuencia cardíaca media (lpm)"),
+    hrv_ms: float = Query(40.0, description="Desvío estándar de los RR (ms)"),
+    noise: float = Query(0.02, description="Ruido blanco, fracción de amp"),
+    drift: float = Query(0.1, description="Deriva de línea base, fracción de amp"),
+    mains: float = Query(0.0, description="Interferencia de red, fracción de amp"),
+    ectopic: float = Query(0.0, description="Probabilidad de latido ventricular prematuro"),
+    channels: int = Query(1, description="Canales independientes (el pipeline usa el 0)"),
+    seed: int = Query(None, description="Semilla para reproducir la señal"),
+):
+    """
+    Activa/desactiva la señal de prueba y ajusta parámetros.
+    Al activarse, la lectura por serial se ignora y se envía la señal a WS y DB.
+    """
+    global _generador
+    if shape not in ("ecg", "sine"):
+        return JSONResponse({"ok": False, "error": "shape debe ser ecg o sine"}, status_code=400)
+    _test_cfg.update(
+        enabled=bool(enabled), shape=shape, freq=max(0.0, float(freq)), amp=int(amp), offset=int(offset),
+        hr=min(max(float(hr), 20.0), 300.0), hrv_ms=max(0.0, float(hrv_ms)), noise=max(0.0, float(noise)),
+        drift=max(0.0, float(drift)), mains=max(0.0, float(mains)), ectopic=min(max(float(ectopic), 0.0), 0.5),
+        channels=min(max(int(channels), 1), 16), seed=seed,
+    )
+    # Generador y ritmo nuevos para que arranque limpio
+    _generador = GeneradorECG(FS, **_test_cfg)
+    _test_state.update(next_t=None, seq0=None)
+    return {"ok": True, "test_signal": _test_cfg}
+
+@app.post("/replay/start")
+def replay_start(
+    name: str = Query(..., description="Archivo de DATA_DIR: .db (de /db/list) o CSV timestamp,value (.csv/.csv.gz)"),
+    speed: float = Query(1.0, ge=0.0, description="1 = tiempo real, N = N veces más rápido, 0 = lo más rápido posible"),
+    loop: bool = Query(False, description="Volver a empezar al terminar"),
+    start: str = Query(None, description="Inicio: epoch (s) o 'YYYY-mm-dd HH:MM:SS[.fff]'"),
+    end: str = Query(None, description="Fin (exclusivo)"),
+):
+    """
+    Reproduce una grabación por el camino del lector serial: /ecg, WS,
+    BPM, latidos e inferencia la ven como si fuera en vivo (con instantes
+    y seq nuevos). La escritura en BD sigue a /activar_escritura.
+    """
+    ruta = DATA_DIR / name
+    nombre = name.lower()
+    if not ruta.exists() or not (nombre.endswith(".db") or nombre.endswith(".csv") or nombre.endswith(".csv.gz")):
+        return JSONResponse({"ok": False, "error": "Archivo no encontrado (.db, .csv o .csv.gz)"}, status_code=404)
+    try:
+        t_ini = _parse_instante(start) if start else None
+        t_fin = _parse_instante(end) if end else None
+        fs = _replay_estimar_fs(ruta, None if t_ini is None else int(t_ini * 1e9),
+                                None if t_fin is None else int(t_fin * 1e9))
+    except (ValueError, sqlite3.Error, OSError) as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    if fs is None:
+        return JSONResponse({"ok": False, "error": "La grabación no tiene muestras ECG en ese rango"}, status_code=400)
+    # Filtro, detectores y buffers están hechos para FS
+    if abs(fs - FS) > 0.02 * FS:
+        return JSONResponse({"ok": False, "error": f"La grabación es de {fs:.1f} Hz y la API trabaja a {FS} Hz"},
+                            status_code=400)
+    _replay.update(name=name, speed=float(speed), loop=bool(loop), start=t_ini, end=t_fin, fs=float(FS),
+                   state="starting", samples=0, gaps=0, t_recording=None, error=None)
+    _replay["id"] += 1
+    _replay["active"] = True
+    return {"ok": True, "replay": _replay}
+
+@app.post("/replay/stop")
+def replay_stop():
+    if _replay["active"]:
+        _replay.update(active=False, state="stopped")
+    return {"ok": True, "replay": _replay}
+
+@app.get("/replay")
+def replay_estado():
+    return _replay
+
+@app.get("/db/info")
+def db_info():
+    p = _current_db_path_from_conn()
+    try:
+        size = p.stat().st_size
+        mtime = datetime.fromtimestamp(p.stat().st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+    except Exception:
+        size, mtime = None, None
+    return {"name": p.name, "path": str(p), "size_bytes": size, "modified": mtime, "schema": db_schema,
+            "maintenance": estado_mantenimiento()}
+
+@app.post("/db/set")
+def db_set(name: str = Query(..., description="Base sin .db; si existe, se autoenumera")):
+    """
+    Vuelca buffers, cierra la conexión actual y abre una nueva con conectar_sqlite().
+    El cambio lo ejecuta el hilo escritor, dueño de la conexión.
+    """
+    # Elegir nombre único y abrir
+    new_db_name = _unique_db_filename(name)  # e.g., paciente.db o paciente_1.db
+    try:
+        _db_comando(lambda: _cambiar_db(new_db_name))
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+    p = DATA_DIR / CURRENT_DB_NAME
+    return {"ok": True, "db_name": CURRENT_DB_NAME, "path": str(p)}
+
+@app.post("/db/rotate")
+def db_rotate():
+    """
+    Rota ya a un archivo nuevo <ROTATE_PREFIX>_<fecha>.db; el anterior se
+    compacta en segundo plano.
+    """
+    try:
+        nuevo = _db_comando(lambda: _rotar_db("manual"))
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+    return {"ok": True, "db_name": nuevo, "closed": _mant_stats["last_rotation"]["closed"]}
+
+@app.post("/db/compact")
+def db_compact(name: str = Query(..., description="Archivo .db cerrado a compactar (checkpoint, ANALYZE, VACUUM)")):
+    """
+    Encola la compactación de un archivo que no es la BD activa.
+    """
+    db_path = _resolver_db(name)
+    if db_path is None:
+        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
+    if db_path.resolve() == _current_db_path_from_conn().resolve():
+        return JSONResponse({"ok": False, "error": "La BD activa no se compacta; rota primero"}, status_code=409)
+    _mant_queue.put(db_path)
+    return {"ok": True, "queued": db_path.name}
+
+@app.get("/db/list")
+def db_list():
+    """
+    Lista todos los .db en DATA_DIR con tamaño y fecha.
+    """
+    items = []
+    for p in sorted(DATA_DIR.glob("*.db")):
+        try:
+            size = p.stat().st_size
+            mtime = datetime.fromtimestamp(p.stat().st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+        except Exception:
+            size, mtime = None, None
+        items.append({"name": p.name, "size_bytes": size, "modified": mtime})
+    return items
+
+# ---------------------- Exportación ----------------------
+
+EXPORT_BLOCK      = 131072  # Muestras por bloque de salida
+EXPORT_GZIP_LEVEL = 1
+# formato -> (media type, extensión)
+EXPORT_FORMATOS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "npy": ("application/octet-stream", "npy"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+def _importar_pyarrow():
+    """
+    pyarrow es opcional: sólo hace falta para exportar en Arrow/Parquet.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow
+    except ImportError:
+        return None
+
+class _SumideroBytes:
+    """
+    Archivo de sólo escritura en memoria para los escritores de pyarrow:
+    lo escrito se recoge en cada bloque con vaciar().
+    """
+
+    def __init__(self):
+        self.partes = []
+        self.closed = False
+        self.pos = 0
+
+    def write(self, datos):
+        datos = bytes(datos)
+        self.partes.append(datos)
+        self.pos += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def vaciar(self) -> bytes:
+        datos = b"".join(self.partes)
+        self.partes.clear()
+        return datos
+
+def _filtro_tiempo(col: str, ini_ns: int, fin_ns: int, margen_ns: int = 0):
+    cond, params = [], []
+    if ini_ns is not None:
+        cond.append(f"{col} >= ?")
+        params.append(ini_ns - margen_ns)
+    if fin_ns is not None:
+        cond.append(f"{col} < ?")
+        params.append(fin_ns)
+    return cond, params
+
+def _tiempos_chunk(t0_ns: int, fs: float, n: int, ini_ns: int, fin_ns: int):
+    """
+    Tiempos (ns) de las muestras de un chunk y máscara de [ini_ns, fin_ns)
+    (None si no hay filtro).
+    """
+    t_ns = t0_ns + np.round(np.arange(n) * (1e9 / fs)).astype(np.int64)
+    if ini_ns is None and fin_ns is None:
+        return t_ns, None
+    m = np.ones(n, dtype=bool)
+    if ini_ns is not None:
+        m &= t_ns >= ini_ns
+    if fin_ns is not None:
+        m &= t_ns < fin_ns
+    return t_ns, m
+
+def _sql_export(conn, table: str, stream: str, ini_ns: int, fin_ns: int, columnas: str):
+    """
+    Consulta ordenada por tiempo para exportar table ("ecg" o "bpm").
+    Devuelve (sql, params, esquema) con esquema 2 = chunks.
+    """
+    if table == "ecg" and esquema_db(conn) >= 2:
+        cond, params = _filtro_tiempo("t0_epoch_ns", ini_ns, fin_ns, int(CHUNK_SECS * 1e9))
+        cond.insert(0, "stream = ?")
+        params.insert(0, stream)
+        return f"SELECT {columnas} FROM ecg_chunks WHERE {' AND '.join(cond)} ORDER BY t0_epoch_ns, id;", params, 2
+    tabla = "ecg_data" if table == "ecg" else "bpm_data"
+    cond, params = _filtro_tiempo("t_epoch_ns", ini_ns, fin_ns)
+    if table == "ecg" and stream == "filtered":
+        cond.append("value_filt IS NOT NULL")
+    where = f" WHERE {' AND '.join(cond)}" if cond else ""
+    return f"SELECT {columnas} FROM {tabla}{where} ORDER BY t_epoch_ns;", params, 1
+
+def _export_dtype(conn, table: str, stream: str) -> np.dtype:
+    """
+    Tipo de la columna de valores, fijo para todo el archivo (NPY/Arrow lo
+    necesitan antes de empezar): float32 si hay algún chunk float.
+    """
+    if table == "bpm":
+        return np.dtype(np.int32)
+    if esquema_db(conn) >= 2:
+        if stream == "filtered":
+            return np.dtype(np.float32)
+        f32 = conn.execute("SELECT 1 FROM ecg_chunks WHERE stream = 'raw' AND encoding LIKE 'f32%' LIMIT 1;").fetchone()
+        return np.dtype(np.float32 if f32 else np.int32)
+    if stream == "filtered":
+        return np.dtype(np.float64)
+    real = conn.execute("SELECT 1 FROM ecg_data WHERE typeof(value) = 'real' LIMIT 1;").fetchone()
+    return np.dtype(np.float64 if real else np.int32)
+
+def _export_contar(conn, table: str, stream: str, ini_ns: int, fin_ns: int) -> int:
+    """
+    Muestras que exportará _export_bloques (la cabecera NPY lleva el total).
+    En chunks se cuenta desde (t0, fs, n) sin descomprimir los BLOB.
+    """
+    if table == "ecg" and esquema_db(conn) >= 2:
+        sql, params, _ = _sql_export(conn, table, stream, ini_ns, fin_ns, "t0_epoch_ns, fs, n")
+        if ini_ns is None and fin_ns is None:
+            return sum(r[2] for r in conn.execute(sql, params))
+        total = 0
+        for t0_ns, fs, n in conn.execute(sql, params):
+            _, m = _tiempos_chunk(t0_ns, fs, n, ini_ns, fin_ns)
+            total += int(m.sum())
+        return total
+    sql, params, _ = _sql_export(conn, table, stream, ini_ns, fin_ns, "COUNT(*)")
+    return conn.execute(sql.replace(" ORDER BY t_epoch_ns", ""), params).fetchone()[0]
+
+def _export_bloques(conn, table: str, stream: str, ini_ns: int, fin_ns: int):
+    """
+    Genera (t_ns int64, valores, seq int64 con -1 si no se conoce) en
+    bloques de unas EXPORT_BLOCK muestras, en orden de tiempo.
+    """
+    if table == "ecg" and esquema_db(conn) >= 2:
+        sql, params, _ = _sql_export(conn, table, stream, ini_ns, fin_ns, "t0_epoch_ns, fs, n, encoding, blob, seq0")
+        cur = conn.execute(sql, params)
+        partes, acumuladas = [], 0
+        while True:
+            rows = cur.fetchmany(64)
+            if not rows:
+                break
+            for t0_ns, fs, n, enc, blob, seq0 in rows:
+                t_ns, m = _tiempos_chunk(t0_ns, fs, n, ini_ns, fin_ns)
+                vals = desempaquetar_muestras(enc, blob)
+                seq = np.arange(seq0, seq0 + n, dtype=np.int64) if seq0 is not None else np.full(n, -1, dtype=np.int64)
+                if m is not None:
+                    t_ns, vals, seq = t_ns[m], vals[m], seq[m]
+                partes.append((t_ns, vals, seq))
+                acumuladas += len(t_ns)
+            if acumuladas >= EXPORT_BLOCK:
+                yield tuple(np.concatenate(c) for c in zip(*partes))
+                partes, acumuladas = [], 0
+        if partes:
+            yield tuple(np.concatenate(c) for c in zip(*partes))
+        return
+
+    if table == "ecg":
+        col = "value_filt" if stream == "filtered" else "value"
+        columnas = f"t_epoch_ns, {col}, seq"
+    else:
+        columnas = "t_epoch_ns, bpm, NULL"
+    sql, params, _ = _sql_export(conn, table, stream, ini_ns, fin_ns, columnas)
+    cur = conn.execute(sql, params)
+    while True:
+        rows = cur.fetchmany(EXPORT_BLOCK)
+        if not rows:
+            break
+        t_ns, vals, seq = zip(*rows)
+        yield (np.asarray(t_ns, dtype=np.int64), np.asarray(vals),
+               np.asarray([-1 if q is None else q for q in seq], dtype=np.int64))
+
+def _csv_bloque(t_ns: np.ndarray, vals: np.ndarray) -> bytes:
+    ts_list = _formatear_epochs(t_ns / 1e9)
+    if vals.dtype.kind == "f":
+        vals = np.round(vals.astype(np.float64), 6)
+    return "".join([f"{ts},{v}\n" for ts, v in zip(ts_list, vals.tolist())]).encode()
+
+def _export_stream(db_path: Path, table: str, stream: str, formato: str, ini_ns: int, fin_ns: int, comprimir: bool):
+    """
+    Genera el archivo exportado por bloques grandes. Lee con una conexión
+    ?mode=ro dentro de una sola transacción de lectura: en WAL ve una foto
+    fija de la BD sin bloquear al escritor ni forzar un volcado, y nunca
+    escribe en el archivo (a una BD antigua le faltan columnas que se
+    suplen con las vistas de conectar_solo_lectura, no con un ALTER).
+    """
+    conn = conectar_solo_lectura(db_path)
+    z = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31) if comprimir else None
+    try:
+        conn.execute("BEGIN;")
+        dtype = _export_dtype(conn, table, stream)
+        nombre = "bpm" if table == "bpm" else "value"
+
+        def salida():
+            if formato == "csv":
+                yield f"timestamp,{nombre}\n".encode()
+                for t_ns, vals, _ in _export_bloques(conn, table, stream, ini_ns, fin_ns):
+                    yield _csv_bloque(t_ns, vals)
+            elif formato == "npy":
+                registro = np.dtype([("t_epoch_ns", "<i8"), (nombre, dtype.newbyteorder("<")), ("seq", "<i8")])
+                total = _export_contar(conn, table, stream, ini_ns, fin_ns)
+                cab = io.BytesIO()
+                np.lib.format.write_array_header_1_0(cab, {
+                    "descr": np.lib.format.dtype_to_descr(registro), "fortran_order": False, "shape": (total,)})
+                yield cab.getvalue()
+                escritas = 0
+                for t_ns, vals, seq in _export_bloques(conn, table, stream, ini_ns, fin_ns):
+                    bloque = np.empty(len(t_ns), dtype=registro)
+                    bloque["t_epoch_ns"], bloque[nombre], bloque["seq"] = t_ns, vals, seq
+                    escritas += len(bloque)
+                    yield bloque.tobytes()
+                if escritas != total:
+                    raise RuntimeError(f"Exportación NPY inconsistente: {escritas} de {total} muestras")
+            else:
+                pa = _importar_pyarrow()
+                esquema = pa.schema([("t_epoch_ns", pa.int64()), (nombre, pa.from_numpy_dtype(dtype)), ("seq", pa.int64())])
+                sumidero = _SumideroBytes()
+                if formato == "arrow":
+                    escritor = pa.ipc.new_stream(sumidero, esquema)
+                else:
+                    escritor = pa.parquet.ParquetWriter(sumidero, esquema, compression="zstd")
+                for t_ns, vals, seq in _export_bloques(conn, table, stream, ini_ns, fin_ns):
+                    lote = pa.record_batch([t_ns, vals.astype(dtype, copy=False), seq], schema=esquema)
+                    if formato == "arrow":
+                        escritor.write_batch(lote)
+                    else:
+                        escritor.write_table(pa.Table.from_batches([lote]))
+                    yield sumidero.vaciar()
+                escritor.close()
+                yield sumidero.vaciar()
+
+        for datos in salida():
+            if z is not None:
+                datos = z.compress(datos)
+            if datos:
+                yield datos
+        if z is not None:
+            yield z.flush()
+    finally:
+        conn.close()
+
+@app.get("/db/export")
+def db_export(
+    name: str = Query(..., description="Nombre del archivo .db a exportar (de /db/list)"),
+    table: str = Query("ecg", pattern="^(ecg|bpm)$", description="Tabla a exportar: ecg o bpm"),
+    format: str = Query("csv", pattern="^(csv|npy|arrow|parquet)$"),
+    gzip: bool = Query(False, description="Comprimir la salida (csv o npy)"),
+    start: str = Query(None, description="Inicio: epoch (s) o 'YYYY-mm-dd HH:MM:SS[.fff]'"),
+    end: str = Query(None, description="Fin (exclusivo)"),
+    stream: str = Query("raw", pattern="^(raw|filtered)$"),
+):
+    """
+    Exporta la DB indicada por streaming, en bloques grandes.
+    - /db/export?name=archivo.db&table=ecg
+    - /db/export?name=archivo.db&table=bpm&format=csv&gzip=true
+    - /db/export?name=archivo.db&format=parquet&start=...&end=...
+    Lee una foto de la BD (WAL) sin volcar ni bloquear la escritura en
+    curso: lo que todavía está en los buffers del escritor no se incluye.
+    """
+    db_path = (DATA_DIR / name)
+    if not db_path.exists() or db_path.suffix.lower() != ".db":
+        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
+    if format in ("arrow", "parquet"):
+        if gzip:
+            return JSONResponse({"ok": False, "error": f"{format} usa su propia compresión; gzip sólo con csv o npy"}, status_code=400)
+        if _importar_pyarrow() is None:
+            return JSONResponse({"ok": False, "error": f"{format} requiere pyarrow"}, status_code=400)
+    try:
+        ini_ns = int(_parse_instante(start) * 1e9) if start else None
+        fin_ns = int(_parse_instante(end) * 1e9) if end else None
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+
+    media_type, ext = EXPORT_FORMATOS[format]
+    filename = f"{db_path.stem}_{table}.{ext}"
+    if gzip:
+        media_type, filename = "application/gzip", filename + ".gz"
+    return StreamingResponse(
+        _export_stream(db_path, table, stream, format, ini_ns, fin_ns, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.post("/db/migrate")
+def db_migrate(name: str = Query(..., description="Archivo .db (esquema 1) a convertir a chunks BLOB")):
+    """
+    Migra una BD de una fila por muestra (esquema 1) a chunks BLOB (esquema 2).
+    La BD activa no se puede migrar: cambie antes con /db/set.
+    """
+    db_path = (DATA_DIR / name)
+    if not db_path.exists() or db_path.suffix.lower() != ".db":
+        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
+    if db_path.resolve() == _current_db_path_from_conn().resolve():
+        return JSONResponse({"ok": False, "error": "No se puede migrar la BD activa"}, status_code=409)
+    try:
+        return {"ok": True, **migrar_db_v2(db_path)}
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+@app.post("/db/pyramid")
+def db_pyramid(name: str = Query(..., description="Archivo .db cuya pirámide min/max se reconstruye")):
+    """
+    Reconstruye la pirámide de resolución de una BD guardada.
+    La BD activa la mantiene el escritor; no se reconstruye aquí.
+    """
+    db_path = (DATA_DIR / name)
+    if not db_path.exists() or db_path.suffix.lower() != ".db":
+        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
+    if db_path.resolve() == _current_db_path_from_conn().resolve():
+        return JSONResponse({"ok": False, "error": "La BD activa ya mantiene su pirámide"}, status_code=409)
+    try:
+        return {"ok": True, **construir_piramide(db_path)}
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+@app.get("/newData")
+def get_new_data():
+    file_path = "newDataStatus.txt"
+
+    try:
+        with open(file_path, "r") as f:
+            data = json.load(f)
+
+        new_data_value = data.get("newData", "false").lower() == "true"
+
+        return {"newData": new_data_value}
+    except FileNotFoundError:
+        return {"error":"Archivo no encontrado"}
+    except json.JSONDecodeError:
+        return{"error":"Error al parsear JSON"}
+
+@app.get("/checkTrainingStatus")
+def check_external():
+    url = "https://qm1n4mn1-3333.brs.devtunnels.ms/"   
+    try:
+        r = requests.get(url, timeout=10)
+        r.raise_for_status()
+        return {"ok": True, "data": r.json()}  
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+def _respuesta_predicciones_csv(request: Request, envoltura: bool, layout: str):
+    """
+    Responde con el cuerpo JSON precalculado de PREDICT_OUTPUT_CSV, o 304
+    si el cliente ya tiene esta versión (If-None-Match / If-Modified-Since).
+    """
+    if not os.path.exists(PREDICT_OUTPUT_CSV):
+        return JSONResponse({"error": "Archivo no encontrado"}, status_code=404)
+    try:
+        cache = cargar_predicciones_csv()
+    except FileNotFoundError:
+        return JSONResponse({"error": "Archivo no encontrado"}, status_code=404)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    etag = f'"{cache["version"]}-{layout}-{int(envoltura)}"'
+    cabeceras = {"ETag": etag, "Last-Modified": cache["last_modified"], "Cache-Control": "no-cache"}
+    if _no_modificado(request, etag, cache["mtime"]):
+        return Response(status_code=304, headers=cabeceras)
+    return Response(content=cuerpo_predicciones_csv(cache, envoltura, layout),
+                    media_type="application/json", headers=cabeceras)
+
+@app.get("/predictedData")
+def obtener_ecg_predicciones(
+    request: Request,
+    layout: str = Query("rows", pattern="^(rows|columns)$", description="rows: lista de filas; columns: una lista por columna"),
+):
+    return _respuesta_predicciones_csv(request, False, layout)
+
+@app.get("/sendPrediction")
+def send_prediction(
+    request: Request,
+    layout: str = Query("rows", pattern="^(rows|columns)$", description="rows: lista de filas; columns: una lista por columna"),
+):
+    return _respuesta_predicciones_csv(request, True, layout)
+
+
+@app.post("/doPrediction")
+def do_prediction(payload: dict = Body(default={})):
+    """
+    Encola una predicción y responde de inmediato; el hilo de inferencia
+    la procesa. payload {"beats": [[187 valores], ...]} clasifica esos
+    latidos; {"source": "beats", "session": ...} clasifica los latidos
+    guardados en la BD activa y anota su clase; sin payload se clasifica
+    PREDICT_INPUT_CSV y el resultado queda en PREDICT_OUTPUT_CSV (como predict.py).
+    """
+    global predictionStatus
+    try:
+        if _modelo["state"] == "unavailable" or not INFER_ENABLED:
+            predictionStatus = {"ok": False, "message": "model unavailable", "error": _modelo["error"]}
+            return JSONResponse(predictionStatus, status_code=503)
+        latidos = payload.get("beats")
+        if latidos:
+            X = np.asarray(latidos, dtype=np.float64)
+            if X.ndim != 2 or X.shape[1] != MODEL_INPUT:
+                return JSONResponse({"ok": False, "error": f"beats debe ser (n, {MODEL_INPUT})"}, status_code=400)
+            trabajo = _nuevo_trabajo("payload", len(X))
+            metas = [{"job": trabajo["job"], "row": i} for i in range(len(X))]
+            item = ("beats", X, metas, time.monotonic(), trabajo["job"])
+        elif payload.get("source") == "beats":
+            trabajo = _nuevo_trabajo("beats", 0)
+            item = ("db", _current_db_path_from_conn(), payload.get("session"), trabajo)
+        else:
+            if not os.path.exists(PREDICT_INPUT_CSV):
+                return JSONResponse({"ok": False, "error": f"{PREDICT_INPUT_CSV} no encontrado"}, status_code=404)
+            trabajo = _nuevo_trabajo("file", 0)
+            item = ("file", PREDICT_INPUT_CSV, trabajo)
+        try:
+            infer_queue.put_nowait(item)
+        except queue.Full:
+            _terminar_trabajo(trabajo, "cola de inferencia llena")
+            return JSONResponse({"ok": False, "error": "cola de inferencia llena"}, status_code=503)
+        predictionStatus = {"ok": True, "message": "queued", "job": trabajo["job"]}
+        return {**predictionStatus, "total": trabajo["total"]}
+    except Exception as e:
+        predictionStatus = {"ok": False, "error": str(e)}
+        return predictionStatus
+
+@app.get("/predictionStatus")
+def getPredictionStatus():
+    """
+    Estado del último trabajo (progreso real y latencia) y del servicio.
+    """
+    estado = dict(predictionStatus)
+    trabajo = _trabajos.get(estado.get("job"))
+    if trabajo is not None:
+        fin = trabajo["finished_at"] or time.time()
+        estado.update(
+            message=trabajo["state"],
+            ok=trabajo["state"] != "error",
+            error=trabajo["error"],
+            total=trabajo["total"],
+            done=trabajo["done"],
+            progress=round(trabajo["done"] / trabajo["total"], 4) if trabajo["total"] else 0.0,
+            elapsed_ms=round((fin - trabajo["queued_at"]) * 1000.0, 1),
+        )
+    return {"status": estado, "inference": estado_inferencia()}
+
+@app.get("/predictions")
+def obtener_predicciones(
+    since: int = Query(None, description="Sólo predicciones en vivo con id mayor que este"),
+    job: int = Query(None, description="Resultados de un trabajo de /doPrediction"),
+):
+    """
+    Predicciones servidas desde memoria: en vivo (por latido) o de un trabajo.
+    """
+    if job is not None:
+        trabajo = _trabajos.get(job)
+        if trabajo is None:
+            return JSONResponse({"ok": False, "error": "Trabajo no encontrado"}, status_code=404)
+        return {k: v for k, v in trabajo.items() if k != "X"}
+    return [p for p in list(predicciones) if since is None or p["id"] > since]
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket, format: str = "text", stream: str = "raw"):
+    """
+    Stream de muestras. format=text (por defecto): "v1,v2,...";
+    format=json: {"seq", "t0", "fs", "values"};
+    format=binary: cabecera con seq/count/fs/dtype + muestras empaquetadas.
+    stream=raw (por defecto) o filtered (salida de FiltroECG).
+    """
+    await websocket.accept()
+    cliente = _ClienteWS(websocket, format if format in ("binary", "json") else "text",
+                         "filtered" if stream == "filtered" else "raw")
+    cliente.tarea = asyncio.create_task(cliente.enviar())
+    ws_clients[websocket] = cliente
+    try:
+        while True:
+            await websocket.receive_text()
+    except Exception:
+        pass
+    finally:
+        ws_clients.pop(websocket, None)
+        cliente.tarea.cancel()
+
+
+@app.websocket("/ws/predictions")
+async def websocket_predicciones(websocket: WebSocket):
+    """
+    Predicciones en vivo: un mensaje JSON (lista) por lote clasificado.
+    En un worker "attach" llegan por el anillo compartido (_shm_sincronizar).
+    """
+    await websocket.accept()
+    cliente = _ClienteWS(websocket, "text")
+    cliente.tarea = asyncio.create_task(cliente.enviar())
+    ws_pred_clients[websocket] = cliente
+    try:
+        while True:
+            await websocket.receive_text()
+    except Exception:
+        pass
+    finally:
+        ws_pred_clients.pop(websocket, None)
+        cliente.tarea.cancel()
+
+@app.websocket("/ws/hrv")
+async def websocket_hrv(websocket: WebSocket):
+    """
+    HRV en vivo: un mensaje JSON (como /hrv, con histogramas) por latido.
+    En un worker "attach" llegan por el anillo compartido (_shm_sincronizar).
+    """
+    await websocket.accept()
+    cliente = _ClienteWS(websocket, "text")
+    cliente.tarea = asyncio.create_task(cliente.enviar())
+    ws_hrv_clients[websocket] = cliente
+    try:
+        while True:
+            await websocket.receive_text()
+    except Exception:
+        pass
+    finally:
+        ws_hrv_clients.pop(websocket, None)
+        cliente.tarea.cancel()
+
+@app.post("/resetPredictionStatus")
+def reset_prediction_status():
+    global predictionStatus
+    predictionStatus = {"ok": False, "message": "idle"}
+    return {"ok": True, "message": "PredictionStatus reset"}
+
+# ---------------------- Reprocesamiento ----------------------
+
+REPROC_VERSION     = "pt1"   # Versión de los resultados: cambiarla al modificar filtro, detector o segmentación
+REPROC_WORKERS     = 2       # Procesos del pool (uno por archivo a la vez)
+REPROC_WARMUP_SECS = 10.0    # Al reanudar se re-procesa esto antes del punto guardado
+
+_SQL_DERIVED = (
+    """CREATE TABLE IF NOT EXISTS derived_runs (
+        version TEXT PRIMARY KEY,
+        params TEXT,            -- configuración con la que se calculó (JSON)
+        state TEXT,             -- running | done | error
+        samples_total INTEGER,
+        samples_done INTEGER,
+        t_done_ns INTEGER,      -- todo lo anterior ya está confirmado en derived_beats
+        beats INTEGER,
+        started TEXT,
+        finished TEXT,
+        elapsed_s REAL,
+        error TEXT
+    );""",
+    """CREATE TABLE IF NOT EXISTS derived_beats (
+        version TEXT NOT NULL,
+        t_epoch_ns INTEGER NOT NULL,  -- instante de la R
+        seq INTEGER,                  -- seq de la R en la grabación (si se conoce)
+        rr_ms INTEGER,
+        bpm INTEGER,
+        class INTEGER,                -- NULL sin modelo
+        PRIMARY KEY (version, t_epoch_ns)
+    ) WITHOUT ROWID;""",
+)
+
+_reprocesos = {}  # {id: trabajo de /reprocess}, sólo los últimos MAX_TRABAJOS
+_reproceso_id = 0
+_reproceso_entorno = threading.Lock()  # ECG_REPROC_WORKER puesto sólo mientras se crea un pool
+
+def _params_reproceso(fs: float, clasificar: bool) -> str:
+    return json.dumps({
+        "fs": fs, "detector": "pan_tompkins", "filter_band": FILTER_BAND, "notch_hz": FILTER_NOTCH_HZ,
+        "median_ms": FILTER_MEDIAN_MS, "beat_pre_s": BEAT_PRE_S, "model": MODEL_PATH if clasificar else None,
+    })
+
+def reprocesar_db(ruta, version: str = REPROC_VERSION, force: bool = False, clasificar: bool = True) -> dict:
+    """
+    Recalcula R, BPM y clase de cada latido de un .db con el filtro, el
+    detector Pan-Tompkins y la segmentación actuales, y los guarda en
+    derived_beats bajo 'version'. Lee la señal cruda en bloques de
+    EXPORT_BLOCK muestras y confirma cada bloque junto con el avance en
+    derived_runs: si se corta, la próxima llamada sigue desde ahí
+    (re-procesando REPROC_WARMUP_SECS para que filtros y umbrales lleguen
+    en régimen). Pensada para correr en un proceso del pool. La señal se
+    lee en una foto fija mientras los resultados se confirman por otra
+    conexión, así que el archivo se pasa a WAL antes de empezar (en otro
+    modo de journal la foto bloquearía esas escrituras).
+    """
+    ruta = Path(ruta)
+    t_ini = time.perf_counter()
+    conn = sqlite3.connect(str(ruta), timeout=30.0)
+    lector = None
+    try:
+        (modo,) = conn.execute("PRAGMA journal_mode=WAL;").fetchone()
+        if str(modo).lower() != "wal":
+            raise RuntimeError(f"{ruta.name} no se pudo pasar a WAL (journal_mode={modo}): "
+                               "la lectura bloquearía la escritura de resultados")
+        for sql in _SQL_DERIVED:
+            conn.execute(sql)
+        if force:
+            conn.execute("DELETE FROM derived_beats WHERE version = ?;", (version,))
+            conn.execute("DELETE FROM derived_runs WHERE version = ?;", (version,))
+        conn.commit()
+        previo = conn.execute("SELECT state, t_done_ns, samples_done, beats, elapsed_s FROM derived_runs "
+                              "WHERE version = ?;", (version,)).fetchone()
+        if previo is not None and previo[0] == "done":
+            return {"name": ruta.name, "version": version, "state": "done", "skipped": True}
+
+        fs = _replay_estimar_fs(ruta, None, None)
+        lector = conectar_solo_lectura(ruta)
+        lector.execute("BEGIN;")  # una foto fija de la grabación
+        total = _export_contar(lector, "ecg", "raw", None, None)
+        hecho_ns, hechas, latidos_n, transcurrido = (previo[1], previo[2] or 0, previo[3] or 0, previo[4] or 0.0) \
+            if previo is not None else (None, 0, 0, 0.0)
+        conn.execute(
+            "INSERT OR REPLACE INTO derived_runs (version, params, state, samples_total, samples_done, t_done_ns, "
+            "beats, started, finished, elapsed_s, error) VALUES (?, ?, 'running', ?, ?, ?, ?, ?, NULL, ?, NULL);",
+            (version, _params_reproceso(fs, clasificar), total, hechas, hecho_ns, latidos_n,
+             datetime.now().strftime("%Y-%m-%d %H:%M:%S"), transcurrido))
+        conn.commit()
+        if fs is None:
+            conn.execute("UPDATE derived_runs SET state = 'done', finished = ? WHERE version = ?;",
+                         (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), version))
+            conn.commit()
+            return {"name": ruta.name, "version": version, "state": "done", "samples": 0, "beats": 0}
+
+        if clasificar and INFER_ENABLED and _modelo["state"] == "not_loaded":
+            _cargar_modelo()
+        clasificar = clasificar and _modelo["state"] == "ready"
+
+        paso_ns = 1e9 / fs
+        filtro = FiltroECG(fs)
+        detector = DetectorPanTompkins(fs)
+        pre = int(round(BEAT_PRE_S * fs))
+        largo = int(np.ceil(MODEL_INPUT * fs / MODEL_FS))
+        anillo = BufferAnillo(2 * EXPORT_BLOCK + 8 * largo, np.float32)
+        pendientes = deque()   # R detectadas cuya ventana todavía no está completa: (r, bpm, seq)
+        r_prev = None
+        t_base = None
+        desde_ns = None if hecho_ns is None else hecho_ns - int(REPROC_WARMUP_SECS * 1e9)
+
+        for t_ns, vals, seq in _export_bloques(lector, "ecg", "raw", desde_ns, None):
+            if t_base is None:
+                t_base = int(t_ns[0])
+            # Índice de muestra desde el tiempo: los huecos reinician filtro y detector
+            k = np.round((t_ns - t_base) / paso_ns).astype(np.int64)
+            cortes = np.flatnonzero(np.diff(k) != 1) + 1
+            filas = []
+            for a, b in zip(np.concatenate(([0], cortes)).tolist(), np.concatenate((cortes, [len(k)])).tolist()):
+                k0 = int(k[a])
+                filt = filtro.procesar(vals[a:b], k0)
+                anillo.escribir(k0, filt)
+                desfase = int(seq[a]) - k0 if seq[a] >= 0 else None
+                for r, bpm in detector.procesar(filt, k0):
+                    pendientes.append((r, bpm, None if desfase is None else r + desfase))
+                while pendientes and pendientes[0][0] - pre + largo <= anillo.fin:
+                    r, bpm, seq_r = pendientes.popleft()
+                    ventana = anillo.leer(r - pre, r - pre + largo)
+                    rr = None if r_prev is None else (r - r_prev) / fs
+                    rr_ms = int(round(rr * 1000)) if rr is not None and RR_MIN <= rr <= RR_MAX else None
+                    r_prev = r
+                    t_r = t_base + int(round(r * paso_ns))
+                    if ventana is None or (hecho_ns is not None and t_r <= hecho_ns):
+                        continue
+                    filas.append([version, t_r, seq_r, rr_ms, bpm, None, remuestrear_latido(ventana, fs), rr_ms])
+
+            if clasificar and filas:
+                X = np.vstack([preparar_latido(f[6], f[7]) for f in filas])
+                for f, clase in zip(filas, clasificar_latidos(X)[0].tolist()):
+                    f[5] = int(clase)
+            # Lo confirmado llega hasta la última muestra o hasta la primera R pendiente
+            fin_ns = int(t_ns[-1])
+            if pendientes:
+                fin_ns = min(fin_ns, t_base + int(round(pendientes[0][0] * paso_ns)) - 1)
+            # samples_done cuenta sólo lo confirmado (hasta t_done_ns): al reanudar no se repite
+            nuevo_ns = fin_ns if hecho_ns is None else max(hecho_ns, fin_ns)
+            confirmadas = t_ns <= nuevo_ns
+            if hecho_ns is not None:
+                confirmadas &= t_ns > hecho_ns
+            hechas += int(np.count_nonzero(confirmadas))
+            hecho_ns = nuevo_ns
+            latidos_n += len(filas)
+            conn.executemany("INSERT OR IGNORE INTO derived_beats (version, t_epoch_ns, seq, rr_ms, bpm, class) "
+                             "VALUES (?, ?, ?, ?, ?, ?);", [f[:6] for f in filas])
+            conn.execute("UPDATE derived_runs SET samples_done = ?, t_done_ns = ?, beats = ?, elapsed_s = ? "
+                         "WHERE version = ?;",
+                         (hechas, hecho_ns, latidos_n, round(transcurrido + time.perf_counter() - t_ini, 3), version))
+            conn.commit()
+
+        elapsed = transcurrido + time.perf_counter() - t_ini
+        hechas = total  # la cola tras la última R pendiente también quedó recorrida
+        conn.execute("UPDATE derived_runs SET state = 'done', samples_done = ?, finished = ?, elapsed_s = ? "
+                     "WHERE version = ?;",
+                     (hechas, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), round(elapsed, 3), version))
+        conn.commit()
+        return {"name": ruta.name, "version": version, "state": "done", "samples": hechas, "beats": latidos_n,
+                "classified": clasificar, "elapsed_s": round(elapsed, 3)}
+    except Exception as e:
+        try:
+            conn.rollback()
+            conn.execute("UPDATE derived_runs SET state = 'error', error = ? WHERE version = ?;", (str(e), version))
+            conn.commit()
+        except sqlite3.Error:
+            pass
+        raise
+    finally:
+        if lector is not None:
+            lector.close()
+        conn.close()
+
+def progreso_reproceso(ruta: Path, version: str) -> dict:
+    """
+    Avance guardado en derived_runs (lo escribe el proceso que reprocesa).
+    """
+    vacio = {"name": ruta.name, "state": "pending", "samples_total": None, "samples_done": 0,
+             "beats": 0, "elapsed_s": 0.0, "samples_per_s": None, "error": None}
+    try:
+        conn = sqlite3.connect(f"{ruta.resolve().as_uri()}?mode=ro", uri=True, timeout=5.0)
+    except sqlite3.Error:
+        return vacio
+    try:
+        fila = conn.execute("SELECT state, samples_total, samples_done, beats, elapsed_s, error "
+                            "FROM derived_runs WHERE version = ?;", (version,)).fetchone()
+    except sqlite3.Error:
+        fila = None
+    finally:
+        conn.close()
+    if fila is None:
+        return vacio
+    estado, total, hechas, latidos_n, elapsed, error = fila
+    return {
+        "name": ruta.name, "state": estado, "samples_total": total, "samples_done": hechas, "beats": latidos_n,
+        "progress": round(hechas / total, 4) if total else None, "elapsed_s": elapsed,
+        "samples_per_s": round(hechas / elapsed, 1) if elapsed else None, "error": error,
+    }
+
+def rutas_reproceso_por_defecto() -> list:
+    """
+    Los .db de DATA_DIR menos los que está grabando un escritor: la BD activa
+    de este proceso y la que publica en el anillo un proceso de adquisición
+    vivo. Reprocesarlos competiría con el escritor por el lock y sus lecturas
+    largas frenarían los checkpoints del WAL; sólo se hacen si se nombran.
+    """
+    en_uso = {_current_db_path_from_conn().resolve()}
+    anillo = _anillo_shm or AnilloCompartido.adjuntar(SHM_NAME)
+    if anillo is not None:
+        try:
+            nombre = anillo.leer_db()
+            if nombre and _pid_vivo(int(anillo.cab_i[AnilloCompartido.I_PID])):
+                en_uso.add((DATA_DIR / nombre).resolve())
+        finally:
+            if anillo is not _anillo_shm:
+                anillo.cerrar()
+    return [p for p in sorted(DATA_DIR.glob("*.db")) if p.resolve() not in en_uso]
+
+def lanzar_reproceso(rutas: list, version: str = REPROC_VERSION, workers: int = REPROC_WORKERS,
+                     force: bool = False, clasificar: bool = True) -> dict:
+    """
+    Reparte los archivos en un pool de procesos (spawn: el servidor tiene
+    hilos) desde un hilo de fondo y devuelve el trabajo para consultar.
+    """
+    global _reproceso_id
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import multiprocessing
+
+    _reproceso_id += 1
+    trabajo = {
+        "job": _reproceso_id, "version": version, "files": [Path(r).name for r in rutas],
+        "workers": workers, "state": "running", "results": {}, "errors": {},
+        "started_at": time.time(), "finished_at": None, "_rutas": [Path(r) for r in rutas],
+    }
+    _reprocesos[trabajo["job"]] = trabajo
+    for viejo in [k for k, t in _reprocesos.items() if t["state"] != "running"][:max(0, len(_reprocesos) - MAX_TRABAJOS)]:
+        _reprocesos.pop(viejo, None)
+
+    def correr():
+        try:
+            with ProcessPoolExecutor(max(1, min(workers, len(rutas))),
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                # Con spawn los procesos del pool se lanzan en submit: heredan
+                # ECG_REPROC_WORKER (y no abren la BD activa al importar app),
+                # pero el entorno del servidor queda como estaba
+                with _reproceso_entorno:
+                    previo = os.environ.get("ECG_REPROC_WORKER")
+                    os.environ["ECG_REPROC_WORKER"] = "1"
+                    try:
+                        futuros = {pool.submit(reprocesar_db, str(r), version, force, clasificar): Path(r).name
+                                   for r in rutas}
+                    finally:
+                        if previo is None:
+                            os.environ.pop("ECG_REPROC_WORKER", None)
+                        else:
+                            os.environ["ECG_REPROC_WORKER"] = previo
+                for futuro in as_completed(futuros):
+                    try:
+                        trabajo["results"][futuros[futuro]] = futuro.result()
+                    except Exception as e:
+                        trabajo["errors"][futuros[futuro]] = str(e)
+        except Exception as e:
+            trabajo["errors"]["pool"] = str(e)
+        trabajo["state"] = "error" if trabajo["errors"] else "done"
+        trabajo["finished_at"] = time.time()
+
+    threading.Thread(target=correr, daemon=True).start()
+    return trabajo
+
+def estado_reproceso(trabajo: dict) -> dict:
+    """
+    Trabajo con el avance de cada archivo y el throughput total (muestras/s
+    procesadas desde que empezó el trabajo, sumando todos los procesos).
+    """
+    archivos = [progreso_reproceso(r, trabajo["version"]) for r in trabajo["_rutas"]]
+    fin = trabajo["finished_at"] or time.time()
+    hechas = sum(a["samples_done"] or 0 for a in archivos)
+    total = sum(a["samples_total"] or 0 for a in archivos)
+    return {
+        **{k: v for k, v in trabajo.items() if not k.startswith("_") and k != "results"},
+        "elapsed_s": round(fin - trabajo["started_at"], 2),
+        "samples_done": hechas,
+        "samples_total": total,
+        "progress": round(hechas / total, 4) if total else None,
+        "samples_per_s": round(hechas / max(fin - trabajo["started_at"], 1e-9), 1),
+        "files": archivos,
+    }
+
+@app.post("/reprocess")
+def reprocess(payload: dict = Body(default={})):
+    """
+    Recalcula R, BPM y clases de uno o varios .db en segundo plano.
+    payload {"names": ["a.db", ...] (por defecto todos los de DATA_DIR
+    menos el que se está grabando, ver rutas_reproceso_por_defecto),
+    "version": REPROC_VERSION, "workers": REPROC_WORKERS, "force": false,
+    "classify": true}. Un archivo ya hecho en esa versión se salta; uno a
+    medias sigue desde donde quedó.
+    """
+    nombres = payload.get("names")
+    rutas = [DATA_DIR / n for n in nombres] if nombres else rutas_reproceso_por_defecto()
+    faltan = [r.name for r in rutas if not r.exists() or r.suffix.lower() != ".db"]
+    if faltan or not rutas:
+        return JSONResponse({"ok": False, "error": f"DB no encontrada: {faltan or 'ninguna'}"}, status_code=404)
+    version = str(payload.get("version") or REPROC_VERSION)
+    ocupados = {(r.resolve(), t["version"]) for t in _reprocesos.values() if t["state"] == "running" for r in t["_rutas"]}
+    if any((r.resolve(), version) in ocupados for r in rutas):
+        return JSONResponse({"ok": False, "error": "Ya hay un reproceso en curso de esos archivos y versión"},
+                            status_code=409)
+    try:
+        workers = max(1, int(payload.get("workers") or REPROC_WORKERS))
+    except (TypeError, ValueError):
+        return JSONResponse({"ok": False, "error": "workers debe ser entero"}, status_code=400)
+    trabajo = lanzar_reproceso(rutas, version, workers, bool(payload.get("force", False)),
+                               bool(payload.get("classify", True)))
+    return {"ok": True, "job": trabajo["job"], "version": version, "files": trabajo["files"]}
+
+@app.get("/reprocess")
+def reprocess_lista():
+    return [estado_reproceso(t) for t in _reprocesos.values()]
+
+@app.get("/reprocess/{job}")
+def reprocess_estado(job: int):
+    trabajo = _reprocesos.get(job)
+    if trabajo is None:
+        return JSONResponse({"ok": False, "error": "Trabajo no encontrado"}, status_code=404)
+    return {**estado_reproceso(trabajo), "results": trabajo["results"]}
+
+@app.get("/derived/beats")
+def derived_beats(
+    name: str = Query(None, description="Archivo .db (de /db/list); por defecto la BD activa"),
+    version: str = Query(REPROC_VERSION),
+    start: str = Query(None, description="Inicio: epoch (s) o 'YYYY-mm-dd HH:MM:SS[.fff]'"),
+    end: str = Query(None, description="Fin (exclusivo)"),
+    limit: int = Query(10000, ge=1, le=RANGE_LIMIT_MAX),
+):
+    """
+    Resultados de /reprocess: una fila por R con BPM, RR y clase.
+    """
+    db_path = _resolver_db(name)
+    if db_path is None:
+        return JSONResponse({"ok": False, "error": "DB no encontrada"}, status_code=404)
+    try:
+        ini_ns = int(_parse_instante(start) * 1e9) if start else None
+        fin_ns = int(_parse_instante(end) * 1e9) if end else None
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    cond, params = _filtro_tiempo("t_epoch_ns", ini_ns, fin_ns)
+    cond.insert(0, "version = ?")
+    params.insert(0, version)
+    conn = conectar_solo_lectura(db_path)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='derived_beats';").fetchone() is None:
+            return {"name": db_path.name, "version": version, "count": 0, "data": []}
+        filas = conn.execute(f"SELECT t_epoch_ns, seq, rr_ms, bpm, class FROM derived_beats "
+                             f"WHERE {' AND '.join(cond)} ORDER BY t_epoch_ns LIMIT ?;", params + [limit]).fetchall()
+    finally:
+        conn.close()
+    ts = _formatear_epochs(np.asarray([f[0] for f in filas], dtype=np.int64) / 1e9) if filas else []
+    data = [{"timestamp": t, "seq": f[1], "rr_ms": f[2], "bpm": f[3], "class": f[4],
+             "label": PRED_CLASES[f[4]] if f[4] is not None else None} for t, f in zip(ts, filas)]
+    return {"name": db_path.name, "version": version, "count": len(data), "data": data}
+
+# ---------------------- Main ----------------------
+
+if __name__ == "__main__":
+    if ACQ_MODE == "process":
+        # Proceso de adquisición: control en local; los workers "attach" atienden en el puerto público
+        uvicorn.run(app, host=ACQ_HOST, port=ACQ_PORT)
+    else:
+        # Ejecuta la API (JSON + WebSocket)
+        uvicorn.run(app, host="0.0.0.0", port=5000)
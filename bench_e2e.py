@@ -0,0 +1,346 @@
+"""
+Benchmark de punta a punta con un dispositivo serial simulado.
+
+Emula el Arduino (tramas 0xAA 0x55 + 24 bits BE a --fs Hz, con --ruido
+como probabilidad de trama corrupta) y hace correr el camino real de
+app.py: leer_desde_serial -> filtro/BPM/latidos -> escritor de BD y
+broadcaster WS, con --clientes WebSockets conectados. El dispositivo es
+un serial.Serial falso en el mismo proceso o, con --pty, un par de
+pseudo-terminales que se abren con pyserial de verdad (Linux).
+
+Cada FS corre en un proceso nuevo (app.py configura buffers y filtros
+para un FS al importarse) y reporta:
+- latencia serial -> WS por mensaje (p50/p95/p99/max), desde que la
+  última muestra del mensaje está disponible en el puerto;
+- filas/s escritas en la BD (temporal; por commit, así que con ventanas
+  cortas se cuantiza a CHUNK_SECS) y muestras descartadas o tardías;
+- CPU por muestra del proceso, sin contar los hilos del propio harness.
+El FS máximo sostenible es el mayor que no pierde muestras, no descarta
+y mantiene el p99 por debajo de LATE_MS. Requiere httpx (TestClient).
+
+    python bench_e2e.py
+    python bench_e2e.py --fs 250 1000 4000 --clientes 4 --segundos 20
+    python bench_e2e.py --fs 1000 --ruido 0.001 --pty --formato binary
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from bench_filtro import ecg_sintetico
+
+
+def tramas_ecg(fs: float, segundos: float, ruido: float, semilla: int = 0):
+    """
+    Bytes de --segundos de ECG sintético en tramas del Arduino y el offset
+    de fin de cada trama. Con ruido > 0 una fracción de las tramas pierde
+    un byte, trae basura delante o llega con la cabecera dañada.
+    """
+    x = ecg_sintetico(fs, segundos).astype(np.int64) & 0xFFFFFF
+    tramas = np.empty((len(x), 5), dtype=np.uint8)
+    tramas[:, 0], tramas[:, 1] = 0xAA, 0x55
+    tramas[:, 2], tramas[:, 3], tramas[:, 4] = x >> 16, (x >> 8) & 0xFF, x & 0xFF
+    if ruido <= 0:
+        return tramas.tobytes(), np.arange(1, len(x) + 1, dtype=np.int64) * 5
+
+    rng = np.random.default_rng(semilla)
+    partes, fines, total = [], np.empty(len(x), dtype=np.int64), 0
+    for i, trama in enumerate(tramas):
+        b = trama.tobytes()
+        if rng.random() < ruido:
+            tipo = rng.integers(3)
+            if tipo == 0:
+                b = b[:2] + b[3:]                     # byte perdido
+            elif tipo == 1:
+                b = rng.integers(0, 256, rng.integers(1, 4), dtype=np.uint8).tobytes() + b
+            else:
+                b = b"\xAA\x00" + b[2:]               # cabecera dañada
+        partes.append(b)
+        total += len(b)
+        fines[i] = total
+    return b"".join(partes), fines
+
+
+class Dispositivo:
+    """
+    Flujo de tramas a ritmo de reloj: la trama i está disponible desde
+    t_ini + i / fs. Recorre en bucle el bloque precalculado.
+    """
+
+    def __init__(self, fs: float, ruido: float, segundos_bloque: float = 30.0):
+        self.fs = fs
+        self.datos, self.fines = tramas_ecg(fs, segundos_bloque, ruido)
+        self.periodo = len(self.fines)
+        self.t_ini = None
+        self.entregados = 0  # bytes ya leídos
+
+    def arrancar(self):
+        self.t_ini = time.perf_counter()
+
+    def tramas_emitidas(self, ahora: float = None) -> int:
+        if self.t_ini is None:
+            return 0
+        ahora = time.perf_counter() if ahora is None else ahora
+        return int((ahora - self.t_ini) * self.fs) + 1
+
+    def _offset(self, tramas: int) -> int:
+        if tramas <= 0:
+            return 0
+        vueltas, resto = divmod(tramas - 1, self.periodo)
+        return vueltas * len(self.datos) + int(self.fines[resto])
+
+    def disponibles(self) -> int:
+        return self._offset(self.tramas_emitidas()) - self.entregados
+
+    def tomar(self, n: int) -> bytes:
+        """
+        Hasta n bytes ya emitidos (puede cruzar el final del bloque).
+        """
+        n = min(n, self.disponibles())
+        salida = bytearray()
+        while n > 0:
+            ini = self.entregados % len(self.datos)
+            trozo = self.datos[ini:ini + n]
+            salida += trozo
+            self.entregados += len(trozo)
+            n -= len(trozo)
+        return bytes(salida)
+
+    def instante(self, seq: int) -> float:
+        """
+        perf_counter en que la muestra seq quedó disponible en el puerto.
+        """
+        return self.t_ini + seq / self.fs
+
+
+class SerialFalso:
+    """
+    Lo que leer_desde_serial usa de serial.Serial: in_waiting, read()
+    con timeout, is_open y close().
+    """
+
+    def __init__(self, dispositivo: Dispositivo, timeout: float):
+        self.dispositivo = dispositivo
+        self.timeout = timeout
+        self.is_open = True
+
+    @property
+    def in_waiting(self) -> int:
+        return self.dispositivo.disponibles()
+
+    def read(self, n: int = 1) -> bytes:
+        limite = time.perf_counter() + self.timeout
+        while self.is_open and self.dispositivo.disponibles() == 0:
+            ahora = time.perf_counter()
+            if ahora >= limite:
+                return b""
+            proxima = self.dispositivo.instante(self.dispositivo.tramas_emitidas(ahora))
+            time.sleep(max(0.0, min(proxima, limite) - ahora))
+        return self.dispositivo.tomar(n)
+
+    def close(self):
+        self.is_open = False
+
+
+def _escribir_pty(dispositivo: Dispositivo, fd: int, parar: threading.Event, cpu: dict):
+    """
+    Hilo que vuelca al lado maestro del pty lo que el dispositivo emitió.
+    """
+    while not parar.is_set():
+        datos = dispositivo.tomar(1 << 16)
+        if datos:
+            os.write(fd, datos)
+        time.sleep(0.001)
+    cpu["pty"] = time.thread_time()
+
+
+def configurar_fs(app, fs: int):
+    """
+    Rehace los objetos de app.py que dependen de FS.
+    """
+    app.FS = fs
+    app._filtro = app.FiltroECG(fs) if app.FILTER_ENABLED else None
+    app._detector_pt = app.DetectorPanTompkins(fs)
+    app.datos_ecg = app.BufferMuestras(int(app.ECG_MEMORY_MIN * 60 * fs))
+    app._anillo_latidos = app.BufferAnillo(int(app.BEAT_RING_SECS * fs), np.float32)
+    app._reloj = app.RelojMuestras(fs)
+    app._hrv = app.AnalizadorHRV(fs)
+
+
+def _cliente_ws(client, formato: str, dispositivo: Dispositivo, fin: list, lat: list, cpu: list):
+    """
+    Cliente WS del harness: recibe hasta que fin[0] pasa y guarda la
+    latencia de la última muestra de cada mensaje.
+    """
+    import app
+    with client.websocket_connect(f"/ws?format={formato}") as ws:
+        while time.perf_counter() < fin[0]:
+            if formato == "binary":
+                msg = ws.receive_bytes()
+                ahora = time.perf_counter()
+                seq, n = app.WS_BIN_HEADER.unpack_from(msg)[:2]
+            else:
+                msg = json.loads(ws.receive_text())
+                ahora = time.perf_counter()
+                seq, n = msg["seq"], len(msg["values"])
+            lat.append(ahora - dispositivo.instante(seq + n - 1))
+    cpu.append(time.thread_time())
+
+
+def corrida(args) -> dict:
+    """
+    Una medición a args.fs[0] en este proceso.
+    """
+    import app
+    from fastapi.testclient import TestClient
+
+    fs = args.fs[0]
+    configurar_fs(app, fs)
+    app._test_cfg["enabled"] = False
+    app.activar_escritura = True
+    tmp = tempfile.TemporaryDirectory()
+    app._cambiar_db(str(Path(tmp.name) / "bench.db"))  # ruta absoluta: fuera de DATA_DIR
+
+    dispositivo = Dispositivo(fs, args.ruido)
+    abrir = threading.Event()
+    parar_pty = threading.Event()
+    cpu_harness = {}
+    if args.pty:
+        import pty
+        import tty
+        maestro, esclavo = pty.openpty()
+        tty.setraw(esclavo)
+        ruta_pty = os.ttyname(esclavo)
+        app.find_arduino_port = lambda prefer=None: ruta_pty
+        abrir_original = app._open_serial
+
+        def abrir_serial():
+            abrir.wait()
+            s = abrir_original()
+            dispositivo.arrancar()
+            threading.Thread(target=_escribir_pty, args=(dispositivo, maestro, parar_pty, cpu_harness),
+                             daemon=True).start()
+            return s
+    else:
+        def abrir_serial():
+            abrir.wait()
+            dispositivo.arrancar()
+            return SerialFalso(dispositivo, app.SER_TIMEOUT)
+    app._open_serial = abrir_serial
+
+    lat, cpu_clientes = [], []
+    with TestClient(app.app) as client:
+        # El modelo se carga en su hilo (import de torch): se espera antes de medir
+        limite = time.time() + 60
+        while app.INFER_ENABLED and app._modelo["state"] in ("not_loaded", "loading") and time.time() < limite:
+            time.sleep(0.1)
+        fin = [float("inf")]
+        hilos = [threading.Thread(target=_cliente_ws, args=(client, args.formato, dispositivo, fin, lat, cpu_clientes))
+                 for _ in range(args.clientes)]
+        for h in hilos:
+            h.start()
+        while len(app.ws_clients) < args.clientes:
+            time.sleep(0.01)
+        abrir.set()
+        while dispositivo.t_ini is None:
+            time.sleep(0.001)
+
+        # Calentamiento y medición
+        time.sleep(args.calentamiento)
+        muestras0, filas0 = app._reloj.stats["samples"], app._db_stats["rows_ecg"]
+        pipeline0 = app.estado_pipeline()
+        emitidas0 = dispositivo.tramas_emitidas()
+        cpu0, t0 = time.process_time(), time.perf_counter()
+        lat.clear()
+        time.sleep(args.segundos)
+        t = time.perf_counter() - t0
+        emitidas = dispositivo.tramas_emitidas() - emitidas0
+        muestras = app._reloj.stats["samples"] - muestras0
+        filas = app._db_stats["rows_ecg"] - filas0
+        pipeline = app.estado_pipeline()
+        fin[0] = time.perf_counter()
+        for h in hilos:
+            h.join(timeout=5.0)
+        cpu = time.process_time() - cpu0
+        parar_pty.set()
+    # Los hilos del harness (clientes y pty) no son costo de app.py
+    cpu -= sum(cpu_clientes) + cpu_harness.get("pty", 0.0)
+    tmp.cleanup()
+
+    lat_ms = np.asarray(lat) * 1000.0
+    perdidas = pipeline["lost"]["serial"] - pipeline0["lost"]["serial"]
+    descartadas = sum(pipeline["dropped"].values()) - sum(pipeline0["dropped"].values())
+    tardias = sum(pipeline["late"].values()) - sum(pipeline0["late"].values())
+    p = (lambda q: round(float(np.percentile(lat_ms, q)), 2) if lat_ms.size else None)
+    res = {
+        "fs": fs,
+        "emitted": emitidas,
+        "decoded": muestras,
+        "lost": perdidas,
+        "dropped": descartadas,
+        "late": tardias,
+        "ws_messages": int(lat_ms.size),
+        "lat_p50_ms": p(50), "lat_p95_ms": p(95), "lat_p99_ms": p(99),
+        "lat_max_ms": round(float(lat_ms.max()), 2) if lat_ms.size else None,
+        "db_rows_s": round(filas / t, 1),
+        "cpu_us_sample": round(cpu / max(muestras, 1) * 1e6, 2),
+        "cpu_pct": round(cpu / t * 100.0, 1),
+    }
+    # Sostenible: lee (casi) todo lo emitido, sin descartes y a tiempo
+    res["ok"] = bool(muestras >= 0.99 * emitidas and descartadas == 0
+                     and res["lat_p99_ms"] is not None and res["lat_p99_ms"] < app.LATE_MS)
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fs", type=int, nargs="*", default=[125, 250, 500, 1000, 2000, 4000, 8000])
+    ap.add_argument("--segundos", type=float, default=10.0, help="Medición por FS")
+    ap.add_argument("--calentamiento", type=float, default=2.0, help="Segundos antes de medir")
+    ap.add_argument("--clientes", type=int, default=2, help="Clientes WebSocket")
+    ap.add_argument("--formato", choices=("json", "binary"), default="json")
+    ap.add_argument("--ruido", type=float, default=0.0, help="Fracción de tramas corruptas")
+    ap.add_argument("--pty", action="store_true", help="Par de pseudo-terminales en vez del serial falso")
+    ap.add_argument("--seguir", action="store_true", help="Seguir con FS mayores tras el primer fallo")
+    ap.add_argument("--corrida", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.corrida:
+        print(json.dumps(corrida(args)))
+        return
+
+    import app
+    print(f"{args.clientes} clientes WS ({args.formato}), ruido {args.ruido:g}, "
+          f"{'pty' if args.pty else 'serial falso'}, {args.segundos:g} s por FS")
+    print(f"Tope del enlace real a {app.BAUDRATE} baudios: {app.BAUDRATE // 10 // app.FRAME_LEN} tramas/s")
+    print(f"{'FS':>6} {'leídas':>8} {'perd.':>6} {'desc.':>6} {'tard.':>6} {'p50':>8} {'p95':>8} {'p99':>8} "
+          f"{'max':>8} {'filas/s':>9} {'us/m':>7} {'CPU%':>6}")
+    maximo = None
+    base = [a for a in sys.argv[1:] if a != "--seguir"]
+    for fs in args.fs:
+        cmd = [sys.executable, __file__, *base, "--corrida", "--fs", str(fs)]
+        salida = subprocess.run(cmd, capture_output=True, text=True, cwd=Path(__file__).parent)
+        try:
+            r = json.loads(salida.stdout.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            print(f"{fs:>6} falló:\n{salida.stderr[-2000:]}")
+            break
+        print(f"{fs:>6} {r['decoded'] / max(r['emitted'], 1):>8.1%} {r['lost']:>6} {r['dropped']:>6} {r['late']:>6} "
+              f"{r['lat_p50_ms']!s:>8} {r['lat_p95_ms']!s:>8} {r['lat_p99_ms']!s:>8} {r['lat_max_ms']!s:>8} "
+              f"{r['db_rows_s']:>9} {r['cpu_us_sample']:>7} {r['cpu_pct']:>6}" + ("" if r["ok"] else "  <- no sostenible"))
+        if r["ok"]:
+            maximo = fs
+        elif not args.seguir:
+            break
+    print(f"FS máximo sostenible: {maximo if maximo is not None else 'ninguno'} Hz (latencias en ms)")
+
+
+if __name__ == "__main__":
+    main()
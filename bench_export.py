@@ -0,0 +1,76 @@
+"""
+Benchmark de /db/export por formato.
+
+Genera una BD temporal (esquema 2, chunks BLOB) con --horas de ECG
+sintético a --fs Hz y mide el generador de exportación de cada formato
+(sin HTTP): MB/s de salida, muestras/s y tamaño del archivo.
+
+    python bench_export.py --horas 1
+    python bench_export.py --horas 4 --formatos csv npy parquet --gzip
+"""
+import argparse
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+import app
+from bench_filtro import ecg_sintetico
+
+
+def crear_bd(ruta: Path, fs: float, horas: float):
+    conn = sqlite3.connect(str(ruta))
+    conn.execute(app._SQL_ECG_V2)
+    conn.execute("PRAGMA user_version = 2;")
+    conn.execute("PRAGMA journal_mode=WAL;")
+    x = ecg_sintetico(fs, 60.0)  # un minuto que se repite
+    t0 = time.time() - horas * 3600
+    cur = conn.cursor()
+    seq = 0
+    for minuto in range(int(horas * 60)):
+        bloques = [(t0 + minuto * 60.0, x, None, seq)]
+        chunks, _ = app._chunks_de_buffer(bloques, fs, force=True)
+        app._insertar_chunks(cur, chunks, "bench", fs)
+        seq += len(x)
+    conn.commit()
+    conn.close()
+    return seq, int(t0 * 1e9)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fs", type=float, default=float(app.FS))
+    ap.add_argument("--horas", type=float, default=1.0)
+    ap.add_argument("--formatos", nargs="*", default=list(app.EXPORT_FORMATOS))
+    ap.add_argument("--gzip", action="store_true", help="Medir también csv/npy comprimidos")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ruta = Path(tmp) / "bench.db"
+        muestras, t0_ns = crear_bd(ruta, args.fs, args.horas)
+        print(f"BD: {muestras} muestras ({args.horas:g} h a {args.fs:g} Hz), {ruta.stat().st_size / 1e6:.1f} MB")
+
+        casos = [(f, False) for f in args.formatos]
+        if args.gzip:
+            casos += [(f, True) for f in args.formatos if f in ("csv", "npy")]
+        for formato, comprimir in casos:
+            if formato in ("arrow", "parquet") and app._importar_pyarrow() is None:
+                print(f"{formato:>8}: sin pyarrow, se omite")
+                continue
+            # Calentamiento con 1 s de datos: imports perezosos (pyarrow) fuera de la medida
+            for _ in app._export_stream(ruta, "ecg", "raw", formato, t0_ns, t0_ns + 10**9, comprimir):
+                pass
+            t_ini = time.perf_counter()
+            total = 0
+            for datos in app._export_stream(ruta, "ecg", "raw", formato, None, None, comprimir):
+                total += len(datos)
+            t = time.perf_counter() - t_ini
+            nombre = formato + (".gz" if comprimir else "")
+            print(f"{nombre:>8}: {total / 1e6:8.1f} MB en {t:6.2f} s -> {total / 1e6 / t:7.1f} MB/s, "
+                  f"{muestras / t / 1e6:5.2f} M muestras/s")
+
+
+if __name__ == "__main__":
+    main()
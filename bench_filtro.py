@@ -0,0 +1,64 @@
+"""
+Benchmark de la etapa de filtrado (FiltroECG) en streaming.
+
+Filtra N segundos de ECG sintético a --fs Hz en bloques de --bloque
+muestras, igual que el lector serial, y mide el tiempo por bloque.
+El filtro va en tiempo real si procesa 1 s de señal en bastante menos de 1 s
+de CPU (factor de tiempo real >> 1).
+
+    python bench_filtro.py --fs 1000 --segundos 60 --bloque 10
+    python bench_filtro.py --fs 1000 --mediana 200 600
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app import FiltroECG, FILTER_BAND, FILTER_NOTCH_HZ
+
+
+def ecg_sintetico(fs: float, segundos: float) -> np.ndarray:
+    """
+    QRS gaussianos a ~72 lpm + deriva de línea base + red de 50 Hz + ruido,
+    en cuentas del ADC de 24 bits.
+    """
+    t = np.arange(int(fs * segundos)) / fs
+    x = np.zeros_like(t)
+    for b in np.arange(0.5, segundos, 60 / 72):
+        x += 40000 * np.exp(-((t - b) / 0.012) ** 2)
+    x += 20000 * np.sin(2 * np.pi * 0.25 * t) + 3000 * np.sin(2 * np.pi * 50 * t)
+    x += np.random.default_rng(0).normal(0, 500, len(t))
+    return np.round(x + 100000).astype(np.int32)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fs", type=float, default=1000.0)
+    ap.add_argument("--segundos", type=float, default=60.0)
+    ap.add_argument("--bloque", type=int, default=10, help="Muestras por bloque")
+    ap.add_argument("--mediana", type=int, nargs="*", default=None, help="Ventanas de mediana en ms")
+    args = ap.parse_args()
+
+    x = ecg_sintetico(args.fs, args.segundos)
+    filtro = FiltroECG(args.fs, banda=FILTER_BAND, notch_hz=FILTER_NOTCH_HZ, mediana_ms=args.mediana)
+
+    tiempos = []
+    for seq0 in range(0, len(x), args.bloque):
+        t_ini = time.perf_counter()
+        filtro.procesar(x[seq0:seq0 + args.bloque], seq0)
+        tiempos.append(time.perf_counter() - t_ini)
+
+    tiempos = np.asarray(tiempos)
+    total = tiempos.sum()
+    print(f"Filtro: {filtro.estado()}")
+    print(f"{len(x)} muestras a {args.fs:g} Hz en {len(tiempos)} bloques de {args.bloque}")
+    print(f"CPU total: {total:.3f} s para {args.segundos:g} s de señal "
+          f"-> factor de tiempo real {args.segundos / total:.1f}x")
+    print(f"Por bloque: p50 {np.percentile(tiempos, 50) * 1e6:.1f} us, "
+          f"p99 {np.percentile(tiempos, 99) * 1e6:.1f} us, max {tiempos.max() * 1e6:.1f} us "
+          f"(presupuesto {args.bloque / args.fs * 1e6:.0f} us)")
+    print(f"Throughput: {len(x) / total / 1e3:.1f} k muestras/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,23 @@
+"""
+Clasificación por lotes de latidos de 187 muestras con ECGNet.
+
+Lee la entrada por bloques de tamaño fijo (CSV separado por ';' o .npy
+mapeado en memoria), aplica scaler + modelo a cada bloque y escribe las
+predicciones a medida que salen: la memoria no crece con el tamaño de la
+entrada. Con --workers > 1 los bloques se reparten en un pool de procesos.
+
+    python predict.py
+    python predict.py --input latidos.npy --output clases.npy --workers 4
+    python predict.py --input dias.csv --output pred.csv --classes-only --threads 4
+"""
+import argparse
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import torch
-import pandas as pd
 import joblib
 class ECGNet(torch.nn.Module):
     def __init__(self, input_size, num_classes):
@@ -15,28 +33,173 @@ class ECGNet(torch.nn.Module):
         x = self.relu2(self.fc2(x))
         return self.fc3(x)
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = ECGNet(input_size=187, num_classes=5)  
-model.load_state_dict(torch.load("data/ecg_model_mlp.pth", map_location=device))
-model.to(device)
-model.eval()
+INPUT_SIZE  = 187
+NUM_CLASSES = 5
+
+def cargar_modelo(model_path, scaler_path, device="cpu"):
+    model = ECGNet(input_size=INPUT_SIZE, num_classes=NUM_CLASSES)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.to(device)
+    model.eval()
+    scaler = joblib.load(scaler_path)
+    return model, scaler
+
+def predecir(model, scaler, X, device="cpu"):
+    """
+    Clases predichas (int ndarray) para un bloque (n, INPUT_SIZE).
+    """
+    X_scaled = scaler.transform(np.asarray(X, dtype=np.float64))
+    with torch.inference_mode():
+        outputs = model(torch.as_tensor(X_scaled, dtype=torch.float32, device=device))
+        return outputs.argmax(dim=1).cpu().numpy()
+
+def leer_bloques(ruta, chunk, sep=";"):
+    """
+    Genera (fila inicial, bloque) sin cargar la entrada completa.
+    En .npy el bloque es una vista del memmap (se lee al usarlo).
+    """
+    if ruta.endswith(".npy"):
+        X = np.load(ruta, mmap_mode="r")
+        if X.ndim != 2 or X.shape[1] != INPUT_SIZE:
+            raise ValueError(f"NPY debe ser (n, {INPUT_SIZE}), es {X.shape}")
+        for inicio in range(0, len(X), chunk):
+            yield inicio, X[inicio:inicio + chunk]
+        return
+
+    import pandas as pd
+    inicio = 0
+    for df in pd.read_csv(ruta, header=None, sep=sep, chunksize=chunk, dtype=np.float64):
+        if df.shape[1] == 0:
+            raise ValueError("CSV FILE IS EMPTY")
+        yield inicio, df.to_numpy()
+        inicio += len(df)
+
+class EscritorPredicciones:
+    """
+    Escribe predicciones por bloques, en orden:
+    - .npy: vector int8 de clases (requiere conocer el total de filas).
+    - CSV: columnas 0..186 + Predicted_Class como antes, o sólo
+      Predicted_Class con classes_only.
+    """
+
+    def __init__(self, ruta, total=None, classes_only=False):
+        self.ruta = ruta
+        self.classes_only = classes_only
+        self.filas = 0
+        if ruta.endswith(".npy"):
+            if total is None:
+                raise ValueError("Salida .npy sólo con entrada .npy (total de filas conocido)")
+            self.npy = np.lib.format.open_memmap(ruta, mode="w+", dtype=np.int8, shape=(total,))
+            self.f = None
+        else:
+            self.npy = None
+            self.f = open(ruta, "w", newline="")
+            if classes_only:
+                self.f.write("Predicted_Class\n")
+            else:
+                self.f.write(",".join([str(i) for i in range(INPUT_SIZE)] + ["Predicted_Class"]) + "\n")
+
+    def escribir(self, X, clases):
+        if self.npy is not None:
+            self.npy[self.filas:self.filas + len(clases)] = clases
+        elif self.classes_only:
+            self.f.write("\n".join(map(str, clases.tolist())) + "\n")
+        else:
+            import pandas as pd
+            df = pd.DataFrame(np.asarray(X))
+            df["Predicted_Class"] = clases
+            df.to_csv(self.f, header=False, index=False)
+        self.filas += len(clases)
+
+    def cerrar(self):
+        if self.npy is not None:
+            self.npy.flush()
+            del self.npy
+        else:
+            self.f.close()
+
+# Estado de cada proceso del pool: modelo cargado una vez en el initializer
+_worker = {}
 
-scaler = joblib.load("data/minmaxscaler.pkl")
+def _init_worker(model_path, scaler_path, threads):
+    torch.set_num_threads(threads)
+    _worker["model"], _worker["scaler"] = cargar_modelo(model_path, scaler_path)
 
-new_data = pd.read_csv("ecg_segmentado_187.csv", header=None, sep=';')
+def _predecir_en_worker(tarea):
+    """
+    tarea es un bloque ndarray o (ruta .npy, inicio, fin): en el segundo
+    caso el proceso lee su rango del memmap y no se copia el bloque.
+    """
+    if isinstance(tarea, tuple):
+        ruta, inicio, fin = tarea
+        tarea = np.load(ruta, mmap_mode="r")[inicio:fin]
+    return predecir(_worker["model"], _worker["scaler"], tarea)
 
-if new_data.shape[1] == 0:
-    raise ValueError("CSV FILE IS EMPTY")
+class Progreso:
+    def __init__(self, cada=2.0):
+        self.t_ini = time.perf_counter()
+        self.t_ultimo = self.t_ini
+        self.cada = cada
+        self.filas = 0
 
-X_new = new_data.values  
-X_new_scaled = scaler.transform(X_new)
+    def sumar(self, n):
+        self.filas += n
+        ahora = time.perf_counter()
+        if ahora - self.t_ultimo >= self.cada:
+            self.t_ultimo = ahora
+            print(f"{self.filas} filas, {self.filas / (ahora - self.t_ini):.0f} filas/s", file=sys.stderr)
 
-X_new_tensor = torch.tensor(X_new_scaled, dtype=torch.float32).to(device)
+    def resumen(self, destino):
+        t = time.perf_counter() - self.t_ini
+        print(f"Listo: {self.filas} filas en {t:.2f} s ({self.filas / max(t, 1e-9):.0f} filas/s) -> {destino}")
 
-with torch.no_grad():
-    outputs = model(X_new_tensor)
-    _, predicted_classes = torch.max(outputs, 1)
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--input", default="ecg_segmentado_187.csv", help="CSV (sep ';') o .npy (n, 187)")
+    ap.add_argument("--output", default="predicted_data.csv", help="CSV o .npy (sólo clases)")
+    ap.add_argument("--model", default="data/ecg_model_mlp.pth")
+    ap.add_argument("--scaler", default="data/minmaxscaler.pkl")
+    ap.add_argument("--sep", default=";", help="Separador del CSV de entrada")
+    ap.add_argument("--chunk", type=int, default=8192, help="Filas por bloque")
+    ap.add_argument("--threads", type=int, default=torch.get_num_threads(), help="Hilos de torch (por proceso)")
+    ap.add_argument("--workers", type=int, default=1, help="Procesos; > 1 usa un pool")
+    ap.add_argument("--classes-only", action="store_true", help="CSV de salida sólo con Predicted_Class")
+    args = ap.parse_args()
 
-new_data['Predicted_Class'] = predicted_classes.cpu().numpy()
+    total = None
+    if args.input.endswith(".npy"):
+        total = np.load(args.input, mmap_mode="r").shape[0]
+    escritor = EscritorPredicciones(args.output, total, args.classes_only)
+    try:
+        if args.workers > 1:
+            # Como mucho 2 bloques en vuelo por proceso: memoria acotada
+            with ProcessPoolExecutor(args.workers, initializer=_init_worker,
+                                     initargs=(args.model, args.scaler, args.threads)) as pool:
+                progreso = Progreso()
+                en_vuelo = deque()
+                for inicio, X in leer_bloques(args.input, args.chunk, args.sep):
+                    tarea = (args.input, inicio, inicio + len(X)) if total is not None else X
+                    en_vuelo.append((X, pool.submit(_predecir_en_worker, tarea)))
+                    while len(en_vuelo) >= 2 * args.workers:
+                        X_listo, futuro = en_vuelo.popleft()
+                        escritor.escribir(X_listo, futuro.result())
+                        progreso.sumar(len(X_listo))
+                while en_vuelo:
+                    X_listo, futuro = en_vuelo.popleft()
+                    escritor.escribir(X_listo, futuro.result())
+                    progreso.sumar(len(X_listo))
+        else:
+            torch.set_num_threads(args.threads)
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            model, scaler = cargar_modelo(args.model, args.scaler, device)
+            progreso = Progreso()
+            for _, X in leer_bloques(args.input, args.chunk, args.sep):
+                escritor.escribir(X, predecir(model, scaler, X, device))
+                progreso.sumar(len(X))
+    finally:
+        escritor.cerrar()
+    progreso.resumen(args.output)
 
-new_data.to_csv("predicted_data.csv", index=False)
+# app.py importa ECGNet sin ejecutar el script
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Reprocesamiento por lotes de grabaciones guardadas.
+
+Recalcula R, BPM y clase de cada latido de uno o varios .db con el filtro,
+el detector Pan-Tompkins y el modelo actuales, en un pool de procesos (un
+archivo por proceso), y guarda los resultados en las tablas derived_beats
+/ derived_runs de cada archivo bajo --version. Un archivo a medias sigue
+desde donde quedó; uno terminado se salta (salvo --force). Es lo mismo que
+POST /reprocess, sin la API.
+
+    python reprocesar.py                         # los .db de data/ menos el que se graba
+    python reprocesar.py data/sesion1.db data/sesion2.db --workers 2
+    python reprocesar.py --version pt2 --force --sin-clases
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault("ECG_REPROC_WORKER", "1")  # ni este proceso ni el pool abren la BD activa
+import app
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("archivos", nargs="*", help="Archivos .db (por defecto los de DATA_DIR menos el que se está grabando)")
+    ap.add_argument("--version", default=app.REPROC_VERSION)
+    ap.add_argument("--workers", type=int, default=app.REPROC_WORKERS)
+    ap.add_argument("--force", action="store_true", help="Borrar esa versión y recalcular desde el principio")
+    ap.add_argument("--sin-clases", action="store_true", help="Sólo R y BPM, sin el modelo")
+    ap.add_argument("--cada", type=float, default=2.0, help="Segundos entre reportes de avance")
+    args = ap.parse_args()
+
+    rutas = [Path(a) for a in args.archivos] or app.rutas_reproceso_por_defecto()
+    if not rutas:
+        sys.exit("No hay archivos .db")
+    trabajo = app.lanzar_reproceso(rutas, args.version, args.workers, args.force, not args.sin_clases)
+    while trabajo["state"] == "running":
+        time.sleep(args.cada)
+        e = app.estado_reproceso(trabajo)
+        hechos = sum(1 for a in e["files"] if a["state"] == "done")
+        print(f"{e['samples_done']}/{e['samples_total']} muestras ({(e['progress'] or 0) * 100:.1f} %), "
+              f"{hechos}/{len(rutas)} archivos, {e['samples_per_s'] / 1e3:.0f} k muestras/s", file=sys.stderr)
+
+    e = app.estado_reproceso(trabajo)
+    for a in e["files"]:
+        sps = f"{a['samples_per_s'] / 1e3:.0f} k muestras/s" if a["samples_per_s"] else "-"
+        print(f"{a['name']}: {a['state']}, {a['samples_done']} muestras, {a['beats']} latidos, {sps}")
+    for nombre, error in trabajo["errors"].items():
+        print(f"{nombre}: error: {error}")
+    print(f"Listo ({args.version}): {e['samples_done']} muestras en {e['elapsed_s']:.1f} s "
+          f"({e['samples_per_s'] / 1e3:.0f} k muestras/s)")
+    sys.exit(1 if trabajo["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
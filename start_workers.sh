@@ -0,0 +1,8 @@
+#!/bin/bash
+# Adquisición en su propio proceso (control en 127.0.0.1:5001) y la API en
+# WORKERS procesos que leen la memoria compartida (puerto público 5000).
+cd "$(dirname "$0")"
+ECG_ACQ_MODE=process python app.py &
+ACQ_PID=$!
+trap 'kill $ACQ_PID 2>/dev/null' EXIT
+ECG_ACQ_MODE=attach uvicorn app:app --host 0.0.0.0 --port 5000 --workers "${WORKERS:-4}"